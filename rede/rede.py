@@ -13,6 +13,7 @@ import flask_limiter #pip install Flask-Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.utils import secure_filename
 import os, sys, json, secrets, io, glob, pathlib, unicodedata, string, importlib, time
+import orjson
 from functools import lru_cache
 import rede_config as config
 import pandas as pd
@@ -64,37 +65,17 @@ bConsultaGoogle = config.config['ETC'].getboolean('busca_google',False)
 bConsultaChaves = config.config['ETC'].getboolean('busca_chaves',False)
 ggeocode_max  = config.config['ETC'].getint('geocode_max', 15) 
 api_key_validas = [k.strip() for k in config.config['API'].get('api_keys', '').split(',')]
+lote_maximo_itens = config.config['API'].getint('lote_maximo_itens', 1000)
+conectados_maximo_itens = config.config['API'].getint('conectados_maximo_itens', 1000)
+paths_profundidade_maxima = config.config['API'].getint('paths_profundidade_maxima', 10)
 #https://blog.cambridgespark.com/python-context-manager-3d53a4d6f017
 gp = {}
 gp['camadaMaxima'] = 10
 gp['itensFlag'] = ['situacao_fiscal', 'pep', 'ceis', 'cepim', 'cnep', 'acordo_leniência', 'ceaf', 'pgfn-fgts', 'pgfn-sida','pgfn-prev', 'servidor_siape']
 
-#como é usada a tabela tmp_cnpjs no sqlite para todas as consultas, se houver requisições simultâneas ocorre colisão. 
-#o lock faz esperar terminar as requisições por ordem.
-#no linux, quando se usa nginx e uwsgi, usar lock do uwsgi, senão lock do threading (funciona no linux quando só tem 1 worker)
-import contextlib
-try:
-    import uwsgi #supondo que quando tem uwsgi instalado, está usando linux e nginx
-    gUwsgiLock=True
-    #rlock = contextlib.nullcontext() #funciona no python3.7
-    gLock =  contextlib.suppress() #python <3.7 #context manager que não faz nada
-    print('usando gUwsgiLock=True e gLock = contexlib.suppress()')
-except:
-    import threading
-    gUwsgiLock=False
-    gLock = threading.Lock() #prevenir erros de requisições seguidas. No servidor faz o esperado colocando só um thread no rede.wsgi.ini
-
-
-#sem usar lock, erro sqlite "database schema has changed"
-'''para remover o lock, necessita de um esquema para gerenciar tabelas temporárias.
-   foi colocado prefixos aleatórios às tabelas temporárias, mas em ambiente com thread provavelmente vai dar erro'''
-if False: #bloqueia em rede_sqlite_cnpj.py
-    #True= não usa bloqueio, rede_relacionamentos.gtabelaTempComPrefixo deve ser =True, para adicionar prefixo nas tabelas temporárias
-    #False= usa bloqueio
-    #gLock = contextlib.suppress() 
-    #gLock = contextlib.nullcontext() #somente python>=3.7
-    gLock =  contextlib.suppress()
-    gUwsgiLock = False
+#as consultas não usam lock. Cada requisição abre sua própria conexão sqlite :memory: para as tabelas temporárias (tmp_), 
+#então requisições simultâneas (threads ou workers do uwsgi) não colidem. As bases são abertas somente para leitura, 
+#exceto a base_local, que usa o lock de escrita do próprio sqlite.
 
 # @app.route("/")
 # def raiz():
@@ -235,21 +216,36 @@ def serve_rede_json_cnpj(tipo, camada=1, cpfcnpj=''):
         cpfcnpj = cpfcnpj.strip()
         listaIds = [cpfcnpj,]
 
+    #filtro dos tipos de ligação, por exemplo ?tipos=Sócio,Sócio-Administrador ou ?excluir_tipos=filial
+    tipos, excluirTipos = listaTiposLigacao(request.args.get('tipos')), listaTiposLigacao(request.args.get('excluir_tipos'))
+    analise = parametroVerdadeiro(request.args.get('analise')) #centralidade dos nós, não é feita na resposta em streaming
+    somenteMatriz = parametroVerdadeiro(request.args.get('matriz')) #matriz=1 troca as filiais pela matriz (campo qtde_filiais)
+    #data_ate=AAAA-MM-DD: só ligações com data de entrada até a data (a rede como estava na data). Com data_desde, o período entre as duas
+    periodo = periodoDasDatas(request.args)
+    #agrupar=1 troca as comunidades por nós CO_n. comunidade=CO_n retorna os itens da comunidade
+    comunidade = request.args.get('comunidade', '')
+    if parametroVerdadeiro(request.args.get('agrupar')) or comunidade:
+        if not criterioCaminhos:
+            return jsonify(rede_relacionamentos.camadasRedeAgrupada(camada=abs(camada), listaIds=listaIds, grupo='', tipos=tipos, excluirTipos=excluirTipos, 
+                                                                    analise=analise, comunidade=comunidade, somenteMatriz=somenteMatriz, periodo=periodo))
+        return jsonify(rede_relacionamentos.camadasRedeAgrupada(camada=abs(camada), grupo=listaIds, criterioCaminhos=criterioCaminhos, tipos=tipos, excluirTipos=excluirTipos, 
+                                                                analise=analise, comunidade=comunidade, somenteMatriz=somenteMatriz, periodo=periodo))
+    if request.args.get('formato')=='ndjson': #resposta em streaming, uma linha json por bloco de ligações ou nós
+        if not criterioCaminhos:
+            return respostaNDJSON(rede_relacionamentos.camadasRede_ndjson(camada=abs(camada), listaIds=listaIds, grupo = '', tipos=tipos, excluirTipos=excluirTipos, somenteMatriz=somenteMatriz, periodo=periodo))
+        return respostaNDJSON(rede_relacionamentos.camadasRede_ndjson(camada=abs(camada), grupo=listaIds, criterioCaminhos = criterioCaminhos, tipos=tipos, excluirTipos=excluirTipos, 
+                                                                          somenteMatriz=somenteMatriz, periodo=periodo))
     r = None
     try:
-        if gUwsgiLock:
-            uwsgi.lock()
-        with gLock:
-            if not criterioCaminhos:
-                noLig = rede_relacionamentos.camadasRede(camada=abs(camada), listaIds=listaIds, grupo = '',  bjson=True)
-            elif criterioCaminhos:
-                noLig = rede_relacionamentos.camadasRede(camada=abs(camada), grupo=listaIds, criterioCaminhos = criterioCaminhos, bjson=True)
-            r = jsonify(noLig)
+        if not criterioCaminhos:
+            noLig = rede_relacionamentos.camadasRede(camada=abs(camada), listaIds=listaIds, grupo = '',  bjson=True, tipos=tipos, excluirTipos=excluirTipos, analise=analise, 
+                                                     somenteMatriz=somenteMatriz, periodo=periodo)
+        elif criterioCaminhos:
+            noLig = rede_relacionamentos.camadasRede(camada=abs(camada), grupo=listaIds, criterioCaminhos = criterioCaminhos, bjson=True, tipos=tipos, excluirTipos=excluirTipos, analise=analise, 
+                                                     somenteMatriz=somenteMatriz, periodo=periodo)
+        r = jsonify(noLig)
     except Exception as e:
         print("ERROR : "+str(e))
-    finally:
-        if gUwsgiLock:
-            uwsgi.unlock()
     return r
 #.def serve_rede_json_cnpj
 
@@ -262,16 +258,7 @@ def serve_rede_json_links(cpfcnpj='', camada=1, numeroItens=15, valorMinimo=0, v
         listaIds = [cpfcnpj,]
     else:
         listaIds = request.get_json()
-    r = None
-    try:
-        if gUwsgiLock:
-            uwsgi.lock()
-        with gLock:
-            r = jsonify(rede_relacionamentos.camadaLink(listaIds=listaIds, camada=camada, numeroItens=numeroItens, valorMinimo=valorMinimo, valorMaximo=valorMaximo, tipoLink='link'))
-    finally:
-        if gUwsgiLock:
-            uwsgi.unlock()        
-    return r
+    return jsonify(rede_relacionamentos.camadaLink(listaIds=listaIds, camada=camada, numeroItens=numeroItens, valorMinimo=valorMinimo, valorMaximo=valorMaximo, tipoLink='link'))
 #.def serve_rede_json_links
 
 #@lru_cache #isto pode dar inconsistência com parametros via post??
@@ -282,72 +269,146 @@ def serve_dados_detalhes(cpfcnpj):
         idin = cpfcnpj
     else:
         idin = request.get_json()['idin']
-    try: 
-        if gUwsgiLock:
-            uwsgi.lock()
-        with gLock:
-            r = rede_relacionamentos.jsonDados([idin,])
-            if r:
-                return jsonify(r[0])
-            return jsonify({})
-    finally:
-        if gUwsgiLock:
-            uwsgi.unlock()    
+    r = rede_relacionamentos.jsonDados([idin,])
+    if r:
+        return jsonify(r[0])
+    return jsonify({})
 #.def serve_dados_detalhes
 
 @app.route('/rede/consulta_cnpj/', methods=['GET', 'POST']) #precisa manter com / no final para manter compatibilidade com robots
 @limiter.limit(limiter_dados)
 def serve_dados_html():
-    try: 
-        if gUwsgiLock:
-            uwsgi.lock()
-        with gLock:
-            return rede_relacionamentos.dados_consulta_cnpj(request, render_template, gp['itensFlag'])
-    finally:
-        if gUwsgiLock:
-            uwsgi.unlock()    
+    return rede_relacionamentos.dados_consulta_cnpj(request, render_template, gp['itensFlag'])
 #.def serve_dados_detalhes
 
 if config.config['API'].getboolean('api_cnpj', False):
     @app.route('/rede/api/<tipo>/<cnpj>', methods=['GET', 'POST']) 
     @limiter.limit(limiter_dados)
     def serve_dados_api(tipo, cnpj):
-        try: 
-            if gUwsgiLock:
-                uwsgi.lock()
-            with gLock:
-                return jsonify(rede_relacionamentos.dados_api_cnpj(cnpj, gp['itensFlag']))
-        finally:
-            if gUwsgiLock:
-                uwsgi.unlock()    
+        return jsonify(rede_relacionamentos.dados_api_cnpj(cnpj, gp['itensFlag']))
     #.def serve_dados_detalhes
     
 if config.config['API'].getboolean('api_caminhos', False):
     @app.route('/rede/api/caminhos', methods=['GET', 'POST']) 
     @limiter.limit(limiter_dados)
     def serve_api_caminhos():
-        try: 
-
-            if gUwsgiLock:
-                uwsgi.lock()
-            with gLock:
-                try:
-                    dados = request.get_json(force=True)
-                    
-                except:
-                    return abort(400, description='Não encontrou json na requisição')
-                
-                if (dados.get('api_key','') not in api_key_validas) or not dados.get('api_key'):
-                    return abort(401,  description='Chave inválida')
-                #print(dados)
-                #return jsonify(dados)
-                camada = min(gp['camadaMaxima'], int(dados['camada']))
-                return jsonify(rede_relacionamentos.camadasRede(camada=camada, grupo= dados['grupo'], listaIds=None, criterioCaminhos=dados['criterioCaminhos']))
-        finally:
-            if gUwsgiLock:
-                uwsgi.unlock()    
+        try:
+            dados = request.get_json(force=True)
+            
+        except:
+            return abort(400, description='Não encontrou json na requisição')
+        
+        if (dados.get('api_key','') not in api_key_validas) or not dados.get('api_key'):
+            return abort(401,  description='Chave inválida')
+        #print(dados)
+        #return jsonify(dados)
+        camada = min(gp['camadaMaxima'], int(dados['camada']))
+        tipos, excluirTipos = listaTiposLigacao(dados.get('tipos')), listaTiposLigacao(dados.get('excluir_tipos'))
+        somenteMatriz = parametroVerdadeiro(dados.get('matriz'))
+        periodo = periodoDasDatas(dados)
+        if dados.get('formato', request.args.get('formato'))=='ndjson':
+            return respostaNDJSON(rede_relacionamentos.camadasRede_ndjson(camada=camada, grupo= dados['grupo'], listaIds=None, criterioCaminhos=dados['criterioCaminhos'], tipos=tipos, excluirTipos=excluirTipos,
+                                                                          somenteMatriz=somenteMatriz, periodo=periodo))
+        if parametroVerdadeiro(dados.get('agrupar')) or dados.get('comunidade'):
+            return jsonify(rede_relacionamentos.camadasRedeAgrupada(camada=camada, grupo= dados['grupo'], listaIds=None, criterioCaminhos=dados['criterioCaminhos'], tipos=tipos, excluirTipos=excluirTipos,
+                                                                    analise=parametroVerdadeiro(dados.get('analise')), comunidade=dados.get('comunidade', ''), somenteMatriz=somenteMatriz, periodo=periodo))
+        return jsonify(rede_relacionamentos.camadasRede(camada=camada, grupo= dados['grupo'], listaIds=None, criterioCaminhos=dados['criterioCaminhos'], tipos=tipos, excluirTipos=excluirTipos,
+                                                        analise=parametroVerdadeiro(dados.get('analise')), somenteMatriz=somenteMatriz, periodo=periodo))
     #.def serve_api_caminhos
 
+if config.config['API'].getboolean('api_paths', False):
+    @app.route('/rede/api/paths', methods=['GET', 'POST']) 
+    @limiter.limit(limiter_dados)
+    def serve_api_paths():
+        ''' caminhos entre dois itens. json: {"api_key":..., "origem":..., "destino":..., "profundidade":6, "k":0, "tipos":[...], "excluir_tipos":[...], "data_ate":"AAAA-MM-DD"}
+            k=0 retorna todos os caminhos mais curtos, k>0 os k caminhos simples mais curtos'''
+        try:
+            dados = request.get_json(force=True)
+        except:
+            return abort(400, description='Não encontrou json na requisição')
+        if (dados.get('api_key','') not in api_key_validas) or not dados.get('api_key'):
+            return abort(401,  description='Chave inválida')
+        if not dados.get('origem') or not dados.get('destino'):
+            return abort(400, description='Informe origem e destino')
+        try:
+            profundidade = min(paths_profundidade_maxima, abs(int(dados.get('profundidade', paths_profundidade_maxima))))
+            k = abs(int(dados.get('k', 0)))
+        except (TypeError, ValueError):
+            return abort(400, description='profundidade ou k inválido')
+        return jsonify(rede_relacionamentos.caminhosEntreDois(str(dados['origem']), str(dados['destino']), profundidade=profundidade, k=k, 
+                                                              tipos=listaTiposLigacao(dados.get('tipos')), excluirTipos=listaTiposLigacao(dados.get('excluir_tipos')),
+                                                              periodo=periodoDasDatas(dados)))
+    #.def serve_api_paths
+
+if config.config['API'].getboolean('api_conectados', False):
+    @app.route('/rede/api/conectados', methods=['GET', 'POST']) 
+    @limiter.limit(limiter_dados)
+    def serve_api_conectados():
+        ''' json: {"api_key":..., "ids":[...]}. Retorna o componente conexo de cada item e se estão todos ligados, sem busca no grafo'''
+        try:
+            dados = request.get_json(force=True)
+        except:
+            return abort(400, description='Não encontrou json na requisição')
+        if (dados.get('api_key','') not in api_key_validas) or not dados.get('api_key'):
+            return abort(401,  description='Chave inválida')
+        if not isinstance(dados.get('ids'), list) or not dados['ids'] or len(dados['ids'])>conectados_maximo_itens:
+            return abort(400, description=f'Informe a lista ids, com até {conectados_maximo_itens} itens')
+        return jsonify(rede_relacionamentos.conectados([str(i) for i in dados['ids']]))
+    #.def serve_api_conectados
+
+if config.config['API'].getboolean('api_controle', False):
+    @app.route('/rede/api/controle', methods=['GET', 'POST']) 
+    @limiter.limit(limiter_dados)
+    def serve_api_controle():
+        ''' json: {"api_key":..., "cnpj":...}. Retorna os sócios pessoa física ou do exterior no topo das cadeias de sócios do cnpj, 
+            pela tabela cadeia_controle, sem expansão de camadas'''
+        try:
+            dados = request.get_json(force=True)
+        except:
+            return abort(400, description='Não encontrou json na requisição')
+        if (dados.get('api_key','') not in api_key_validas) or not dados.get('api_key'):
+            return abort(401,  description='Chave inválida')
+        if not dados.get('cnpj'):
+            return abort(400, description='Informe o cnpj')
+        return jsonify(rede_relacionamentos.controladores(str(dados['cnpj'])))
+    #.def serve_api_controle
+
+if config.config['API'].getboolean('api_lote', False):
+    @app.route('/rede/api/lote', methods=['POST']) 
+    @limiter.limit(limiter_dados)
+    def serve_api_lote():
+        ''' várias consultas numa requisição. json: {"api_key":..., "itens":[{"listaIds":[...], "camada":1, "excluir_tipos":["filial"], "analise":true, "matriz":true}, {"grupo":[[...],[...]], "camada":2, "criterioCaminhos":"caminhos"}, ...]}
+            resposta em ndjson, uma linha {"indice":k, "resultado":{...}} por item, na ordem em que as consultas terminam'''
+        try:
+            dados = request.get_json(force=True)
+        except:
+            return abort(400, description='Não encontrou json na requisição')
+        if (dados.get('api_key','') not in api_key_validas) or not dados.get('api_key'):
+            return abort(401,  description='Chave inválida')
+        itens = dados.get('itens')
+        if not isinstance(itens, list) or not itens:
+            return abort(400, description='Informe a lista de itens')
+        if len(itens)>lote_maximo_itens:
+            return abort(400, description=f'Máximo de {lote_maximo_itens} itens por requisição')
+        itensConsulta = []
+        for item in itens:
+            if not isinstance(item, dict) or not (item.get('listaIds') or item.get('grupo')):
+                return abort(400, description='Cada item deve ter listaIds ou grupo')
+            try:
+                camada = min(gp['camadaMaxima'], abs(int(item.get('camada', 1))))
+            except (TypeError, ValueError):
+                return abort(400, description='camada inválida')
+            itensConsulta.append({'listaIds':item.get('listaIds'), 'grupo':item.get('grupo'), 'camada':camada, 
+                                  'criterioCaminhos':item.get('criterioCaminhos', '') if item.get('grupo') else '',
+                                  'tipos':listaTiposLigacao(item.get('tipos')), 'excluirTipos':listaTiposLigacao(item.get('excluir_tipos')),
+                                  'analise':parametroVerdadeiro(item.get('analise')), 'agrupar':parametroVerdadeiro(item.get('agrupar')),
+                                  'somenteMatriz':parametroVerdadeiro(item.get('matriz')), 'periodo':periodoDasDatas(item)})
+        def gera():
+            for k, resultado in rede_relacionamentos.camadasRedeLote(itensConsulta):
+                yield orjson.dumps({'indice':k, 'resultado':resultado}) + b'\n' #bytes, como camadasRede_ndjson. O gerador roda fora do contexto da requisição
+        return respostaNDJSON(gera())
+    #.def serve_api_lote
+
 #https://www.techcoil.com/blog/serve-static-files-python-3-flask/
 
 # rotina antiga, para servir imagens - nginx não estava servindo imagens por erro de permissão na pasta
@@ -470,6 +531,14 @@ def serve_arquivos_json_upload_para_base(comentario=''):
     return jsonify({'retorno':'ok'})
 #.def serve_arquivos_json_upload_para_base
 
+@app.route('/rede/cache_estatisticas', methods=['GET'])
+@limiter.limit(limiter_padrao)
+def serve_cache_estatisticas():
+    if not usuarioLocal():
+        return jsonify({'mensagem':'Opção apenas disponível para usuário local'})
+    return jsonify(rede_relacionamentos.gCache.estatisticas())
+#.def serve_cache_estatisticas
+
 @app.route('/rede/envia_json/<acao>', methods=['POST'])
 @limiter.limit(limiter_padrao)
 def serve_envia_json_acao(acao=''):
@@ -503,29 +572,22 @@ def serve_envia_json_acao(acao=''):
 @limiter.limit(limiter_arquivos)
 def serve_dadosEmArquivo(formato='xlsx'):
     #dados = json.loads(request.form['dadosJSON']) #formato anterior
-    try: 
-        if gUwsgiLock:
-            uwsgi.lock()
-        with gLock:
-            dados = request.form.get('data')
-            try:
-                dados = json.loads(dados)
-            except Exception as err:
-                print('erro em dadosemarquivo:', err)
-                return 
-            if formato=='xlsx':
-                return send_file(rede_relacionamentos.dadosParaExportar(dados), 
-                                 download_name="rede_cnpj-"+time.strftime("%Y-%m-%d_%Hh%Mm")+".xlsx", as_attachment=True)
-            elif formato=='anx':
-                try:
-                    return send_file(rede_i2.jsonParai2(dados), 
-                                     download_name="rede_cnpj-"+time.strftime("%Y-%m-%d_%Hh%Mm")+".anx", as_attachment=True)
-                except Exception as err:
-                    print('erro na exportacao i2: ', err)
-                #return send_file('folium.html', download_name="mapa.html", as_attachment=False)
-    finally:
-        if gUwsgiLock:
-            uwsgi.unlock() 
+    dados = request.form.get('data')
+    try:
+        dados = json.loads(dados)
+    except Exception as err:
+        print('erro em dadosemarquivo:', err)
+        return 
+    if formato=='xlsx':
+        return send_file(rede_relacionamentos.dadosParaExportar(dados), 
+                         download_name="rede_cnpj-"+time.strftime("%Y-%m-%d_%Hh%Mm")+".xlsx", as_attachment=True)
+    elif formato=='anx':
+        try:
+            return send_file(rede_i2.jsonParai2(dados), 
+                             download_name="rede_cnpj-"+time.strftime("%Y-%m-%d_%Hh%Mm")+".anx", as_attachment=True)
+        except Exception as err:
+            print('erro na exportacao i2: ', err)
+        #return send_file('folium.html', download_name="mapa.html", as_attachment=False)
 #.def serve_dadosEmArquivo
 
 @app.route('/rede/mapa', methods = ['POST'])
@@ -680,6 +742,30 @@ def caminhoArquivoLocal(nomeArquivo):
         return nomeArquivo
 #.def caminhoArquivoLocal
 
+def listaTiposLigacao(valor):
+    ''' parâmetro tipos ou excluir_tipos: lista ou texto separado por vírgula. None se não informado'''
+    if not valor:
+        return None
+    if isinstance(valor, str):
+        valor = valor.split(',')
+    return [str(v).strip() for v in valor if str(v).strip()] or None
+
+def parametroVerdadeiro(valor):
+    ''' parâmetro booleano da url (1, true, sim) ou do json'''
+    if isinstance(valor, str):
+        return valor.strip().lower() in ('1', 'true', 'sim', 's')
+    return bool(valor)
+
+def periodoDasDatas(dados):
+    ''' parâmetros data_desde e data_ate (AAAA-MM-DD) da url ou do json, para o período do filtro de datas. Erro 400 se a data não for válida'''
+    try:
+        return rede_relacionamentos.periodoDatas(dados.get('data_desde'), dados.get('data_ate'))
+    except ValueError as e:
+        abort(400, description=str(e))
+
+def respostaNDJSON(gerador):
+    return Response(gerador, mimetype='application/x-ndjson')
+
 def usuarioLocal():
     return request.remote_addr ==  '127.0.0.1'
 
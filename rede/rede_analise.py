@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+centralidade dos nós da rede retornada por camadasRede
+
+Com o parâmetro analise, camadasRede monta uma matriz esparsa do subgrafo do resultado (nós e ligações do json)
+e anexa em cada nó o campo centralidade, com:
+    grau: quantidade de vizinhos no subgrafo (ligações repetidas entre os mesmos itens contam uma vez)
+    pagerank: pagerank do grafo sem direção, com amortecimento 0.85. A soma dos nós é 1
+    intermediacao: betweenness normalizada (0 a 1). Em subgrafos com mais nós que a amostra, usa só algumas origens sorteadas
+        (semente fixa, para a mesma rede dar o mesmo valor) e multiplica pela proporção, como em networkx.betweenness_centrality(k=...)
+As ligações são tratadas sem direção, como na expansão das camadas.
+A intermediação é o algoritmo de Brandes feito para várias origens de uma vez, com produtos da matriz de adjacência
+por matrizes densas (nós x origens), uma camada da busca em largura por produto.
+Precisa do numpy e usa scipy.sparse para os produtos (os dois estão no requirements.txt). Sem o scipy, os produtos são feitos
+só com numpy (vizinhos em CSR e np.add.reduceat), com o mesmo resultado e mais lentos.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+def disponivel():
+    return np is not None
+
+class Adjacencia():
+    ''' matriz de adjacência simétrica e sem repetição, em CSR. 
+        peso (opcional) é somado nas ligações repetidas e fica em self.peso, na ordem de self.vizinhos. A matriz não usa o peso'''
+    def __init__(self, n, origem, destino, peso=None):
+        self.n = n
+        chaves = np.concatenate([origem*n + destino, destino*n + origem])
+        pares, inverso = np.unique(chaves, return_inverse=True)
+        self.peso = np.bincount(inverso.ravel(), weights=None if peso is None else np.concatenate([peso, peso]), minlength=len(pares))
+        self.linhas, self.vizinhos = pares//n, pares%n
+        self.offsets = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.linhas, minlength=n), out=self.offsets[1:])
+        self.grau = np.diff(self.offsets)
+        self.matriz = None
+        if scipy is not None:
+            self.matriz = scipy.sparse.csr_matrix((np.ones(len(pares)), self.vizinhos, self.offsets), shape=(n, n))
+
+    def produto(self, x):
+        ''' A @ x, x com n linhas (vetor ou matriz densa)'''
+        if self.matriz is not None:
+            return self.matriz @ x
+        resultado = np.zeros(x.shape)
+        if len(self.vizinhos):
+            #reduceat não aceita segmento vazio: soma pelo início de cada linha com vizinhos
+            comVizinhos = self.grau>0
+            resultado[comVizinhos] = np.add.reduceat(x[self.vizinhos], self.offsets[:-1][comVizinhos], axis=0)
+        return resultado
+#.class Adjacencia
+
+def pagerank(adj, amortecimento=0.85, tolerancia=1e-8, iteracoesMaximas=100):
+    n = adj.n
+    x = np.full(n, 1.0/n)
+    semVizinhos = adj.grau==0
+    grau = np.where(semVizinhos, 1, adj.grau)
+    for _ in range(iteracoesMaximas):
+        novo = amortecimento*adj.produto(x/grau) + (amortecimento*x[semVizinhos].sum() + 1 - amortecimento)/n
+        if np.abs(novo-x).sum()<tolerancia*n:
+            return novo
+        x = novo
+    return x
+
+def intermediacao(adj, origens):
+    ''' soma das dependências (Brandes) das origens. Retorna o vetor sem normalizar'''
+    n, k = adj.n, len(origens)
+    colunas = np.arange(k)
+    sigma = np.zeros((n, k)) #quantidade de caminhos mais curtos da origem até o nó
+    sigma[origens, colunas] = 1
+    naoVisitados = np.ones((n, k), dtype=bool)
+    naoVisitados[origens, colunas] = False
+    niveis = [~naoVisitados] #nós de cada nível da busca em largura, por origem
+    fronteira = sigma
+    while True:
+        novos = adj.produto(fronteira)
+        novos *= naoVisitados
+        alcancados = novos>0
+        if not alcancados.any():
+            break
+        sigma += novos
+        naoVisitados &= ~alcancados
+        niveis.append(alcancados)
+        fronteira = novos
+    delta = np.zeros((n, k))
+    peso = np.zeros((n, k))
+    for d in range(len(niveis)-1, 1, -1): #o nível 0 é a própria origem, que não acumula
+        peso.fill(0)
+        np.divide(1+delta, sigma, out=peso, where=niveis[d])
+        delta += adj.produto(peso)*sigma*niveis[d-1]
+    return delta.sum(axis=1)
+
+def adjacenciaDoResultado(nos, ligacoes):
+    ''' matriz do subgrafo do json de camadasRede. Os nós são numerados na ordem de nos'''
+    posicao = {no['id']:k for k, no in enumerate(nos)}
+    pares = [(posicao[l['origem']], posicao[l['destino']]) for l in ligacoes
+             if l['origem'] in posicao and l['destino'] in posicao and l['origem']!=l['destino']]
+    a = np.array(pares, dtype=np.int64).reshape(-1, 2)
+    return Adjacencia(len(nos), a[:,0], a[:,1])
+
+def centralidades(nos, ligacoes, amostra=64, bloco=64, semente=0):
+    ''' nos e ligacoes no formato do json de camadasRede. Retorna {id: {'grau':..., 'pagerank':..., 'intermediacao':...}}'''
+    ids = [no['id'] for no in nos]
+    n = len(ids)
+    if not n:
+        return {}
+    adj = adjacenciaDoResultado(nos, ligacoes)
+    pr = pagerank(adj)
+    if amostra and n>amostra:
+        origens = np.random.default_rng(semente).choice(n, amostra, replace=False)
+    else:
+        origens = np.arange(n)
+    soma = np.zeros(n)
+    for inicio in range(0, len(origens), bloco):
+        soma += intermediacao(adj, origens[inicio:inicio+bloco])
+    #soma de pares ordenados (s,t), estimada para todas as origens. Normalizada pela quantidade de pares sem o próprio nó
+    bc = soma*(n/len(origens))/((n-1)*(n-2)) if n>2 else np.zeros(n)
+    return {i:{'grau':int(adj.grau[k]), 'pagerank':round(float(pr[k]), 6), 'intermediacao':round(float(bc[k]), 6)} for k, i in enumerate(ids)}
+#.def centralidades
+
+def coloracao(adj):
+    ''' coloração gulosa (nós de maior grau primeiro): nós vizinhos nunca têm a mesma cor'''
+    cor = np.full(adj.n, -1, dtype=np.int64)
+    offsets, vizinhos = adj.offsets.tolist(), adj.vizinhos.tolist()
+    for v in np.argsort(-adj.grau, kind='stable').tolist():
+        usadas = {cor[w] for w in vizinhos[offsets[v]:offsets[v+1]]}
+        c = 0
+        while c in usadas:
+            c += 1
+        cor[v] = c
+    return cor
+
+def propagaRotulos(adj, iteracoesMaximas=30):
+    ''' propagação de rótulos semi-síncrona: os nós de uma mesma cor (sem vizinhos entre si) mudam juntos para o rótulo de maior peso
+        entre os vizinhos. No empate, o nó fica com o rótulo atual se ele estiver entre os de maior peso, senão com o menor.
+        Não oscila em grafos bipartidos (sócio-empresa) como a versão síncrona e não depende de sorteio. Retorna o rótulo de cada nó'''
+    n = adj.n
+    cor = coloracao(adj)
+    ligacoesPorCor = [np.flatnonzero(cor[adj.linhas]==c) for c in range(int(cor.max())+1) if n]
+    ligacoesPorCor = [indices for indices in ligacoesPorCor if len(indices)] #cor só de nós sem ligação
+    rotulo = np.arange(n)
+    for _ in range(iteracoesMaximas):
+        mudou = 0
+        for indices in ligacoesPorCor:
+            chave, inverso = np.unique(adj.linhas[indices]*n + rotulo[adj.vizinhos[indices]], return_inverse=True) #ordenado por nó e rótulo
+            peso = np.bincount(inverso.ravel(), weights=adj.peso[indices], minlength=len(chave))
+            no, candidato = chave//n, chave%n
+            maximo = np.zeros(n)
+            np.maximum.at(maximo, no, peso)
+            mais = peso==maximo[no]
+            no, candidato = no[mais], candidato[mais]
+            fica = np.zeros(n, dtype=bool)
+            fica[no[candidato==rotulo[no]]] = True
+            primeiro = np.r_[True, no[1:]!=no[:-1]] #menor rótulo entre os de maior peso
+            no, candidato = no[primeiro], candidato[primeiro]
+            troca = ~fica[no]
+            rotulo[no[troca]] = candidato[troca]
+            mudou += int(troca.sum())
+        if not mudou:
+            break
+    return rotulo
+#.def propagaRotulos
+
+def comunidades(nos, ligacoes, alvo=0, niveisMaximos=10):
+    ''' comunidades do subgrafo do json de camadasRede, por propagação de rótulos. Se sobrarem mais de alvo comunidades (alvo>0), 
+        cada comunidade vira um nó de um grafo novo, com peso = quantidade de ligações entre elas, e a propagação é feita de novo,
+        como na agregação do método de Louvain. Os nós são numerados pelo id, então a mesma rede dá as mesmas comunidades em qualquer ordem
+        (a interface pede a expansão de uma comunidade em outra requisição, que pode ir para outro processo).
+        Retorna a lista com o número da comunidade de cada nó, na ordem de nos. A comunidade 0 é a maior'''
+    n = len(nos)
+    if not n:
+        return []
+    porId = sorted(range(n), key=lambda k: nos[k]['id'])
+    adj = adjacenciaDoResultado([nos[k] for k in porId], ligacoes)
+    membro = np.arange(n) #comunidade de cada nó original no nível atual
+    for _ in range(niveisMaximos):
+        unicos, inverso = np.unique(propagaRotulos(adj), return_inverse=True)
+        if len(unicos)==adj.n: #nenhum nó mudou de comunidade
+            break
+        membro = inverso[membro]
+        if not alvo or len(unicos)<=alvo:
+            break
+        metade = adj.linhas<adj.vizinhos #cada ligação uma vez, o construtor faz os dois sentidos
+        origem, destino = inverso[adj.linhas[metade]], inverso[adj.vizinhos[metade]]
+        diferentes = origem!=destino
+        adj = Adjacencia(len(unicos), origem[diferentes], destino[diferentes], adj.peso[metade][diferentes])
+    #renumera pelo tamanho da comunidade (maior primeiro) e pelo primeiro nó, para o número não depender dos rótulos
+    unicos, inverso, tamanho = np.unique(membro, return_inverse=True, return_counts=True)
+    ordem = np.lexsort((unicos, -tamanho))
+    numero = np.empty(len(unicos), dtype=np.int64)
+    numero[ordem] = np.arange(len(unicos))
+    resultado = [0]*n
+    for k, c in zip(porId, numero[inverso].tolist()):
+        resultado[k] = c
+    return resultado
+#.def comunidades
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+comparação de tempo por camada da expansão de camadasRede em layouts diferentes da tabela ligacao_int
+
+Gera um grafo sintético (poucos nós com muitas ligações, como holdings e escritórios de contabilidade) e grava a mesma
+tabela ligacao_int em arquivos sqlite com layouts diferentes:
+    rowid: tabela comum com índices (src, tipo) e (dst, tipo). Cada ligação achada no índice precisa de uma leitura na tabela para pegar as outras colunas
+    cobertura: tabela comum com índices (src, tipo, dst) e (dst, tipo, src), que já têm todas as colunas da consulta
+    clustered: tabela WITHOUT ROWID com chave (src, tipo, dst) e índice (dst, tipo), layout gerado por rede_cria_tabela_rede.db.py
+Para cada layout, expande as mesmas sementes com a consulta de camadasRede (fronteira, UNION das ligações por src e por dst)
+e mostra o tempo médio de cada camada. Não precisa das bases da rede-cnpj. Exemplo:
+    python rede_benchmark.py -n 2000000 -m 8000000 -c 3 -s 50
+Também compara os motores de expansão no layout clustered (ou na base indicada em --base, por exemplo bases/rede.db):
+    loop: a sequência de consultas por camada acima (motor_grafo=sqlite)
+    cte: uma consulta WITH RECURSIVE para todas as camadas e depois as ligações dos nós expandidos (motor_grafo=cte)
+    python rede_benchmark.py --base bases/rede.db -c 2 -s 100
+"""
+import os, sys, time, random, sqlite3, argparse, tempfile, statistics, json
+
+kTiposLigacao = 6
+kCodigoFilial = 900
+kMotores = ('loop', 'cte')
+kLayouts = {
+    'rowid': '''
+        CREATE TABLE ligacao_int (src INTEGER, dst INTEGER, tipo INTEGER);
+        INSERT INTO ligacao_int SELECT src, dst, tipo FROM origem.ligacao ORDER BY src;
+        CREATE INDEX idx_ligacao_int_src ON ligacao_int (src, tipo);
+        CREATE INDEX idx_ligacao_int_dst ON ligacao_int (dst, tipo);
+    ''',
+    'cobertura': '''
+        CREATE TABLE ligacao_int (src INTEGER, dst INTEGER, tipo INTEGER);
+        INSERT INTO ligacao_int SELECT src, dst, tipo FROM origem.ligacao ORDER BY src;
+        CREATE INDEX idx_ligacao_int_src ON ligacao_int (src, tipo, dst);
+        CREATE INDEX idx_ligacao_int_dst ON ligacao_int (dst, tipo, src);
+    ''',
+    'clustered': '''
+        CREATE TABLE ligacao_int (src INTEGER, dst INTEGER, tipo INTEGER, PRIMARY KEY (src, tipo, dst)) WITHOUT ROWID;
+        INSERT INTO ligacao_int SELECT src, dst, tipo FROM origem.ligacao ORDER BY src, tipo, dst;
+        CREATE INDEX idx_ligacao_int_dst ON ligacao_int (dst, tipo);
+    ''',
+}
+
+def runParser():
+    parser = argparse.ArgumentParser(description='tempo por camada da expansão de camadasRede em layouts da tabela ligacao_int')
+    parser.add_argument('-n', '--nos', action='store', dest='nos', type=int, default=1000000, help='quantidade de nós do grafo sintético')
+    parser.add_argument('-m', '--ligacoes', action='store', dest='ligacoes', type=int, default=4000000, help='quantidade de ligações')
+    parser.add_argument('-c', '--camada', action='store', dest='camada', type=int, default=3, help='camadas expandidas')
+    parser.add_argument('-s', '--sementes', action='store', dest='sementes', type=int, default=30, help='quantidade de consultas (uma semente por consulta)')
+    parser.add_argument('-l', '--layouts', action='store', dest='layouts', default=','.join(kLayouts), help='layouts separados por vírgula')
+    parser.add_argument('-e', '--motores', action='store', dest='motores', default=','.join(kMotores), help='motores comparados, separados por vírgula')
+    parser.add_argument('-b', '--base', action='store', dest='base', default='', help='mede os motores nesta base com a tabela ligacao_int (rede.db), sem gerar o grafo sintético')
+    parser.add_argument('-p', '--pasta', action='store', dest='pasta', default='', help='pasta dos arquivos temporários (padrão: pasta temporária do sistema)')
+    parser.add_argument('-j', '--json', action='store', dest='arquivoJson', default='', help='grava o resultado neste arquivo json')
+    parser.add_argument('--semente-aleatoria', action='store', dest='sementeAleatoria', type=int, default=1, help='semente do gerador aleatório')
+    return parser.parse_args()
+
+def geraGrafo(caminho, n, m):
+    ''' ligações com origem concentrada nos primeiros nós (random()**3), para haver nós com grau muito alto'''
+    con = sqlite3.connect(caminho)
+    con.execute('CREATE TABLE ligacao (src INTEGER, dst INTEGER, tipo INTEGER)')
+    geradas = 0
+    while geradas<m:
+        bloco = set()
+        for _ in range(min(500000, m-geradas)):
+            src, dst = 1 + int(n*random.random()**3), random.randint(1, n)
+            if src!=dst:
+                tipo = kCodigoFilial if random.random()<0.05 else random.randint(1, kTiposLigacao)
+                bloco.add((src, dst, tipo))
+        con.executemany('INSERT INTO ligacao VALUES (?,?,?)', bloco)
+        geradas += len(bloco)
+    #sem repetição, como em ligacao_int (a chave primária do layout clustered exige)
+    con.executescript('''
+        CREATE TABLE ligacao_unica AS SELECT DISTINCT src, dst, tipo FROM ligacao;
+        DROP TABLE ligacao;
+        ALTER TABLE ligacao_unica RENAME TO ligacao;
+    ''')
+    con.commit()
+    total = con.execute('select count(*) from ligacao').fetchone()[0]
+    con.execute('VACUUM')
+    con.close()
+    return total
+#.def geraGrafo
+
+def criaLayout(caminhoOrigem, caminho, layout):
+    if os.path.exists(caminho):
+        os.remove(caminho)
+    con = sqlite3.connect(caminho)
+    con.execute("ATTACH DATABASE '" + caminhoOrigem.replace("'", "''") + "' as origem")
+    con.executescript(kLayouts[layout])
+    con.commit()
+    con.execute('DETACH DATABASE origem')
+    con.execute('VACUUM')
+    con.close()
+    return os.path.getsize(caminho)
+
+def expandeCamadas(con, semente, camada):
+    ''' mesma sequência de consultas do loop de camadasRede_expande (motor sqlite, esquema em inteiros). Retorna [(segundos, nós novos)] por camada'''
+    con.executescript(f'''
+        DROP TABLE if exists tmp_nos;
+        CREATE TABLE tmp_nos (identificador PRIMARY KEY);
+        INSERT INTO tmp_nos VALUES ({semente});
+        DROP TABLE if exists tmp_fronteira;
+        CREATE TABLE tmp_fronteira AS SELECT identificador FROM tmp_nos;
+        DROP TABLE if exists tmp_lig_rede;
+        CREATE TABLE tmp_lig_rede (id1, id2, descricao);
+    ''')
+    tempos = []
+    for cam in range(camada):
+        inicio = time.perf_counter()
+        con.executescript(f'''
+            DROP TABLE if exists tmp_lig_camada;
+            CREATE TABLE tmp_lig_camada AS
+                SELECT t.src as id1, t.dst as id2, t.tipo as descricao
+                FROM tmp_fronteira tl INNER JOIN rede.ligacao_int t ON t.src=tl.identificador
+                UNION
+                SELECT t.src as id1, t.dst as id2, t.tipo as descricao
+                FROM tmp_fronteira tl INNER JOIN rede.ligacao_int t ON t.dst=tl.identificador
+                WHERE t.tipo<>{kCodigoFilial};
+            INSERT INTO tmp_lig_rede SELECT * FROM tmp_lig_camada;
+            DROP TABLE if exists tmp_fronteira;
+            CREATE TABLE tmp_fronteira AS
+            SELECT id1 as identificador FROM tmp_lig_camada
+            UNION
+            SELECT id2 FROM tmp_lig_camada
+            EXCEPT
+            SELECT identificador FROM tmp_nos;
+            INSERT INTO tmp_nos SELECT identificador FROM tmp_fronteira;
+        ''')
+        tempos.append((time.perf_counter()-inicio, con.execute('select count(*) from tmp_fronteira').fetchone()[0]))
+    return tempos
+#.def expandeCamadas
+
+def expandeCTE(con, semente, camada):
+    ''' mesma expansão de camadasRede_cte (sem limite de grau e de itens). Retorna (segundos, nós alcançados)'''
+    inicio = time.perf_counter()
+    alcancados = {semente}
+    def noNovo(no):
+        if no in alcancados:
+            return 0
+        alcancados.add(no)
+        return 1
+    con.create_function('no_novo_cte', 1, noNovo)
+    con.executescript(f'''
+        DROP TABLE if exists tmp_alcance;
+        CREATE TABLE tmp_alcance AS
+        WITH RECURSIVE alcance(no, camada) AS (
+            SELECT {semente}, 0
+            UNION ALL
+            SELECT t.dst, a.camada+1 FROM alcance a INNER JOIN rede.ligacao_int t ON t.src=a.no
+            WHERE CASE WHEN a.camada<{camada} THEN no_novo_cte(t.dst) ELSE 0 END
+            UNION ALL
+            SELECT t.src, a.camada+1 FROM alcance a INNER JOIN rede.ligacao_int t ON t.dst=a.no
+            WHERE CASE WHEN a.camada<{camada} AND t.tipo<>{kCodigoFilial} THEN no_novo_cte(t.src) ELSE 0 END
+            ORDER BY 2
+        )
+        SELECT no as identificador, camada FROM alcance;
+        DROP TABLE if exists tmp_lig_rede;
+        CREATE TABLE tmp_lig_rede AS
+        SELECT t.src as id1, t.dst as id2, t.tipo as descricao
+        FROM tmp_alcance x INNER JOIN rede.ligacao_int t ON t.src=x.identificador WHERE x.camada<{camada}
+        UNION
+        SELECT t.src, t.dst, t.tipo
+        FROM tmp_alcance x INNER JOIN rede.ligacao_int t ON t.dst=x.identificador WHERE x.camada<{camada} AND t.tipo<>{kCodigoFilial};
+    ''')
+    return time.perf_counter()-inicio, con.execute('select count(*) from tmp_alcance').fetchone()[0]
+#.def expandeCTE
+
+def conexaoBenchmark(caminho):
+    con = sqlite3.connect(':memory:')
+    con.execute('PRAGMA temp_store=MEMORY')
+    con.execute("ATTACH DATABASE '" + caminho.replace("'", "''") + "' as rede")
+    con.execute('PRAGMA rede.cache_size=-65536')
+    return con
+
+def medeMotores(caminho, sementes, camada, motores):
+    ''' tempo total por consulta de cada motor. Os nós alcançados de cada semente têm que ser iguais nos motores'''
+    con = conexaoBenchmark(caminho)
+    tempos = {m:[] for m in motores}
+    alcancados = {m:[] for m in motores}
+    for motor in motores:
+        for k, semente in enumerate([sementes[0]] + sementes): #a primeira consulta só aquece o cache de páginas
+            if motor=='loop':
+                camadas = expandeCamadas(con, semente, camada)
+                segundos, nos = sum(t for t, _ in camadas), 1 + sum(n for _, n in camadas)
+            else:
+                segundos, nos = expandeCTE(con, semente, camada)
+            if k:
+                tempos[motor].append(segundos)
+                alcancados[motor].append(nos)
+    con.close()
+    divergentes = sum(1 for nos in zip(*alcancados.values()) if len(set(nos))>1)
+    return {m:{'media_ms':round(1000*statistics.mean(tempos[m]), 3), 'mediana_ms':round(1000*statistics.median(tempos[m]), 3),
+               'nos_media':round(statistics.mean(alcancados[m]), 1)} for m in motores}, divergentes
+#.def medeMotores
+
+def imprimeMotores(motores, resultado, divergentes):
+    referencia = resultado[motores[0]]['media_ms']
+    print(f'{"motor":<12}{"média (ms)":>14}{"mediana (ms)":>14}{"nós alcançados":>16}')
+    for motor in motores:
+        r = resultado[motor]
+        ganho = referencia/r['media_ms'] if r['media_ms'] else 0
+        print(f'{motor:<12}{r["media_ms"]:>9.2f} ({ganho:.1f}x){r["mediana_ms"]:>14.2f}{r["nos_media"]:>16}')
+    if divergentes:
+        print(f'ATENÇÃO: {divergentes} sementes com quantidade de nós diferente entre os motores')
+
+def medeLayout(caminho, sementes, camada):
+    con = conexaoBenchmark(caminho)
+    expandeCamadas(con, sementes[0], camada) #aquece o cache de páginas
+    porCamada = [[] for _ in range(camada)]
+    nosPorCamada = [[] for _ in range(camada)]
+    for semente in sementes:
+        for k, (segundos, nos) in enumerate(expandeCamadas(con, semente, camada)):
+            porCamada[k].append(segundos)
+            nosPorCamada[k].append(nos)
+    con.close()
+    return [{'camada':k+1, 'media_ms':round(1000*statistics.mean(t), 3), 'mediana_ms':round(1000*statistics.median(t), 3),
+             'nos_novos_media':round(statistics.mean(nosPorCamada[k]), 1)} for k, t in enumerate(porCamada)]
+
+def main():
+    par = runParser()
+    layouts = [l.strip() for l in par.layouts.split(',') if l.strip()]
+    for layout in layouts:
+        if layout not in kLayouts:
+            print(f'layout {layout} não previsto. Use {", ".join(kLayouts)}.')
+            sys.exit(1)
+    motores = [m.strip() for m in par.motores.split(',') if m.strip()]
+    for motor in motores:
+        if motor not in kMotores:
+            print(f'motor {motor} não previsto. Use {", ".join(kMotores)}.')
+            sys.exit(1)
+    if 'cte' in motores and sqlite3.sqlite_version_info<(3, 34, 0):
+        print(f'o motor cte precisa do sqlite 3.34 ou mais novo (versão instalada: {sqlite3.sqlite_version}).')
+        sys.exit(1)
+    random.seed(par.sementeAleatoria)
+    if par.base: #só compara os motores na base indicada
+        if not os.path.exists(par.base):
+            print(f'o arquivo {par.base} não foi localizado.')
+            sys.exit(1)
+        con = sqlite3.connect(par.base)
+        maximo = con.execute('select max(src) from ligacao_int').fetchone()[0]
+        con.close()
+        sementes = random.sample(range(1, maximo+1), par.sementes)
+        print(time.asctime(), f'medindo motores em {par.base}')
+        resultadoMotores, divergentes = medeMotores(par.base, sementes, par.camada, motores)
+        print()
+        imprimeMotores(motores, resultadoMotores, divergentes)
+        if par.arquivoJson:
+            json.dump({'base':par.base, 'camada':par.camada, 'sementes':par.sementes, 'motores':resultadoMotores, 'divergentes':divergentes},
+                      open(par.arquivoJson, 'w', encoding='utf8'), ensure_ascii=False, indent=1)
+        return
+    pasta = par.pasta or tempfile.mkdtemp(prefix='rede_benchmark_')
+    caminhoOrigem = os.path.join(pasta, 'grafo_sintetico.db')
+    if os.path.exists(caminhoOrigem):
+        os.remove(caminhoOrigem)
+    print(time.asctime(), f'gerando grafo sintético com {par.nos} nós em {pasta}')
+    total = geraGrafo(caminhoOrigem, par.nos, par.ligacoes)
+    print(time.asctime(), f'{total} ligações')
+    #sementes fora dos primeiros nós, para não começar sempre de um nó com grau muito alto
+    sementes = random.sample(range(par.nos//10, par.nos+1), par.sementes)
+    resultado = {'nos':par.nos, 'ligacoes':total, 'camada':par.camada, 'sementes':par.sementes, 'layouts':{}}
+    divergentes = 0
+    for layout in layouts:
+        caminho = os.path.join(pasta, f'ligacao_{layout}.db')
+        tamanho = criaLayout(caminhoOrigem, caminho, layout)
+        print(time.asctime(), f'layout {layout}: {tamanho/2**20:.1f} MB, medindo')
+        resultado['layouts'][layout] = {'tamanho_mb':round(tamanho/2**20, 1), 'camadas':medeLayout(caminho, sementes, par.camada)}
+        if layout=='clustered' and motores: #layout gerado pelo rede_cria_tabela_rede.db.py
+            print(time.asctime(), 'medindo motores no layout clustered')
+            resultado['motores'], divergentes = medeMotores(caminho, sementes, par.camada, motores)
+        os.remove(caminho)
+    os.remove(caminhoOrigem)
+    if not par.pasta:
+        os.rmdir(pasta)
+
+    referencia = resultado['layouts'][layouts[0]]['camadas']
+    print()
+    print(f'{"layout":<12}{"MB":>8}' + ''.join(f'{"camada "+str(k+1)+" (ms)":>18}' for k in range(par.camada)))
+    for layout in layouts:
+        r = resultado['layouts'][layout]
+        linha = f'{layout:<12}{r["tamanho_mb"]:>8}'
+        for k, c in enumerate(r['camadas']):
+            ganho = referencia[k]['media_ms']/c['media_ms'] if c['media_ms'] else 0
+            linha += f'{c["media_ms"]:>11.2f} ({ganho:.1f}x)'
+        print(linha)
+    print('nós novos por camada (média):', [c['nos_novos_media'] for c in referencia])
+    if 'motores' in resultado:
+        print()
+        imprimeMotores(motores, resultado['motores'], divergentes)
+    if par.arquivoJson:
+        json.dump(resultado, open(par.arquivoJson, 'w', encoding='utf8'), ensure_ascii=False, indent=1)
+#.def main
+
+if __name__ == '__main__':
+    main()
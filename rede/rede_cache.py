@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+cache dos resultados de camadasRede e camadaLink
+
+Os resultados são guardados já serializados com orjson, num OrderedDict com limite de bytes (LRU: descarta o usado há mais tempo).
+A chave é montada em rede_sqlite_cnpj.cacheResultado (itens de entrada normalizados, camada, critério e data de referência das bases).
+Com mais de um worker do uwsgi, cada processo tem seu cache. A data de modificação da base_local faz parte da chave,
+então uma gravação feita por outro processo também invalida os resultados antigos.
+"""
+import threading, collections
+import orjson
+
+class CacheResultados():
+    def __init__(self, limiteBytes):
+        self.limiteBytes = limiteBytes
+        self.itens = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.acertos = 0
+        self.falhas = 0
+        self.descartes = 0
+
+    def ativo(self):
+        return self.limiteBytes>0
+
+    def obtem(self, chave):
+        ''' retorna uma cópia nova do resultado (o orjson.loads é rápido), ou None'''
+        with self.lock:
+            valor = self.itens.get(chave)
+            if valor is None:
+                self.falhas += 1
+                return None
+            self.itens.move_to_end(chave)
+            self.acertos += 1
+        return orjson.loads(valor)
+
+    def guarda(self, chave, resultado):
+        valor = orjson.dumps(resultado)
+        if len(valor)>self.limiteBytes: #não guarda resultado maior que o cache inteiro
+            return
+        with self.lock:
+            anterior = self.itens.pop(chave, None)
+            if anterior is not None:
+                self.bytes -= len(anterior)
+            self.itens[chave] = valor
+            self.bytes += len(valor)
+            while self.bytes>self.limiteBytes:
+                _, descartado = self.itens.popitem(last=False)
+                self.bytes -= len(descartado)
+                self.descartes += 1
+
+    def limpa(self):
+        with self.lock:
+            self.itens.clear()
+            self.bytes = 0
+
+    def estatisticas(self):
+        with self.lock:
+            total = self.acertos + self.falhas
+            return {'itens':len(self.itens), 'bytes':self.bytes, 'limite_bytes':self.limiteBytes,
+                    'acertos':self.acertos, 'falhas':self.falhas, 'descartes':self.descartes,
+                    'taxa_acerto':round(self.acertos/total, 4) if total else 0}
+#.class CacheResultados
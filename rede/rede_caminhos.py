@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+busca de caminhos mais curtos entre os itens de entrada (caminhos, intra e extra)
+
+BFS com rótulos a partir de todas as origens ao mesmo tempo. Cada rótulo é (identificador de origem, grupo) e guarda
+a camada em que alcançou cada nó e as ligações que chegaram ao nó nessa camada (todos os caminhos mais curtos).
+As ligações são buscadas só para a fronteira de cada camada (Adjacencia), não é preciso expandir antes toda a rede.
+Um par de origens é resolvido na primeira camada em que os dois rótulos se encontram: se os dois já expandiram até a camada k,
+a distância D é 2k-1 ou 2k e os nós de cruzamento no meio do caminho (camada D//2 ou D-D//2 de cada lado) já são conhecidos.
+A origem que não tem mais pares pendentes para de expandir.
+Até a camada pedida, as ligações são as da tabela rede.ligacao e as de endereços e da base local. Na camada seguinte,
+só as de endereços e da base local, como na rotina anterior (camadasRede_caminhos), que ia uma camada além por causa dos endereços.
+As ligações são percorridas nos dois sentidos, inclusive filial (na expansão de camadas, filial só é seguida a partir da matriz).
+Para dois itens (/rede/api/paths): bfsBidirecional, com todos os caminhos mais curtos ou os k caminhos simples mais curtos (Yen).
+"""
+import time, collections, heapq
+
+class Adjacencia():
+    ''' ligações de uma lista de nós, nos dois sentidos.
+        As ligações de rede.ligacao vêm do grafo em memória (motor csr ou mmap) ou do sqlite. As de endereços e base local, do sqlite'''
+    def __init__(self, con, tmp, esquema, tabelasLinks, grafo=None, filtroTipos='', codigosGrafo=None):
+        self.con = con
+        self.tmp = tmp
+        self.esquema = esquema #ver esquemaLigacao em rede_sqlite_cnpj
+        self.tabelasLinks = tabelasLinks #tabelas com colunas id1, id2, descricao, por exemplo endereco.link_ete
+        self.grafo = grafo
+        self.filtroTipos = filtroTipos #trecho sql " AND t.tipo IN (...)" para as ligações de rede.ligacao, ver filtroTiposSQL em rede_sqlite_cnpj
+        self.codigosGrafo = codigosGrafo #o mesmo filtro, com os códigos de tipo do grafo em memória
+
+    def _consultaTexto(self, tabela, id1='id1', id2='id2', descricao='descricao', filtro=''):
+        tmp = self.tmp
+        return f'''
+            SELECT f.identificador, t.{id1}, t.{id2}, t.{descricao} FROM {tmp}_caminhos_fronteira f INNER JOIN {tabela} t ON t.{id1}=f.identificador{filtro}
+            UNION ALL
+            SELECT f.identificador, t.{id1}, t.{id2}, t.{descricao} FROM {tmp}_caminhos_fronteira f INNER JOIN {tabela} t ON t.{id2}=f.identificador{filtro}
+        '''
+
+    def _consultaInteiro(self):
+        tmp = self.tmp
+        return f'''
+            SELECT f.identificador, f.identificador, n2.ident, t.tipo
+            FROM {tmp}_caminhos_fronteira f INNER JOIN rede.node n ON n.ident=f.identificador
+            INNER JOIN rede.ligacao_int t ON t.src=n.id{self.filtroTipos}
+            INNER JOIN rede.node n2 ON n2.id=t.dst
+            UNION ALL
+            SELECT f.identificador, n1.ident, f.identificador, t.tipo
+            FROM {tmp}_caminhos_fronteira f INNER JOIN rede.node n ON n.ident=f.identificador
+            INNER JOIN rede.ligacao_int t ON t.dst=n.id{self.filtroTipos}
+            INNER JOIN rede.node n1 ON n1.id=t.src
+        ''' #o código do tipo é convertido para descrição em ligacoes
+
+    def _ligacoesGrafo(self, nos):
+        grafo = self.grafo
+        posicoes = grafo.posicoes(nos)
+        filtro = posicoes>=0
+        posicoes = posicoes[filtro]
+        if not len(posicoes):
+            return []
+        nosGrafo = [n for n, f in zip(nos, filtro) if f]
+        numero = {p:k for k, p in enumerate(posicoes.tolist())}
+        resultado = []
+        for offsets, vizinhos, tipos, bSaida in ((grafo.offsetsSaida, grafo.vizinhosSaida, grafo.tiposSaida, True),
+                                                 (grafo.offsetsEntrada, grafo.vizinhosEntrada, grafo.tiposEntrada, False)):
+            orig, dest, tip = grafo._junta(offsets, vizinhos, tipos, posicoes)
+            if self.codigosGrafo is not None:
+                filtro = grafo.mascaraTipos(tip, self.codigosGrafo)
+                orig, dest, tip = orig[filtro], dest[filtro], tip[filtro]
+            if not len(orig):
+                continue
+            idsDest = grafo.identificador(dest)
+            for o, d, t in zip(orig.tolist(), idsDest, tip.tolist()):
+                no = nosGrafo[numero[o]]
+                resultado.append((no, no, d, grafo.descricoes[t]) if bSaida else (no, d, no, grafo.descricoes[t]))
+        return resultado
+
+    def _gravaFronteira(self, nos):
+        tmp = self.tmp
+        self.con.executescript(f'''DROP TABLE if exists {tmp}_caminhos_fronteira;
+                                   CREATE TABLE {tmp}_caminhos_fronteira (identificador PRIMARY KEY);''')
+        self.con.executemany(f'INSERT INTO {tmp}_caminhos_fronteira VALUES (?)', ((n,) for n in nos))
+
+    def ligacoes(self, nos, bRede=True):
+        ''' lista de (no, id1, id2, descricao) com as ligações dos nós. bRede=False só busca endereços e base local'''
+        nos = list(nos)
+        resultado = []
+        consultas = []
+        e = self.esquema
+        if bRede and self.grafo is not None:
+            resultado.extend(self._ligacoesGrafo(nos))
+        elif bRede and not e['inteiro']:
+            consultas.append(self._consultaTexto(e['tabela'], filtro=self.filtroTipos))
+        consultas.extend(self._consultaTexto(tabela) for tabela in self.tabelasLinks)
+        bInteiro = bRede and self.grafo is None and e['inteiro']
+        if consultas or bInteiro:
+            self._gravaFronteira(nos)
+        if bInteiro:
+            descricaoTipo = e['descricaoTipo']
+            resultado.extend((no, id1, id2, descricaoTipo.get(t, '')) for no, id1, id2, t in self.con.execute(self._consultaInteiro()))
+        for query in consultas:
+            resultado.extend(self.con.execute(query).fetchall())
+        return resultado
+#.class Adjacencia
+
+def paresDoCriterio(rotulos, criterio, componentes=None):
+    ''' pares (i, j), i<j, de rótulos (identificador, grupo) com origens diferentes que atendem ao critério.
+        componentes: dicionário identificador -> componente conexo. Pares em componentes diferentes não têm caminho e ficam de fora'''
+    if criterio not in ('caminhos', 'intra', 'extra'):
+        raise Exception('critério de caminhos não previsto.')
+    pares = set()
+    for i, (origem1, grupo1) in enumerate(rotulos):
+        for j in range(i+1, len(rotulos)):
+            origem2, grupo2 = rotulos[j]
+            if origem1==origem2:
+                continue
+            if (criterio=='intra' and grupo1!=grupo2) or (criterio=='extra' and grupo1==grupo2):
+                continue
+            if componentes and componentes.get(origem1, origem1)!=componentes.get(origem2, origem2):
+                continue
+            pares.add((i, j))
+    return pares
+
+def voltaAteOrigem(cruzamentos, camadas, predecessores):
+    ''' ligações de todos os caminhos mais curtos da origem até os nós de cruzamento: gera (ligacao, camada)'''
+    vistos = set(cruzamentos)
+    pilha = list(cruzamentos)
+    while pilha:
+        no = pilha.pop()
+        for pai, ligacao in predecessores.get(no, ()):
+            yield ligacao, camadas[no]
+            if pai not in vistos:
+                vistos.add(pai)
+                pilha.append(pai)
+
+def buscaCaminhos(adjacencia, rotulos, criterio, camada, limiteNos=0, tempoMaximo=0, componentes=None):
+    ''' rotulos: lista de (identificador de origem, grupo). componentes: ver paresDoCriterio.
+        Retorna (linhas, mensagem, tamanhoFronteiras).
+        linhas: (id1, id2, descricao, camada, id_origem, id_destino, grupo_origem, grupo_destino, camada_caminho),
+        com as duas metades de cada caminho (a partir da origem e a partir do destino), como em camadasRede_caminhos'''
+    tempoInicio = time.time()
+    rotulos = list(rotulos)
+    pendentes = paresDoCriterio(rotulos, criterio, componentes)
+    camadas = [{origem:0} for origem, _ in rotulos] #nó -> camada, para cada rótulo
+    predecessores = [{} for _ in rotulos] #nó -> lista de (nó anterior, ligação) dos caminhos mais curtos
+    fronteiras = [[origem] for origem, _ in rotulos]
+    donos = collections.defaultdict(list) #nó -> rótulos que já alcançaram o nó
+    for i, (origem, _) in enumerate(rotulos):
+        donos[origem].append(i)
+    linhas = set()
+    mensagem = ''
+    tamanhoFronteiras = []
+    encontros = set() #pares que se encontraram na camada atual
+    for cam in range(1, camada+2):
+        ativos = {i for par in pendentes for i in par}
+        nosFronteira = set()
+        for i in ativos:
+            nosFronteira.update(fronteiras[i])
+        if not nosFronteira:
+            break
+        vizinhos = collections.defaultdict(set)
+        for no, id1, id2, descricao in adjacencia.ligacoes(nosFronteira, bRede=cam<=camada):
+            vizinhos[no].add((id2 if id1==no else id1, (id1, id2, descricao)))
+        novos = 0
+        for i in ativos:
+            camadasRotulo, predRotulo = camadas[i], predecessores[i]
+            nova = []
+            for no in fronteiras[i]:
+                for outro, ligacao in vizinhos.get(no, ()):
+                    c = camadasRotulo.get(outro)
+                    if c is None:
+                        camadasRotulo[outro] = cam
+                        predRotulo[outro] = [(no, ligacao)]
+                        nova.append(outro)
+                        for j in donos[outro]:
+                            encontros.add((min(i, j), max(i, j)))
+                        donos[outro].append(i)
+                    elif c==cam:
+                        predRotulo[outro].append((no, ligacao))
+            fronteiras[i] = nova
+            novos += len(nova)
+        tamanhoFronteiras.append(novos)
+        for i, j in encontros & pendentes:
+            ci, cj = camadas[i], camadas[j]
+            if len(cj)<len(ci):
+                menor, outro = cj, ci
+            else:
+                menor, outro = ci, cj
+            distancia = min(c + outro[n] for n, c in menor.items() if n in outro)
+            meio = {distancia//2, distancia - distancia//2}
+            cruzamentos = [n for n, c in ci.items() if c in meio and cj.get(n)==distancia-c]
+            for a, b in ((i, j), (j, i)):
+                (origem, grupoOrigem), (destino, grupoDestino) = rotulos[a], rotulos[b]
+                for (id1, id2, descricao), c in voltaAteOrigem(cruzamentos, camadas[a], predecessores[a]):
+                    linhas.add((id1, id2, descricao, c, origem, destino, grupoOrigem, grupoDestino, distancia))
+            pendentes.discard((i, j))
+        encontros.clear()
+        if not pendentes:
+            break
+        if cam<camada:
+            if limiteNos and len(donos)>limiteNos:
+                mensagem += f'A busca de caminhos parou na camada {cam}, pois excedeu o limite de itens por camada ({limiteNos}).'
+                break
+            if tempoMaximo and (time.time()-tempoInicio)>tempoMaximo:
+                mensagem += f'A busca de caminhos parou na camada {cam}, pois excedeu o tempo máximo de consulta.'
+                break
+    return list(linhas), mensagem, tamanhoFronteiras
+#.def buscaCaminhos
+
+class LimiteExcedido(Exception):
+    pass
+
+class AdjacenciaCache():
+    ''' guarda os vizinhos já buscados, para as várias buscas de caminhoMaisCurto (k caminhos) não repetirem consultas.
+        vizinhos[no] é um dicionário vizinho -> conjunto de ligações (id1, id2, descricao)'''
+    def __init__(self, adjacencia):
+        self.adjacencia = adjacencia
+        self.vizinhos = {}
+
+    def vizinhosDe(self, nos):
+        faltam = [n for n in nos if n not in self.vizinhos]
+        if faltam:
+            for n in faltam:
+                self.vizinhos[n] = {}
+            for no, id1, id2, descricao in self.adjacencia.ligacoes(faltam):
+                outro = id2 if id1==no else id1
+                if outro!=no:
+                    self.vizinhos[no].setdefault(outro, set()).add((id1, id2, descricao))
+        return self.vizinhos
+#.class AdjacenciaCache
+
+def bfsBidirecional(adjacencia, origem, destino, profundidade, nosProibidos=frozenset(), paresProibidos=frozenset(), limiteNos=0):
+    ''' BFS a partir das duas pontas, sempre expandindo o lado com a fronteira menor, até os dois lados se encontrarem.
+        Retorna (distancia, cruzamentos, predecessores da origem, predecessores do destino) ou None se não houver caminho até a profundidade.
+        paresProibidos: ligações (no1, no2) que não podem ser usadas, nos dois sentidos'''
+    if origem==destino:
+        return 0, [origem], {origem:[]}, {destino:[]}
+    lados = [{'camadas':{origem:0}, 'pred':{origem:[]}, 'fronteira':[origem], 'nivel':0},
+             {'camadas':{destino:0}, 'pred':{destino:[]}, 'fronteira':[destino], 'nivel':0}]
+    while lados[0]['nivel'] + lados[1]['nivel'] < profundidade:
+        lado, outro = (lados[0], lados[1]) if len(lados[0]['fronteira'])<=len(lados[1]['fronteira']) else (lados[1], lados[0])
+        if not lado['fronteira']:
+            return None
+        vizinhos = adjacencia.vizinhosDe(lado['fronteira'])
+        nivel = lado['nivel'] + 1
+        camadas, pred = lado['camadas'], lado['pred']
+        nova = []
+        for no in lado['fronteira']:
+            for viz in vizinhos[no]:
+                if viz in nosProibidos or (no, viz) in paresProibidos or (viz, no) in paresProibidos:
+                    continue
+                c = camadas.get(viz)
+                if c is None:
+                    camadas[viz] = nivel
+                    pred[viz] = [no]
+                    nova.append(viz)
+                elif c==nivel:
+                    pred[viz].append(no)
+        lado['fronteira'], lado['nivel'] = nova, nivel
+        if limiteNos and len(lados[0]['camadas']) + len(lados[1]['camadas'])>limiteNos:
+            raise LimiteExcedido(f'A busca passou de {limiteNos} itens.')
+        #os lados só se encontram nos nós novos deste lado. Todo caminho mais curto passa por um deles
+        cruzamentos = [n for n in nova if n in outro['camadas']]
+        if cruzamentos:
+            distancia = min(nivel + outro['camadas'][n] for n in cruzamentos)
+            cruzamentos = sorted(n for n in cruzamentos if nivel + outro['camadas'][n]==distancia)
+            return distancia, cruzamentos, lados[0]['pred'], lados[1]['pred']
+    return None
+#.def bfsBidirecional
+
+def caminhosAteRaiz(no, pred):
+    ''' todos os caminhos mais curtos da raiz da BFS até o nó, em listas da raiz para o nó, em ordem alfabética'''
+    if not pred[no]:
+        yield [no]
+        return
+    for p in sorted(pred[no]):
+        for c in caminhosAteRaiz(p, pred):
+            yield c + [no]
+
+def todosCaminhosMaisCurtos(adjacencia, origem, destino, profundidade, **kw):
+    ''' gera todos os caminhos mais curtos entre origem e destino (listas de nós)'''
+    r = bfsBidirecional(adjacencia, origem, destino, profundidade, **kw)
+    if r is None:
+        return
+    _, cruzamentos, predOrigem, predDestino = r
+    for n in cruzamentos:
+        for inicio in caminhosAteRaiz(n, predOrigem):
+            for fim in caminhosAteRaiz(n, predDestino):
+                yield inicio + fim[::-1][1:]
+
+def caminhoMaisCurto(adjacencia, origem, destino, profundidade, **kw):
+    return next(todosCaminhosMaisCurtos(adjacencia, origem, destino, profundidade, **kw), None)
+
+def kCaminhosMaisCurtos(adjacencia, origem, destino, k, profundidade, limiteNos=0):
+    ''' gera os k caminhos simples mais curtos, em ordem de comprimento (algoritmo de Yen).
+        Cada busca de desvio é uma BFS bidirecional. Os vizinhos ficam em AdjacenciaCache, então as buscas repetem pouco as consultas'''
+    caminho = caminhoMaisCurto(adjacencia, origem, destino, profundidade, limiteNos=limiteNos)
+    if caminho is None:
+        return
+    encontrados = [caminho]
+    vistos = {tuple(caminho)}
+    candidatos = []
+    yield caminho
+    while len(encontrados)<k:
+        ultimo = encontrados[-1]
+        for i in range(len(ultimo)-1):
+            raiz = ultimo[:i+1]
+            paresProibidos = {(c[i], c[i+1]) for c in encontrados if len(c)>i+1 and c[:i+1]==raiz}
+            desvio = caminhoMaisCurto(adjacencia, ultimo[i], destino, profundidade-i, nosProibidos=frozenset(raiz[:-1]), 
+                                      paresProibidos=paresProibidos, limiteNos=limiteNos)
+            if desvio is None:
+                continue
+            novo = tuple(raiz[:-1] + desvio)
+            if novo not in vistos:
+                vistos.add(novo)
+                heapq.heappush(candidatos, (len(novo), novo))
+        if not candidatos:
+            return
+        caminho = list(heapq.heappop(candidatos)[1])
+        encontrados.append(caminho)
+        yield caminho
+#.def kCaminhosMaisCurtos
+
+def ligacoesDoCaminho(adjacencia, caminho):
+    ''' ligações (id1, id2, descricao) entre os nós consecutivos do caminho'''
+    ligacoes = []
+    for a, b in zip(caminho, caminho[1:]):
+        ligacoes.extend(sorted(adjacencia.vizinhosDe([a])[a][b]))
+    return ligacoes
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+pool de conexões sqlite para as consultas da rede
+
+Cada conexão do pool é uma base :memory: (para as tabelas temporárias tmp_) com as bases do rede.ini já anexadas
+somente para leitura (mode=ro) e com pragmas de cache e mmap.
+As requisições pegam uma conexão com obtem() e devolvem com devolve(), sem refazer connect, attach e leitura do esquema.
+Na devolução, as tabelas temporárias são apagadas. Se uma requisição não devolver a conexão (erro no meio da rotina),
+a conexão é descartada pelo coletor de lixo e o pool cria outra quando precisar.
+A escrita na base_local (carregaJSONemBaseLocal) não usa o pool, pois precisa de conexão de escrita.
+"""
+import os, sqlite3, queue, pathlib, threading, time
+
+def uriSomenteLeitura(caminho):
+    return pathlib.Path(caminho).resolve().as_uri() + '?mode=ro'
+
+def anexaBase(con, caminho, alias, somenteLeitura=True):
+    ''' ATTACH DATABASE só se o alias ainda não estiver anexado à conexão com o mesmo arquivo'''
+    for _, nome, arquivo in con.execute('PRAGMA database_list').fetchall():
+        if nome==alias:
+            if arquivo and os.path.realpath(arquivo)==os.path.realpath(caminho):
+                return
+            con.execute(f'DETACH DATABASE {alias}')
+            break
+    camDB = uriSomenteLeitura(caminho) if somenteLeitura else pathlib.Path(caminho).resolve().as_uri()
+    con.execute("ATTACH DATABASE '" + camDB.replace("'", "''") + "' as " + alias)
+#.def anexaBase
+
+def definePrazo(con, prazo, passos=10000):
+    ''' prazo em time.time(). Depois do prazo, a consulta em execução é abortada com sqlite3.OperationalError: interrupted.
+        O handler é chamado a cada "passos" instruções da máquina virtual do sqlite'''
+    con.set_progress_handler(lambda: time.time()>prazo, passos)
+
+def removePrazo(con):
+    con.set_progress_handler(None, 0)
+
+def consultaInterrompida(err):
+    return isinstance(err, sqlite3.OperationalError) and 'interrupted' in str(err)
+
+class PoolConexoes():
+    def __init__(self, bases, tamanho=8, mmapMB=256, cacheMB=32):
+        ''' bases: dicionário alias->caminho das bases a anexar.
+            tamanho: quantidade máxima de conexões guardadas. Se todas estiverem em uso, cria conexões novas'''
+        self.bases = {alias:caminho for alias,caminho in bases.items() if caminho}
+        self.tamanho = tamanho
+        self.mmapMB = mmapMB
+        self.cacheMB = cacheMB
+        self.fila = queue.LifoQueue() #LIFO reaproveita a conexão com cache mais recente
+        self.lock = threading.Lock()
+        self.criadas = 0
+
+    def _nova(self):
+        con = sqlite3.connect(':memory:', uri=True, check_same_thread=False) #check_same_thread=False porque a conexão passa de uma thread para outra entre requisições, mas é usada por uma de cada vez
+        con.execute('PRAGMA temp_store=MEMORY')
+        for alias, caminho in self.bases.items():
+            anexaBase(con, caminho, alias)
+            con.execute(f'PRAGMA {alias}.mmap_size={self.mmapMB*2**20}')
+            con.execute(f'PRAGMA {alias}.cache_size={-self.cacheMB*1024}') #negativo é em KB
+        with self.lock:
+            self.criadas += 1
+        return con
+
+    def obtem(self):
+        try:
+            return self.fila.get_nowait()
+        except queue.Empty:
+            return self._nova()
+
+    def devolve(self, con):
+        ''' limpa a conexão e devolve ao pool. Se não for possível limpar, fecha a conexão'''
+        if con is None:
+            return
+        try:
+            con.row_factory = None
+            removePrazo(con)
+            con.rollback()
+            tabelas = [r[0] for r in con.execute("select name from main.sqlite_master where type='table'")]
+            anexadas = [r[1] for r in con.execute('PRAGMA database_list') if r[1] not in ('main','temp') and r[1] not in self.bases]
+            con.executescript(''.join(f'DROP TABLE IF EXISTS main."{t}";' for t in tabelas if not t.startswith('sqlite_')))
+            for alias in anexadas:
+                con.execute(f'DETACH DATABASE {alias}')
+        except sqlite3.Error as err:
+            print('erro ao devolver conexão ao pool:', err)
+            con.close()
+            return
+        if self.fila.qsize()<self.tamanho:
+            self.fila.put(con)
+        else:
+            con.close()
+#.class PoolConexoes
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+motor de grafo em memória para camadasRede
+
+A tabela rede.ligacao é carregada uma única vez em arrays no formato CSR (compressed sparse row):
+offsets + vizinhos + código do tipo de ligação, nos dois sentidos (id1->id2 e id2->id1).
+A expansão por camadas é feita em memória, sem tabelas temporárias no sqlite.
+Ativado no rede.ini por motor_grafo=csr. Se o numpy não estiver instalado, camadasRede usa o sqlite.
+Com motor_grafo=mmap, os mesmos arrays são lidos do arquivo gerado por rede_cria_tabela_grafo.py (base_grafo no rede.ini), 
+mapeado na memória com numpy.memmap. Não há carga inicial e os processos compartilham o cache do sistema operacional.
+"""
+import time, threading, sqlite3, json
+import pandas as pd
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def disponivel():
+    return np is not None
+
+class GrafoCSR():
+    ''' grafo de ligações em arrays numpy.
+        os nós são inteiros 0..n-1, na ordem alfabética do identificador (PF_xxx, PJ_xxx...)'''
+    def __init__(self, identificadores, origem, destino, tipos, descricoes):
+        self.identificadores = identificadores #pd.Index ordenado, posição = número do nó
+        self.descricoes = list(descricoes) #descrição do tipo de ligação, posição = código
+        n = len(identificadores)
+        dtipo = np.uint8 if len(self.descricoes)<256 else np.uint16
+        self.codigoFilial = self.descricoes.index('filial') if 'filial' in self.descricoes else -1
+        self.offsetsSaida, self.vizinhosSaida, self.tiposSaida = self._csr(origem, destino, tipos.astype(dtipo), n)
+        self.offsetsEntrada, self.vizinhosEntrada, self.tiposEntrada = self._csr(destino, origem, tipos.astype(dtipo), n)
+
+    @staticmethod
+    def _csr(origem, destino, tipos, n):
+        ordem = np.argsort(origem, kind='stable')
+        offsets = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(origem, minlength=n), out=offsets[1:])
+        return offsets, destino[ordem].astype(np.int32 if n<2**31 else np.int64), tipos[ordem]
+
+    @classmethod
+    def carregaSQLite(cls, caminhoDB):
+        print(time.asctime(), f'carregando grafo de {caminhoDB} na memória')
+        con = sqlite3.connect(f'file:{caminhoDB}?mode=ro', uri=True)
+        tabelas = {r[0] for r in con.execute("select name from sqlite_master")}
+        if 'ligacao_int' in tabelas: #base com identificadores em inteiros, não precisa fatorar os textos
+            dnos = pd.read_sql('select id, ident from node order by id', con)
+            dtipos = pd.read_sql('select codigo, descricao from tipo_ligacao order by codigo', con)
+            df = pd.read_sql('select src, dst, tipo from ligacao_int', con)
+            con.close()
+            idsNos = dnos['id'].values
+            m = len(df)
+            nos = np.searchsorted(idsNos, np.concatenate([df['src'].values, df['dst'].values]))
+            tipos = np.searchsorted(dtipos['codigo'].values, df['tipo'].values)
+            identificadores, descricoes = dnos['ident'].values, dtipos['descricao'].tolist()
+        else:
+            df = pd.read_sql('select id1, id2, descricao from ligacao', con)
+            con.close()
+            nos, identificadores = pd.factorize(pd.concat([df['id1'], df['id2']], ignore_index=True), sort=True)
+            tipos, descricoes = pd.factorize(df['descricao'].fillna(''))
+            m = len(df)
+        df = None
+        grafo = cls(pd.Index(identificadores), nos[:m], nos[m:], tipos, descricoes)
+        print(time.asctime(), f'grafo carregado: {len(identificadores)} nós, {m} ligações')
+        return grafo
+
+    def numeroNos(self):
+        return len(self.offsetsSaida)-1
+
+    def indices(self, listaIds):
+        ''' retorna array com os números dos nós que estão no grafo '''
+        if not listaIds:
+            return np.zeros(0, dtype=np.int64)
+        ind = self.identificadores.get_indexer(list(listaIds))
+        return np.unique(ind[ind>=0])
+
+    def identificador(self, nos):
+        return self.identificadores[nos]
+
+    def posicoes(self, listaIds):
+        ''' número do nó de cada identificador, na mesma ordem, -1 se não estiver no grafo'''
+        return self.identificadores.get_indexer(list(listaIds))
+
+    @staticmethod
+    def _junta(offsets, vizinhos, tipos, nos):
+        ''' vizinhos de todos os nós de uma vez, sem loop em python '''
+        inicio = offsets[nos]
+        quantidade = offsets[nos+1] - inicio
+        total = int(quantidade.sum())
+        if not total:
+            return np.zeros(0, dtype=nos.dtype), vizinhos[:0], tipos[:0]
+        deslocamento = np.repeat(inicio - (np.cumsum(quantidade) - quantidade), quantidade)
+        posicoes = np.arange(total) + deslocamento
+        return np.repeat(nos, quantidade), vizinhos[posicoes], tipos[posicoes]
+
+    def codigosTipos(self, permitidos):
+        ''' códigos do grafo (posição em descricoes) dos tipos de ligação com descrição em permitidos'''
+        return np.array([k for k, d in enumerate(self.descricoes) if d in permitidos], dtype=np.int64)
+
+    @staticmethod
+    def mascaraTipos(tip, codigos):
+        return np.isin(tip, codigos)
+
+    def arestasDaFronteira(self, fronteira, tipos=None):
+        ''' ligações da fronteira, no padrão do union de camadasRede:
+            todas com id1 na fronteira e as com id2 na fronteira que não são filial. tipos: códigos dos tipos a seguir (None para todos)'''
+        orig, dest, tip = self._junta(self.offsetsSaida, self.vizinhosSaida, self.tiposSaida, fronteira)
+        dest2, orig2, tip2 = self._junta(self.offsetsEntrada, self.vizinhosEntrada, self.tiposEntrada, fronteira)
+        if self.codigoFilial>=0:
+            filtro = tip2!=self.codigoFilial
+            dest2, orig2, tip2 = dest2[filtro], orig2[filtro], tip2[filtro]
+        if tipos is not None:
+            filtro = np.isin(tip, tipos)
+            orig, dest, tip = orig[filtro], dest[filtro], tip[filtro]
+            filtro = np.isin(tip2, tipos)
+            dest2, orig2, tip2 = dest2[filtro], orig2[filtro], tip2[filtro]
+        return (np.concatenate([orig, orig2]).astype(np.int64),
+                np.concatenate([dest, dest2]).astype(np.int64),
+                np.concatenate([tip, tip2]).astype(np.int64))
+
+    def graus(self, nos):
+        ''' quantidade de ligações de cada nó, nos dois sentidos (mesmo valor de rede.grau.total)'''
+        return (self.offsetsSaida[nos+1] - self.offsetsSaida[nos]) + (self.offsetsEntrada[nos+1] - self.offsetsEntrada[nos])
+
+    def custoCamadas(self, listaIds, grauMaximo=0, bSegunda=True):
+        ''' ligações lidas na expansão da camada 1 (grau dos itens de entrada) e, se bSegunda, da camada 2 
+            (grau dos vizinhos, sem os que passam de grauMaximo). Retorna quantidade de itens no grafo e lista de custos'''
+        sementes = self.indices(listaIds)
+        custos = [int(self.graus(sementes).sum())]
+        if bSegunda:
+            orig, dest, _ = self.arestasDaFronteira(sementes)
+            graus = self.graus(np.setdiff1d(np.concatenate([orig, dest]), sementes))
+            custos.append(int(graus[graus<=grauMaximo].sum() if grauMaximo else graus.sum()))
+        return len(sementes), custos
+
+    def expansao(self, listaIds, grauMaximo=0, tipos=None):
+        return ExpansaoCSR(self, listaIds, grauMaximo, tipos)
+#.class GrafoCSR
+
+class ExpansaoCSR():
+    ''' expansão por camadas a partir de listaIds. Cada chamada a proximaCamada expande só a fronteira (nós novos da camada anterior).
+        Mantém o mesmo critério de contagem de registros do loop em sqlite (itens de entrada + nós alcançados)'''
+    def __init__(self, grafo, listaIds, grauMaximo=0, tipos=None):
+        self.grafo = grafo
+        self.tipos = tipos #códigos dos tipos de ligação a seguir, None para todos
+        self.grauMaximo = grauMaximo #nós alcançados com mais ligações que isso não são expandidos
+        self.truncados = {} #nó -> grau
+        self.idsIniciais = set(listaIds)
+        self.visitados = grafo.indices(self.idsIniciais)
+        self.fronteira = self.visitados
+        self.qtdeForaDoGrafo = len(self.idsIniciais) - len(self.visitados)
+        self.arestas = []
+        self.tamanhoFronteiras = []
+
+    def proximaCamada(self):
+        if self.grauMaximo and self.tamanhoFronteiras: #os itens de entrada (primeira camada) sempre são expandidos
+            graus = self.grafo.graus(self.fronteira)
+            hubs = graus>self.grauMaximo
+            if hubs.any():
+                self.truncados.update(zip(self.fronteira[hubs].tolist(), graus[hubs].tolist()))
+                self.fronteira = self.fronteira[~hubs]
+        orig, dest, tip = self.grafo.arestasDaFronteira(self.fronteira, self.tipos)
+        self.arestas.append((orig, dest, tip))
+        self.fronteira = np.setdiff1d(np.concatenate([orig, dest]), self.visitados)
+        self.visitados = np.union1d(self.visitados, self.fronteira)
+        self.tamanhoFronteiras.append(len(self.fronteira))
+        return self.qtdeForaDoGrafo + len(self.visitados)
+
+    def ligacoes(self):
+        ''' lista de (id1, id2, descricao), sem repetição '''
+        if not self.arestas:
+            return []
+        trios = np.unique(np.stack([np.concatenate(a) for a in zip(*self.arestas)], axis=1), axis=0)
+        ids1 = self.grafo.identificador(trios[:,0])
+        ids2 = self.grafo.identificador(trios[:,1])
+        descricoes = self.grafo.descricoes
+        return [(i1, i2, descricoes[t]) for i1, i2, t in zip(ids1, ids2, trios[:,2])]
+
+    def identificadores(self):
+        ''' itens de entrada mais os nós alcançados'''
+        return self.idsIniciais.union(self.grafo.identificador(self.visitados))
+
+    def identificadoresTruncados(self):
+        nos = np.array(list(self.truncados), dtype=np.int64)
+        return dict(zip(self.grafo.identificador(nos), (int(self.truncados[n]) for n in nos)))
+#.class ExpansaoCSR
+
+class GrafoMmap(GrafoCSR):
+    ''' mesmo grafo, lido do arquivo binário gerado por rede_cria_tabela_grafo.py. 
+        Os identificadores ficam no arquivo, em ordem crescente, e são localizados por busca binária'''
+    kAssinatura = b'REDEGRF1'
+    kTamanhoCabecalho = 4096
+
+    def __init__(self, caminho):
+        with open(caminho, 'rb') as arq:
+            cabecalho = arq.read(self.kTamanhoCabecalho)
+        if not cabecalho.startswith(self.kAssinatura):
+            raise ValueError(f'O arquivo {caminho} não é um grafo gerado por rede_cria_tabela_grafo.py')
+        meta = json.loads(cabecalho[len(self.kAssinatura):].rstrip(b'\0').decode('utf8'))
+        bruto = np.memmap(caminho, dtype=np.uint8, mode='r')
+        secao = {}
+        for nome, s in meta['secoes'].items():
+            dtipo = np.dtype(s['dtype'])
+            secao[nome] = bruto[s['offset']:s['offset'] + s['tamanho']*dtipo.itemsize].view(dtipo)
+        self.descricoes = meta['descricoes']
+        self.codigoFilial = self.descricoes.index('filial') if 'filial' in self.descricoes else -1
+        self.nosOffsets, self.nosTexto = secao['nos_offsets'], secao['nos_texto']
+        self.offsetsSaida, self.vizinhosSaida, self.tiposSaida = secao['saida_offsets'], secao['saida_vizinhos'], secao['saida_tipos']
+        self.offsetsEntrada, self.vizinhosEntrada, self.tiposEntrada = secao['entrada_offsets'], secao['entrada_vizinhos'], secao['entrada_tipos']
+        print(time.asctime(), f'grafo {caminho} mapeado: {meta["nos"]} nós, {meta["ligacoes"]} ligações')
+
+    def _texto(self, no):
+        return self.nosTexto[self.nosOffsets[no]:self.nosOffsets[no+1]].tobytes()
+
+    def _posicao(self, ident):
+        ''' busca binária do identificador, retorna -1 se não estiver no grafo'''
+        alvo = ident.encode('utf8')
+        inicio, fim = 0, self.numeroNos()
+        while inicio<fim:
+            meio = (inicio+fim)//2
+            if self._texto(meio)<alvo:
+                inicio = meio+1
+            else:
+                fim = meio
+        return inicio if inicio<self.numeroNos() and self._texto(inicio)==alvo else -1
+
+    def indices(self, listaIds):
+        ind = self.posicoes(listaIds)
+        return np.unique(ind[ind>=0])
+
+    def identificador(self, nos):
+        return [self._texto(no).decode('utf8') for no in nos]
+
+    def posicoes(self, listaIds):
+        return np.array([self._posicao(i) for i in listaIds], dtype=np.int64)
+#.class GrafoMmap
+
+gGrafo = {}
+gLockCarga = threading.Lock()
+
+def grafoCSR(caminhoDB):
+    ''' carrega o grafo só na primeira chamada. As consultas seguintes compartilham os arrays (somente leitura)'''
+    if caminhoDB not in gGrafo:
+        with gLockCarga:
+            if caminhoDB not in gGrafo:
+                gGrafo[caminhoDB] = GrafoCSR.carregaSQLite(caminhoDB)
+    return gGrafo[caminhoDB]
+
+def grafoMmap(caminho):
+    ''' abre o arquivo só na primeira chamada. Abrir é instantâneo, as páginas são lidas do disco conforme as consultas'''
+    if caminho not in gGrafo:
+        with gLockCarga:
+            if caminho not in gGrafo:
+                gGrafo[caminho] = GrafoMmap(caminho)
+    return gGrafo[caminho]
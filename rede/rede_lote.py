@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+processamento em lote de camadasRede, sem o servidor flask
+
+Lê um arquivo de sementes (cnpj, cpf, PJ_..., PF_..., um item por linha ou na primeira coluna do csv),
+calcula a rede de cada semente com camadasRede em vários processos e grava o resultado em partes:
+    saida/parte_00000.db (sqlite, padrão) ou saida/{semente,no,ligacao}/parte_00000.parquet (se o pyarrow estiver instalado)
+Cada parte tem as tabelas semente (situação de cada item), no e ligacao, com a coluna semente para separar as redes.
+Uma parte só é gravada quando está completa (arquivo .tmp renomeado no fim). Se o processo for interrompido,
+rodar o mesmo comando continua das partes que faltam. Os parâmetros do lote ficam em saida/lote.json.
+Rodar na pasta do rede.py, por exemplo:
+    python rede_lote.py sementes.csv saida_lote -c 2 -w 8
+"""
+import sys, os, time, json, argparse, hashlib, io, contextlib, sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+kArquivoParametros = 'lote.json'
+kTabelasSaida = ('semente', 'no', 'ligacao')
+kColunasNo = ('id', 'descricao', 'camada') #os demais campos do nó vão em json na coluna atributos
+kColunasLigacao = ('origem', 'destino', 'label', 'camada', 'cor', 'tipoDescricao')
+
+def runParser():
+    parser = argparse.ArgumentParser(description='rede de relacionamentos de cada item de um arquivo, em lote')
+    parser.add_argument('arquivo', help='arquivo com as sementes (txt ou csv, uma por linha)')
+    parser.add_argument('saida', help='pasta de saída')
+    parser.add_argument('-c', '--camada', action='store', dest='camada', type=int, default=1, help='camada')
+    parser.add_argument('-w', '--processos', action='store', dest='processos', type=int, default=os.cpu_count(), help='quantidade de processos')
+    parser.add_argument('-b', '--bloco', action='store', dest='tamanhoBloco', type=int, default=500, help='sementes por parte')
+    parser.add_argument('-f', '--formato', action='store', dest='formato', default='sqlite', choices=['sqlite', 'parquet'], help='formato da saída')
+    parser.add_argument('-s', '--separador', action='store', dest='separador', default=',', help='separador do csv')
+    parser.add_argument('-e', '--encoding', action='store', dest='encodingArquivo', default='utf8', help='codificação do arquivo')
+    parser.add_argument('-k', '--conf_file', action='store', default='rede.ini', help='arquivo de configuração', metavar='FILE')
+    parser.add_argument('-v', '--verbose', action='store_true', dest='bVerbose', default=False, help='exibe as mensagens de camadasRede')
+    return parser.parse_args()
+
+def leSementes(arquivo, separador, encoding):
+    ''' primeira coluna do arquivo, sem repetição e na ordem do arquivo. A ordem define as partes, para poder continuar o lote'''
+    df = pd.read_csv(arquivo, sep=separador, dtype=str, header=None, usecols=[0], keep_default_na=False, encoding=encoding, skip_blank_lines=True)
+    return list(dict.fromkeys(s.strip() for s in df[0] if s.strip()))
+
+def assinaturaLote(arquivo, camada, tamanhoBloco, formato):
+    with open(arquivo, 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    return {'arquivo':os.path.abspath(arquivo), 'md5':md5, 'camada':camada, 'bloco':tamanhoBloco, 'formato':formato}
+
+def nomeParte(saida, k, formato, tabela=''):
+    if formato=='parquet':
+        return os.path.join(saida, tabela, f'parte_{k:05d}.parquet')
+    return os.path.join(saida, f'parte_{k:05d}.db')
+
+def parteCompleta(saida, k, formato):
+    if formato=='parquet': #semente é a última tabela gravada
+        return os.path.exists(nomeParte(saida, k, formato, 'semente'))
+    return os.path.exists(nomeParte(saida, k, formato))
+
+rede_relacionamentos = None
+gVerbose = False
+def inicializaProcesso(confFile, bVerbose):
+    ''' rede_config lê sys.argv na importação, então os parâmetros do lote são trocados antes de importar'''
+    global rede_relacionamentos, gVerbose
+    sys.argv = [sys.argv[0], '-k', confFile]
+    import rede_sqlite_cnpj
+    rede_relacionamentos = rede_sqlite_cnpj
+    rede_relacionamentos.gCache.limiteBytes = 0 #cada semente é consultada uma vez, o cache só ocuparia memória
+    gVerbose = bVerbose
+
+def redeDaSemente(semente, camada):
+    cids = rede_relacionamentos.idsLocalizados(rede_relacionamentos.separaEntrada([semente])[0])
+    if not cids:
+        return 'nao_localizado', {'no':[], 'ligacao':[], 'mensagem':''}
+    resultado = rede_relacionamentos.camadasRede(listaIds=sorted(cids), camada=camada)
+    return ('incompleto' if resultado.get('incompleto') else 'ok'), resultado
+
+def processaParte(k, sementes, camada, saida, formato):
+    ''' roda num processo do pool. Retorna a contagem da parte para o relatório'''
+    inicio = time.time()
+    lsementes, lnos, lligacoes = [], [], []
+    for semente in sementes:
+        t = time.time()
+        try:
+            if gVerbose:
+                situacao, resultado = redeDaSemente(semente, camada)
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    situacao, resultado = redeDaSemente(semente, camada)
+            mensagem = resultado.get('mensagem', '')
+        except Exception as err:
+            situacao, resultado, mensagem = 'erro', {'no':[], 'ligacao':[]}, str(err)
+        for no in resultado['no']:
+            lnos.append([semente] + [no.get(c) for c in kColunasNo] + [json.dumps({c:v for c,v in no.items() if c not in kColunasNo}, ensure_ascii=False)])
+        for lig in resultado['ligacao']:
+            lligacoes.append([semente] + [lig.get(c) for c in kColunasLigacao])
+        lsementes.append([semente, situacao, len(resultado['no']), len(resultado['ligacao']), mensagem, round(time.time()-t, 4)])
+    dfs = {'semente':pd.DataFrame(lsementes, columns=['semente', 'situacao', 'qtde_nos', 'qtde_ligacoes', 'mensagem', 'segundos']),
+           'no':pd.DataFrame(lnos, columns=('semente',) + kColunasNo + ('atributos',)),
+           'ligacao':pd.DataFrame(lligacoes, columns=('semente',) + kColunasLigacao)}
+    if formato=='parquet':
+        for tabela in ('no', 'ligacao', 'semente'): #semente por último, marca a parte como completa
+            caminho = nomeParte(saida, k, formato, tabela)
+            dfs[tabela].to_parquet(caminho + '.tmp', index=False)
+            os.replace(caminho + '.tmp', caminho)
+    else:
+        caminho = nomeParte(saida, k, formato)
+        if os.path.exists(caminho + '.tmp'):
+            os.remove(caminho + '.tmp')
+        con = sqlite3.connect(caminho + '.tmp')
+        for tabela in kTabelasSaida:
+            dfs[tabela].to_sql(tabela, con, index=False)
+        con.execute('CREATE INDEX idx_no_semente ON no (semente)')
+        con.execute('CREATE INDEX idx_ligacao_semente ON ligacao (semente)')
+        con.commit()
+        con.close()
+        os.replace(caminho + '.tmp', caminho)
+    contagem = dfs['semente']['situacao'].value_counts().to_dict()
+    return {'parte':k, 'sementes':len(sementes), 'nos':len(lnos), 'ligacoes':len(lligacoes), 'situacao':contagem, 'segundos':time.time()-inicio}
+#.def processaParte
+
+def main():
+    par = runParser()
+    if not os.path.exists(par.arquivo):
+        print('O arquivo ' + par.arquivo + ' não existe. Parando...')
+        sys.exit(1)
+    if par.formato=='parquet' and pyarrow is None:
+        print('O formato parquet precisa do pyarrow (pip install pyarrow). Use -f sqlite ou instale o pacote.')
+        sys.exit(1)
+    os.makedirs(par.saida, exist_ok=True)
+    if par.formato=='parquet':
+        for tabela in kTabelasSaida:
+            os.makedirs(os.path.join(par.saida, tabela), exist_ok=True)
+    parametros = assinaturaLote(par.arquivo, par.camada, par.tamanhoBloco, par.formato)
+    camParametros = os.path.join(par.saida, kArquivoParametros)
+    if os.path.exists(camParametros):
+        anteriores = json.load(open(camParametros, encoding='utf8'))
+        if anteriores!=parametros:
+            print(f'A pasta {par.saida} tem um lote com outros parâmetros ou outro arquivo de sementes: {anteriores}. Use outra pasta.')
+            sys.exit(1)
+    else:
+        json.dump(parametros, open(camParametros, 'w', encoding='utf8'), ensure_ascii=False, indent=1)
+
+    sementes = leSementes(par.arquivo, par.separador, par.encodingArquivo)
+    partes = [(k, sementes[i:i+par.tamanhoBloco]) for k, i in enumerate(range(0, len(sementes), par.tamanhoBloco))]
+    pendentes = [(k, s) for k, s in partes if not parteCompleta(par.saida, k, par.formato)]
+    totalPendente = sum(len(s) for _, s in pendentes)
+    print(time.asctime(), f'{len(sementes)} sementes em {len(partes)} partes. Já processadas: {len(partes)-len(pendentes)} partes. Faltam {totalPendente} sementes.')
+    if not pendentes:
+        return
+
+    inicio = time.time()
+    relatorio = {'sementes':0, 'nos':0, 'ligacoes':0, 'situacao':{}}
+    with ProcessPoolExecutor(max_workers=par.processos, initializer=inicializaProcesso, initargs=(par.conf_file, par.bVerbose)) as executor:
+        futuros = [executor.submit(processaParte, k, s, par.camada, par.saida, par.formato) for k, s in pendentes]
+        for futuro in as_completed(futuros):
+            r = futuro.result()
+            for c in ('sementes', 'nos', 'ligacoes'):
+                relatorio[c] += r[c]
+            for situacao, qtde in r['situacao'].items():
+                relatorio['situacao'][situacao] = relatorio['situacao'].get(situacao, 0) + qtde
+            decorrido = time.time()-inicio
+            taxa = relatorio['sementes']/decorrido if decorrido else 0
+            restante = (totalPendente-relatorio['sementes'])/taxa if taxa else 0
+            print(time.asctime(), f"parte {r['parte']}: {relatorio['sementes']}/{totalPendente} sementes, {taxa:.1f} sementes/s, faltam {restante/60:.1f} min", flush=True)
+    decorrido = time.time()-inicio
+    relatorio.update({'segundos':round(decorrido, 2), 'processos':par.processos,
+                      'sementes_por_segundo':round(relatorio['sementes']/decorrido, 2) if decorrido else 0,
+                      'ligacoes_por_segundo':round(relatorio['ligacoes']/decorrido, 2) if decorrido else 0})
+    json.dump(relatorio, open(os.path.join(par.saida, f'relatorio_{time.strftime("%Y%m%d_%H%M%S")}.json'), 'w', encoding='utf8'), ensure_ascii=False, indent=1)
+    print(time.asctime(), 'Fim. Relatório:', json.dumps(relatorio, ensure_ascii=False))
+#.def main
+
+if __name__ == '__main__':
+    main()
@@ -9,14 +9,18 @@ Não fazer Create table ou criar índice para uma tabela a ser criada ou modific
 2022-07-20 - Parâmetro WAL no sqlite para consultas concorrentes. (não funcionou, base trava)
 2022-11 - usando sqlite3 para fazer attach. fazendo consulta in memory.
 """
-import sys, os, time, copy, re, string, unicodedata, collections, json, secrets, io
+import sys, os, time, copy, re, string, unicodedata, collections, json, secrets, io, itertools, threading, datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from functools import lru_cache
+from functools import lru_cache, wraps
+import inspect
 import pandas as pd, sqlalchemy, sqlite3
+import orjson
 #from fnmatch import fnmatch 
 import util_cpf_cnpj as cpf_cnpj
 
 import rede_config as config
+import rede_grafo, rede_conexoes, rede_cache, rede_caminhos, rede_analise
 
 caminhoDBReceita = config.config['BASE']['base_receita'].strip()
 caminhoDBRede = config.config['BASE']['base_rede'].strip()
@@ -24,6 +28,7 @@ caminhoDBRedeSearch = config.config['BASE'].get('base_rede_search', caminhoDBRed
 caminhoDBEnderecoNormalizado = config.config['BASE'].get('base_endereco_normalizado', '').strip()
 caminhoDBLinks = config.config['BASE'].get('base_links', '').strip()
 caminhoDBBaseLocal =  config.config['BASE'].get('base_local', '').strip()
+caminhoGrafo = config.config['BASE'].get('base_grafo', '').strip() #arquivo gerado por rede_cria_tabela_grafo.py, para motor_grafo=mmap
 
 if not caminhoDBReceita: #se não houver db da receita, carrega um template para evitar erros nas consultas
     caminhoDBReceita = 'base_cnpj_vazia.db'
@@ -44,6 +49,35 @@ for cam in [caminhoDBReceita, caminhoDBRede, caminhoDBRedeSearch, caminhoDBEnder
 ligacaoSocioFilial = config.config['ETC'].getboolean('ligacao_socio_filial',False) #registra cnpjs consultados
 kLimiteCamada = config.config['ETC'].getint('limite_registros_camada', 1000)
 kTempoMaxConsulta = config.config['ETC'].getfloat('tempo_maximo_consulta', 10) #em segundos
+kTempoLimiteConsulta = config.config['ETC'].getfloat('tempo_limite_consulta', 30) #em segundos, interrompe a consulta sqlite em andamento (0 desativa)
+kMotorGrafo = config.config['ETC'].get('motor_grafo', 'sqlite').strip().lower() #sqlite, csr (grafo em memória), mmap (arquivo mapeado, ver rede_grafo.py) ou cte (WITH RECURSIVE)
+if kMotorGrafo=='cte' and sqlite3.sqlite_version_info<(3, 34, 0): #mais de um SELECT recursivo na mesma cte
+    print(f'motor_grafo=cte precisa do sqlite 3.34 ou mais novo (versão instalada: {sqlite3.sqlite_version}). Usando motor_grafo=sqlite.')
+    kMotorGrafo = 'sqlite'
+kLimiteLinhasCTE = config.config['ETC'].getint('limite_linhas_cte', 1000000)
+if kMotorGrafo in ('csr', 'mmap') and not rede_grafo.disponivel():
+    print(f'motor_grafo={kMotorGrafo} precisa do numpy instalado. Usando motor_grafo=sqlite.')
+    kMotorGrafo = 'sqlite'
+if kMotorGrafo=='mmap' and not os.path.isfile(caminhoGrafo):
+    print(f'motor_grafo=mmap precisa do arquivo base_grafo ({caminhoGrafo}) gerado por rede_cria_tabela_grafo.py. Usando motor_grafo=sqlite.')
+    kMotorGrafo = 'sqlite'
+kGrauMaximoNo = config.config['ETC'].getint('grau_maximo_no', 0) #nós com mais ligações que isso não são expandidos (exceto os itens de entrada). 0 desativa
+kOrcamentoLigacoes = config.config['ETC'].getint('orcamento_ligacoes_consulta', 0) #estimativa máxima de ligações lidas numa consulta de camadas. 0 desativa
+kAdmissaoConsulta = config.config['ETC'].get('admissao_consulta', 'rebaixar').strip().lower() #rebaixar (reduz a camada) ou rejeitar
+kAmostraIntermediacao = config.config['ETC'].getint('amostra_intermediacao', 32)
+kLimiteItensAnalise = config.config['ETC'].getint('limite_itens_analise', 20000)
+kItensAgrupamento = config.config['ETC'].getint('itens_agrupamento', 500)
+kMotorCaminhos = config.config['ETC'].get('motor_caminhos', 'sqlite').strip().lower() #sqlite (camadasRede_caminhos, expande todas as camadas antes) ou bfs (rede_caminhos.py)
+
+#conexões :memory: com as bases já anexadas somente para leitura, ver rede_conexoes.py
+gPool = rede_conexoes.PoolConexoes({'rede':caminhoDBRede, 'search':caminhoDBRedeSearch, 'cnpj':caminhoDBReceita, 
+                                    'endereco':caminhoDBEnderecoNormalizado, 'dlink':caminhoDBLinks, 'dlocal':caminhoDBBaseLocal},
+                                   tamanho=config.config['ETC'].getint('pool_conexoes', 8),
+                                   mmapMB=config.config['ETC'].getint('sqlite_mmap_mb', 256),
+                                   cacheMB=config.config['ETC'].getint('sqlite_cache_mb', 32))
+
+#cache dos resultados de camadasRede e camadaLink, ver rede_cache.py. cache_mb=0 desativa
+gCache = rede_cache.CacheResultados(config.config['ETC'].getint('cache_mb', 64)*2**20)
 
 class DicionariosCodigosCNPJ():
     def __init__(self):
@@ -86,6 +120,51 @@ def timeit(method):
         return result    
     return timed
 
+def normalizaEntradaCache(nome, valor):
+    ''' itens de entrada sem repetição e em ordem, para consultas iguais terem a mesma chave'''
+    if nome=='listaIds' and valor:
+        return tuple(sorted(set(valor)))
+    if nome in ('tipos', 'excluirTipos') and valor:
+        return tuple(sorted(set(valor)))
+    if nome=='grupo' and valor:
+        if type(valor)==dict:
+            return tuple(sorted((str(k), tuple(sorted(set(v)))) for k,v in valor.items()))
+        if type(valor) in (list, tuple, set):
+            return tuple(tuple(sorted(set(g))) for g in valor) #a ordem dos grupos define o número do grupo
+    return valor
+
+def cacheResultado(funcao):
+    ''' decorator que guarda o resultado da função em gCache. 
+        A chave tem o nome da função, os parâmetros normalizados, a data de referência da base cnpj e a data de modificação da base_local'''
+    assinatura = inspect.signature(funcao)
+    @wraps(funcao)
+    def comCache(*args, **kw):
+        if not gCache.ativo():
+            return funcao(*args, **kw)
+        parametros = assinatura.bind(*args, **kw)
+        parametros.apply_defaults()
+        try:
+            chave = (funcao.__name__, referenciaBasesCache()) + tuple((k, normalizaEntradaCache(k, v)) for k,v in parametros.arguments.items() if not k.startswith('con'))
+            hash(chave)
+        except TypeError: #parâmetro não previsto, não usa cache
+            return funcao(*args, **kw)
+        resultado = gCache.obtem(chave)
+        if resultado is None:
+            resultado = funcao(*args, **kw)
+            if not resultado.get('incompleto'): #resultado interrompido pelo tempo limite depende da carga do servidor
+                gCache.guarda(chave, resultado)
+        return resultado
+    return comCache
+#.def cacheResultado
+
+def referenciaBasesCache():
+    try:
+        referencia = qteEmpresas_referenciaF()['data_referencia']
+    except Exception: #base cnpj sem tabela _referencia
+        referencia = ''
+    mtimeLocal = os.path.getmtime(caminhoDBBaseLocal) if caminhoDBBaseLocal and os.path.exists(caminhoDBBaseLocal) else 0
+    return (referencia, mtimeLocal)
+
 
 def buscaPorNome(nomeIn, limite=10): 
     ''' #alterado: nome tinha que ser completo, a partir da versão 0.9 não. Com Teste, pega item randomico
@@ -102,17 +181,16 @@ def buscaPorNome(nomeIn, limite=10):
     if not nomeIn:
         return set()
     limite =  min(limite,100) if limite else 10
-    if nomeIn=='#TESTE#':
-         con = sqlite3.connect(caminhoDBRede, uri=True)
-    else:
-        con = sqlite3.connect(caminhoDBRedeSearch, uri=True)
     nome = ''.join(x for x in unicodedata.normalize('NFKD', nomeIn) if x in string.printable).upper()
 
     nomeMatch = ''
     nomeGlob = ''
     if nomeIn=='#TESTE#':
         #query = '''select id_descricao as id from id_search where rowid > (abs(random()) % (select (select max(rowid) from id_search)+1)) LIMIT 1;'''
-        query = '''select id1 as id from ligacao where rowid > (abs(random()) % (select (select max(rowid) from ligacao)+1)) LIMIT 1;'''
+        if esquemaLigacao()['inteiro']: #ligacao é view, não tem rowid
+            query = '''select ident as id from rede.node where id > (abs(random()) % (select (select max(id) from rede.node)+1)) LIMIT 1;'''
+        else:
+            query = '''select id1 as id from rede.ligacao where rowid > (abs(random()) % (select (select max(rowid) from rede.ligacao)+1)) LIMIT 1;'''
         #query = '''select id_descricao as id from id_search where rowid > (abs(random()) % (select (select max(rowid) from id_search)+1)) LIMIT 1;'''
         #cursor = con.execute(query)
     elif ('*' in nomeIn) or ('?' in nomeIn):
@@ -134,7 +212,7 @@ def buscaPorNome(nomeIn, limite=10):
 
         query = '''
                     select distinct id_descricao as id
-                    FROM id_search
+                    FROM search.id_search
                     where -- id_descricao match :palavraM and
                     id_descricao match :nomeMatch
                     and id_descricao glob :nomeGlob
@@ -149,11 +227,12 @@ def buscaPorNome(nomeIn, limite=10):
         #palavraM = nomeMatch.split(' ')[0]
         query = '''
                 SELECT id_descricao as id
-                FROM id_search
+                FROM search.id_search
                 where -- id_descricao match :palavraM and
                 id_descricao match :nomeMatch
                 limit :limite 
             '''
+    con = gPool.obtem()
     con.row_factory = sqlite3.Row #para ver registros do sqlite3 como dicionário
     cur = con.cursor()
 
@@ -162,6 +241,8 @@ def buscaPorNome(nomeIn, limite=10):
         cur.execute(query, {'nomeMatch':nomeMatch, 'nomeGlob':nomeGlob, 'limite':limite}) #, 'palavraM':palavraM})
     except Exception as e:
         print("ERROR : "+str(e))
+        cur.close()
+        gPool.devolve(con)
         return set()
     cids = set()
 
@@ -173,13 +254,13 @@ def buscaPorNome(nomeIn, limite=10):
         cids.add(rid)
         # contagemRegistros += 1
     cur.close()
-    con = None
+    gPool.devolve(con)
     return cids #cjs, cps
 #.def buscaPorNome
 
 def busca_cnpj(cnpj_basico, limiteIn):
     kLimiteFiliais = 200
-    con = sqlite3.connect(caminhoDBRedeSearch, uri=True)
+    con = gPool.obtem()
     limite = min(limiteIn, kLimiteFiliais) 
     if not limite:
         limite = 10 #xxx
@@ -189,7 +270,7 @@ def busca_cnpj(cnpj_basico, limiteIn):
     cnpjMatch = 'PJ_' + cnpj_basico + '*'
     query = '''
             SELECT distinct substr(id_descricao, 1, 17) as id
-            FROM id_search
+            FROM search.id_search
             where id_descricao MATCH :cnpjMatch
             limit :limite '''
     con.row_factory=sqlite3.Row
@@ -200,7 +281,7 @@ def busca_cnpj(cnpj_basico, limiteIn):
     #spj = {'PJ_'+k[0] for k in r}
     #spj = {k[0] for k in r}
     cur.close()
-    con = None
+    gPool.devolve(con)
     return spj
 #.def busca_cnpj
     
@@ -211,12 +292,12 @@ def busca_cpf(cpfin, limiteIn):
     if not limite:
         limite = 10 #default
 
-    con = sqlite3.connect(caminhoDBRedeSearch, uri=True)
+    con = gPool.obtem()
     cpfMatch = 'PF_ ' + cpfin[3:9]
     cpfGlob = 'PF_' + '???' + cpfin[3:9] + '??*'
     query = '''
                 SELECT distinct id_descricao as id
-                FROM id_search
+                FROM search.id_search
                 where id_descricao Match :cpfMatch
                 --and id_descricao glob :cpfGlob
                 limit :limite
@@ -232,7 +313,7 @@ def busca_cpf(cpfin, limiteIn):
         #scpf.add('PF_'+c+'-'+n)
         scpf.add(c['id'])
     cur.close()
-    con = None
+    gPool.devolve(con)
     #print(scpf)
     return scpf
 #.def busca_cpf
@@ -316,6 +397,271 @@ def separaEntrada(listaIds=None):
     return cids, cnpjs, cpfnomes, outrosIdentificadores, cpfpjnomes
 #.def separaEntrada
 
+def idsLocalizados(ids):
+    ''' ids (PJ_, PF_...) que existem na base. separaEntrada transforma qualquer texto de 14 dígitos em PJ_ sem consultar a base.
+        cnpj é procurado em cnpj.estabelecimento (empresa sem ligações também tem dados), os demais em rede.node ou na tabela ligacao'''
+    e = esquemaLigacao()
+    localizados = set()
+    con = gPool.obtem()
+    try:
+        for ident in ids:
+            if ident.startswith('PJ_') and con.execute('SELECT 1 FROM cnpj.estabelecimento WHERE cnpj=?', (ident[3:],)).fetchone():
+                localizados.add(ident)
+            elif e['inteiro']:
+                if con.execute('SELECT 1 FROM rede.node WHERE ident=?', (ident,)).fetchone():
+                    localizados.add(ident)
+            elif con.execute('SELECT 1 FROM rede.ligacao WHERE id1=? UNION ALL SELECT 1 FROM rede.ligacao WHERE id2=? LIMIT 1', (ident, ident)).fetchone():
+                localizados.add(ident)
+    finally:
+        gPool.devolve(con)
+    return localizados
+#.def idsLocalizados
+
+
+@lru_cache(1)
+def esquemaLigacao():
+    ''' nomes da tabela de ligações do rede.db para montar as consultas de camadas.
+        bases geradas pela versão atual de rede_cria_tabela_rede.db.py têm os identificadores em inteiros (tabelas node, tipo_ligacao e ligacao_int),
+        bases anteriores só têm a tabela ligacao, com texto.'''
+    con = sqlite3.connect(f'file:{caminhoDBRede}?mode=ro', uri=True)
+    tabelas = {r[0] for r in con.execute("select name from sqlite_master where type in ('table', 'view')")}
+    if {'node', 'tipo_ligacao', 'ligacao_int'}.issubset(tabelas):
+        r = con.execute("select codigo from tipo_ligacao where descricao='filial'").fetchone()
+        esquema = {'inteiro':True, 'tabela':'rede.ligacao_int', 'id1':'src', 'id2':'dst', 'descricao':'tipo', 'filial':str(r[0]) if r else '-1',
+                   'descricaoTipo':dict(con.execute('select codigo, descricao from tipo_ligacao').fetchall()), #para converter o código só nas ligações retornadas
+                   'dataEntrada':'data_entrada' in {c[1] for c in con.execute('pragma table_info(ligacao_int)')}} #coluna gravada pela versão atual de rede_cria_tabela_rede.db.py
+    else:
+        esquema = {'inteiro':False, 'tabela':'rede.ligacao', 'id1':'id1', 'id2':'id2', 'descricao':'descricao', 'filial':"'filial'", 'dataEntrada':False}
+    esquema['tabelas'] = tabelas
+    con.close()
+    return esquema
+#.def esquemaLigacao
+
+@lru_cache(1)
+def tiposLigacao():
+    ''' dicionário descrição do tipo de ligação -> valores da coluna tipo na tabela de ligações (códigos em tipo_ligacao, ou a própria descrição no esquema antigo)'''
+    e = esquemaLigacao()
+    if e['inteiro']:
+        tipos = collections.defaultdict(list)
+        for codigo, descricao in e['descricaoTipo'].items():
+            tipos[descricao].append(codigo)
+        return dict(tipos)
+    con = sqlite3.connect(f'file:{caminhoDBRede}?mode=ro', uri=True)
+    tipos = {r[0]:[r[0]] for r in con.execute('select distinct descricao from ligacao') if r[0] is not None}
+    con.close()
+    return tipos
+#.def tiposLigacao
+
+def tiposPermitidos(tipos=None, excluirTipos=None):
+    ''' tipos de ligação (descrições, sem diferenciar maiúsculas) a seguir na expansão: só os de tipos, se informado, menos os de excluirTipos.
+        Retorna frozenset das descrições (None se não houver filtro) e a lista dos nomes que não existem na base'''
+    if not tipos and not excluirTipos:
+        return None, []
+    disponiveis = tiposLigacao()
+    porNome = {d.lower():d for d in disponiveis}
+    naoEncontrados = [t for t in list(tipos or []) + list(excluirTipos or []) if t.lower() not in porNome]
+    permitidos = {porNome[t.lower()] for t in tipos if t.lower() in porNome} if tipos else set(disponiveis)
+    permitidos -= {porNome[t.lower()] for t in (excluirTipos or []) if t.lower() in porNome}
+    return frozenset(permitidos), naoEncontrados
+
+def filtroTiposSQL(permitidos, coluna):
+    ''' trecho " AND coluna IN (...)" para a junção com a tabela de ligações. Com os índices (src, tipo) e (dst, tipo) do rede.db,
+        o sqlite só lê as ligações dos tipos pedidos'''
+    if permitidos is None:
+        return ''
+    codigos = tiposLigacao()
+    if esquemaLigacao()['inteiro']:
+        valores = ','.join(str(c) for d in sorted(permitidos) for c in codigos[d])
+    else:
+        valores = ','.join("'" + d.replace("'", "''") + "'" for d in sorted(permitidos))
+    return f' AND {coluna} IN ({valores or "NULL"})'
+#.def filtroTiposSQL
+
+def diaDaData(texto):
+    ''' data AAAA-MM-DD, AAAAMMDD ou DD/MM/AAAA para o número do dia desde 1970-01-01, como a coluna data_entrada de ligacao_int.
+        None se texto vazio. ValueError se a data não for válida'''
+    texto = str(texto or '').strip()
+    if not texto:
+        return None
+    for formato in ('%Y-%m-%d', '%Y%m%d', '%d/%m/%Y'):
+        try:
+            return (datetime.datetime.strptime(texto, formato).date() - datetime.date(1970, 1, 1)).days
+        except ValueError:
+            pass
+    raise ValueError(f'data inválida: {texto}')
+
+def periodoDatas(dataDesde=None, dataAte=None):
+    ''' parâmetros data_desde e data_ate para o período (dia inicial, dia final) dos filtros de data. Só data_ate: a rede como estava na data.
+        None se nenhuma data. ValueError se alguma data não for válida'''
+    periodo = (diaDaData(dataDesde), diaDaData(dataAte))
+    return periodo if periodo!=(None, None) else None
+
+def filtroDataSQL(periodo, coluna):
+    ''' trecho " AND ..." para a junção com ligacao_int: só ligações com data de entrada no período. 
+        Ligações sem data (filial, data em branco na base) não são filtradas. A coluna está na tabela e no índice por dst'''
+    if not periodo:
+        return ''
+    condicoes = []
+    if periodo[0] is not None:
+        condicoes.append(f'{coluna}>={int(periodo[0])}')
+    if periodo[1] is not None:
+        condicoes.append(f'{coluna}<={int(periodo[1])}')
+    return f" AND ({coluna} IS NULL OR {' AND '.join(condicoes)})"
+#.def filtroDataSQL
+
+@lru_cache(1)
+def indiceComponentes():
+    ''' True se o rede.db tem a tabela componente (rede_cria_tabela_componente.py). 
+        Se houver base de endereços, a tabela só vale se foi gerada com as ligações de cnpj_links_ete.db'''
+    if 'componente' not in esquemaLigacao()['tabelas']:
+        return False
+    if not caminhoDBEnderecoNormalizado:
+        return True
+    con = sqlite3.connect(f'file:{caminhoDBRede}?mode=ro', uri=True)
+    r = con.execute("select valor from componente_info where chave='links_ete'").fetchone()
+    con.close()
+    return bool(r) and r[0]=='1'
+
+gComponentesBaseLocal = {} #data de modificação da base_local -> componentes unidos pelas ligações da base local
+
+def componentesDosIds(con, listaIds, bBaseLocal=True):
+    ''' componente conexo de cada identificador: dicionário identificador -> (chave do componente, tamanho).
+        Itens fora das tabelas de componente são um componente só com eles (chave = o próprio identificador, tamanho 1).
+        As ligações da base local, que muda a qualquer momento, juntam componentes na hora (o tamanho continua o do rede.db)'''
+    listaIds = list(set(listaIds))
+    resultado = {i:(i, 1) for i in listaIds}
+    for k in range(0, len(listaIds), 900):
+        parte = listaIds[k:k+900]
+        marcadores = ','.join('?'*len(parte))
+        for ident, componente, tamanho in con.execute(f'''
+                SELECT n.ident, c.componente, c.tamanho FROM rede.node n INNER JOIN rede.componente c ON c.id=n.id WHERE n.ident IN ({marcadores})
+                UNION ALL
+                SELECT ident, componente, tamanho FROM rede.componente_extra WHERE ident IN ({marcadores})''', parte + parte):
+            resultado[ident] = (f'C{componente}', tamanho)
+    if bBaseLocal and caminhoDBBaseLocal:
+        uniao = uniaoBaseLocal(con)
+        resultado = {i:(uniao.get(c, c), t) for i, (c, t) in resultado.items()}
+    return resultado
+#.def componentesDosIds
+
+def uniaoBaseLocal(con):
+    ''' chave do componente -> chave do componente unido pelas ligações da base local, refeito quando a base local muda'''
+    mtime = os.path.getmtime(caminhoDBBaseLocal) if os.path.exists(caminhoDBBaseLocal) else 0
+    if mtime in gComponentesBaseLocal:
+        return gComponentesBaseLocal[mtime]
+    rede_conexoes.anexaBase(con, caminhoDBBaseLocal, 'dlocal')
+    ligacoes = con.execute('SELECT id1, id2 FROM dlocal.links').fetchall()
+    componentes = componentesDosIds(con, [i for par in ligacoes for i in par], bBaseLocal=False)
+    pai = {}
+    def raiz(c):
+        while pai.get(c, c)!=c:
+            c = pai[c]
+        return c
+    for id1, id2 in ligacoes:
+        r1, r2 = raiz(componentes[id1][0]), raiz(componentes[id2][0])
+        if r1!=r2:
+            pai[max(r1, r2)] = min(r1, r2)
+    uniao = {c:raiz(c) for c in pai}
+    gComponentesBaseLocal.clear()
+    gComponentesBaseLocal[mtime] = uniao
+    return uniao
+#.def uniaoBaseLocal
+
+def conectados(listaIds):
+    ''' para /rede/api/conectados: componente de cada item e se estão todos ligados entre si'''
+    if not indiceComponentes():
+        if 'componente' in esquemaLigacao()['tabelas']: #indiceComponentes só recusa a tabela existente se ela não tiver as ligações de endereço
+            return {'componentes':{}, 'mensagem':'A tabela componente do rede.db foi gerada sem as ligações de cnpj_links_ete.db, que está configurado em base_endereco_normalizado. Rode de novo o script rede_cria_tabela_componente.py.'}
+        return {'componentes':{}, 'mensagem':'A base rede.db não tem a tabela componente. Rode o script rede_cria_tabela_componente.py.'}
+    ids = {}
+    for item in listaIds:
+        cids = separaEntrada([item])[0]
+        if len(cids)==1:
+            ids[item] = cids.pop()
+    con = gPool.obtem()
+    try:
+        componentes = componentesDosIds(con, ids.values())
+    finally:
+        gPool.devolve(con)
+    resultado = {'componentes':{item:{'id':i, 'componente':componentes[i][0], 'tamanho':componentes[i][1]} for item, i in ids.items()},
+                 'conectados':len({componentes[i][0] for i in ids.values()})<=1 and len(ids)==len(listaIds)}
+    naoLocalizados = [item for item in listaIds if item not in ids]
+    if naoLocalizados:
+        resultado['mensagem'] = 'Itens sem identificador único: ' + ', '.join(naoLocalizados)
+    return resultado
+#.def conectados
+
+@lru_cache(1)
+def indiceControle():
+    ''' True se o rede.db tem a tabela cadeia_controle (rede_cria_tabela_controle.py)'''
+    e = esquemaLigacao()
+    return e['inteiro'] and 'cadeia_controle' in e['tabelas']
+
+def controladores(cnpj):
+    ''' para /rede/api/controle: sócios pessoa física ou do exterior (PF_, PE_) da empresa e das empresas sócias diretas e indiretas dela,
+        lidos da tabela cadeia_controle e das ligações de sócio dessas empresas, sem expansão de camadas.
+        Cada item tem a profundidade (quantidade de ligações até o cnpj) e o caminho do cnpj até ele, pelo trajeto mais curto.
+        Filial é trocada pela matriz, que é quem tem os sócios'''
+    if not indiceControle():
+        return {'controladores':[], 'mensagem':'A base rede.db não tem a tabela cadeia_controle. Rode o script rede_cria_tabela_controle.py.'}
+    cids = separaEntrada([cnpj])[0]
+    ident = cids.pop() if len(cids)==1 else ''
+    if not ident.startswith('PJ_'):
+        return {'controladores':[], 'mensagem':f'{cnpj} não é um cnpj.'}
+    e = esquemaLigacao()
+    mensagem = ''
+    con = gPool.obtem()
+    try:
+        r = con.execute('SELECT id FROM rede.node WHERE ident=?', (ident,)).fetchone()
+        if not r:
+            return {'cnpj':ident, 'controladores':[], 'mensagem':'O cnpj não tem ligações na base.'}
+        idEmpresa = r[0]
+        r = con.execute(f"SELECT {e['id2']} FROM {e['tabela']} WHERE {e['id1']}=? AND {e['descricao']}={e['filial']}", (idEmpresa,)).fetchone()
+        if r:
+            idEmpresa = r[0]
+            mensagem += 'O cnpj é de filial. A cadeia de controle é a da matriz.'
+        cadeia = {idEmpresa:(0, [idEmpresa])} #empresa da cadeia -> (profundidade, caminho)
+        ciclos = []
+        for controladora, profundidade, caminho, ciclo in con.execute('SELECT controladora, profundidade, caminho, ciclo FROM rede.cadeia_controle WHERE empresa=?', (idEmpresa,)):
+            caminho = [int(i) for i in caminho.split(',')]
+            if ciclo:
+                ciclos.append(caminho)
+            else:
+                cadeia[controladora] = (profundidade, caminho)
+        profundidadeMaxima = con.execute("SELECT valor FROM rede.cadeia_controle_info WHERE chave='profundidade_maxima'").fetchone()
+        if profundidadeMaxima and max(p for p, _ in cadeia.values())>=int(profundidadeMaxima[0]):
+            mensagem += f'A cadeia foi calculada até a profundidade {profundidadeMaxima[0]} e pode continuar além dela.'
+        codigosSocio = ','.join(str(c) for c in e['descricaoTipo'] if c<100 or c==999) #sem representante legal e filial
+        pessoas = {} #sócio que não é empresa -> (profundidade, caminho, tipo)
+        empresas = list(cadeia)
+        for k in range(0, len(empresas), 900):
+            parte = empresas[k:k+900]
+            for src, dst, tipo in con.execute(f'''
+                    SELECT t.{e['id1']}, t.{e['id2']}, t.{e['descricao']} FROM {e['tabela']} t INNER JOIN rede.node n ON n.id=t.{e['id1']}
+                    WHERE t.{e['id2']} IN ({','.join('?'*len(parte))}) AND t.{e['descricao']} IN ({codigosSocio or 'NULL'})
+                    AND n.ident NOT LIKE 'PJ^_%' ESCAPE '^' ''', parte):
+                profundidade = cadeia[dst][0]+1
+                if src not in pessoas or profundidade<pessoas[src][0]:
+                    pessoas[src] = (profundidade, cadeia[dst][1]+[src], tipo)
+        ids = {i for _, caminho in cadeia.values() for i in caminho} | {i for _, caminho, _ in pessoas.values() for i in caminho} | {i for c in ciclos for i in c}
+        ids = list(ids)
+        idents = {}
+        for k in range(0, len(ids), 900):
+            parte = ids[k:k+900]
+            idents.update(con.execute(f"SELECT id, ident FROM rede.node WHERE id IN ({','.join('?'*len(parte))})", parte).fetchall())
+    finally:
+        gPool.devolve(con)
+    resultado = {'cnpj':idents[idEmpresa],
+                 'controladores':sorted(({'id':idents[i], 'tipo':e['descricaoTipo'].get(tipo, ''), 'profundidade':p, 'caminho':[idents[c] for c in caminho]}
+                                         for i, (p, caminho, tipo) in pessoas.items()), key=lambda x:(x['profundidade'], x['id'])),
+                 'empresas':sorted(({'id':idents[i], 'profundidade':p, 'caminho':[idents[c] for c in caminho]}
+                                    for i, (p, caminho) in cadeia.items() if p), key=lambda x:(x['profundidade'], x['id'])),
+                 'ciclos':[[idents[c] for c in caminho] for caminho in ciclos]}
+    if ciclos:
+        mensagem += f'Há {len(ciclos)} participação(ões) circular(es) na cadeia.'
+    resultado['mensagem'] = mensagem
+    return resultado
+#.def controladores
 
 gtabelaTempComPrefixo = False
 def tabelaTemp():
@@ -331,16 +677,15 @@ def criaTabelasTmpParaCamadas(camDBAttach, aliasAttach, listaIds=None, grupo=Non
     '''se camada<=1, vê se tem nomes. se camada>=2, supões que listaIds começa com padrão de identificador PJ_, PF_, ...
        se grupo for fornecido, ignora listaIds'''
     #https://www.sqlite.org/inmemorydb.html
-    global gTable
     if prefixo_tabela_temporaria:
         tmp = prefixo_tabela_temporaria
     else:
         tmp = tabelaTemp()
     #xxx4
-    con = sqlite3.connect(':memory:') 
+    #conexão do pool, com as bases já anexadas. Quem chama deve devolver com gPool.devolve(con)
+    con = gPool.obtem()
     #con = sqlite3.connect('test_debug.db')
-    #?mode=ro para read only
-    con.execute("ATTACH DATABASE '" + camDBAttach.replace('\\','/') + "' as " + aliasAttach) 
+    rede_conexoes.anexaBase(con, camDBAttach, aliasAttach)
     
     camadasIds = {}
     #apagaTabelasTemporarias(tmp)
@@ -433,8 +778,256 @@ def id2cnpj(id):
     return id[3:]
 
 @timeit
-def camadasRede(listaIds=None, camada=1, grupo=None, criterioCaminhos='', bjson=True):    
+@cacheResultado
+def camadasRede(listaIds=None, camada=1, grupo=None, criterioCaminhos='', bjson=True, tipos=None, excluirTipos=None, analise=False, somenteMatriz=False, periodo=None):
+    con, tmp, camadasIds, mensagem, bIncompleto = camadasRede_expande(listaIds=listaIds, camada=camada, grupo=grupo, criterioCaminhos=criterioCaminhos, tipos=tipos, excluirTipos=excluirTipos,
+                                                                      somenteMatriz=somenteMatriz, periodo=periodo)
+    if con is None:
+        textoJson = {'no': [], 'ligacao':[], 'mensagem':mensagem} 
+    else:
+        try:
+            textoJson = camadasRede_json(con, tmp, camadasIds, mensagem, bCaminhos=bool(criterioCaminhos))
+        finally:
+            gPool.devolve(con)
+        if analise:
+            camadasRede_analise(textoJson)
+    if bIncompleto:
+        textoJson['incompleto'] = True
+    return textoJson
+#.def camadasRede
+
+def camadasRede_analise(textoJson):
+    ''' anexa em cada nó o campo centralidade (grau, pagerank e intermediacao no subgrafo do resultado), ver rede_analise.py'''
+    if not rede_analise.disponivel():
+        textoJson['mensagem'] += 'A análise da rede precisa do numpy instalado.'
+    elif len(textoJson['no'])>kLimiteItensAnalise:
+        textoJson['mensagem'] += f'A análise da rede não foi feita, pois o resultado tem mais de {kLimiteItensAnalise} itens.'
+    else:
+        tinicial = time.time()
+        centralidade = rede_analise.centralidades(textoJson['no'], textoJson['ligacao'], amostra=kAmostraIntermediacao)
+        for no in textoJson['no']:
+            no['centralidade'] = centralidade[no['id']]
+        print(time.asctime(), f"camadasRede_analise: {len(textoJson['no'])} itens, {time.time()-tinicial:.3f}s")
+    return textoJson
+#.def camadasRede_analise
+
+@timeit
+@cacheResultado
+def camadasRedeAgrupada(listaIds=None, camada=1, grupo=None, criterioCaminhos='', tipos=None, excluirTipos=None, analise=False, comunidade='', somenteMatriz=False, periodo=None):
+    ''' resultado de camadasRede com cada comunidade de mais de um item trocada por um nó CO_n (campo qtde_itens) e as ligações 
+        entre comunidades somadas (campo peso). Com comunidade=CO_n, retorna só os itens dessa comunidade e as ligações deles, 
+        com a outra ponta como no grafo agrupado, para a interface trocar o nó CO_n pelos itens'''
+    textoJson = camadasRede(listaIds=listaIds, camada=camada, grupo=grupo, criterioCaminhos=criterioCaminhos, tipos=tipos, excluirTipos=excluirTipos, analise=analise,
+                            somenteMatriz=somenteMatriz, periodo=periodo)
+    if not rede_analise.disponivel():
+        textoJson['mensagem'] += 'O agrupamento da rede precisa do numpy instalado.'
+        return textoJson
+    tinicial = time.time()
+    nos = textoJson['no']
+    numero = rede_analise.comunidades(nos, textoJson['ligacao'], alvo=kItensAgrupamento)
+    membros = collections.defaultdict(list)
+    for no, k in zip(nos, numero):
+        membros[f'CO_{k+1}'].append(no)
+    idAgrupado = {}
+    for idComunidade, lista in membros.items():
+        for no in lista:
+            idAgrupado[no['id']] = idComunidade if len(lista)>1 else no['id']
+    comunidades = {c:membros[c] for c in sorted(membros, key=lambda c: int(c[3:])) if len(membros[c])>1} #CO_1 é a maior
+    if comunidade: 
+        if comunidade not in comunidades:
+            return {'no':[], 'ligacao':[], 'mensagem':f'A comunidade {comunidade} não foi encontrada neste resultado.', 'comunidade':comunidade}
+        for no in comunidades[comunidade]:
+            idAgrupado[no['id']] = no['id']
+        ids = {no['id'] for no in comunidades[comunidade]}
+        ligacoes = ligacoesAgrupadas([l for l in textoJson['ligacao'] if l['origem'] in ids or l['destino'] in ids], idAgrupado)
+        resultado = {'no':comunidades[comunidade], 'ligacao':ligacoes, 'mensagem':'', 'comunidade':comunidade}
+    else:
+        grau = collections.Counter(itertools.chain.from_iterable((l['origem'], l['destino']) for l in textoJson['ligacao']))
+        nosComunidades = []
+        for idComunidade, lista in comunidades.items():
+            principal = max(lista, key=lambda no: grau[no['id']])
+            nosComunidades.append({'id':idComunidade, 'descricao':f"{principal.get('descricao', principal['id'])} e mais {len(lista)-1} {'item' if len(lista)==2 else 'itens'}", 
+                                 'camada':min(no.get('camada', 0) for no in lista), 'imagem':'users.png', 'qtde_itens':len(lista), 'principal':principal['id']})
+        nosAgrupados = [no for no in nos if idAgrupado[no['id']]==no['id']] + ajustaLabelIcone(nosComunidades)
+        resultado = {'no':nosAgrupados, 'ligacao':ligacoesAgrupadas(textoJson['ligacao'], idAgrupado), 'mensagem':textoJson['mensagem'],
+                     'comunidades':[{'id':c, 'qtde_itens':len(lista)} for c, lista in comunidades.items()]}
+        if comunidades:
+            resultado['mensagem'] += f"{sum(len(lista) for lista in comunidades.values())} itens foram agrupados em {len(comunidades)} comunidades."
+    for chave in ('origem_destino', 'incompleto'):
+        if chave in textoJson:
+            resultado[chave] = textoJson[chave]
+    print(time.asctime(), f"camadasRedeAgrupada: {len(nos)} itens, {len(comunidades)} comunidades, {time.time()-tinicial:.3f}s")
+    return resultado
+#.def camadasRedeAgrupada
+
+def ligacoesAgrupadas(ligacoes, idAgrupado):
+    ''' troca as pontas das ligações pelo id no grafo agrupado. Ligações entre itens fora das comunidades ficam iguais, 
+        as demais são somadas por par (origem, destino), sem as ligações internas de uma comunidade'''
+    resultado = []
+    peso = collections.Counter()
+    label = {}
+    for lig in ligacoes:
+        origem, destino = idAgrupado.get(lig['origem'], lig['origem']), idAgrupado.get(lig['destino'], lig['destino'])
+        if origem==lig['origem'] and destino==lig['destino']:
+            resultado.append(lig)
+        elif origem!=destino:
+            peso[(origem, destino)] += 1
+            label[(origem, destino)] = lig['label']
+    for (origem, destino), qtde in peso.items():
+        resultado.append({'origem':origem, 'destino':destino, 'label':label[(origem, destino)] if qtde==1 else f'{qtde} ligações', 
+                          'cor':'silver', 'camada':0, 'tipoDescricao':'', 'peso':qtde})
+    return resultado
+#.def ligacoesAgrupadas
+
+kTamanhoBlocoNDJSON = 1000
+def camadasRede_ndjson(listaIds=None, camada=1, grupo=None, criterioCaminhos='', tipos=None, excluirTipos=None, somenteMatriz=False, periodo=None):
+    ''' mesmo resultado de camadasRede, mas gerado em pedaços para resposta em streaming (uma linha json por bloco).
+        As linhas são {"ligacao":[...]}, {"no":[...]}, {"origem_destino":[...]} e por último {"mensagem":..., "fim":true}.
+        Os nós não são ordenados por camada como em camadasRede_json, para não precisar esperar todos.'''
+    con, tmp, camadasIds, mensagem, bIncompleto = camadasRede_expande(listaIds=listaIds, camada=camada, grupo=grupo, criterioCaminhos=criterioCaminhos, tipos=tipos, excluirTipos=excluirTipos,
+                                                                      somenteMatriz=somenteMatriz, periodo=periodo)
+    try:
+        if con is not None:
+            for chave, bloco in camadasRede_blocos(con, tmp, camadasIds, bCaminhos=bool(criterioCaminhos)):
+                yield orjson.dumps({chave:bloco}) + b'\n'
+        fim = {'mensagem':mensagem, 'fim':True}
+        if bIncompleto:
+            fim['incompleto'] = True
+        yield orjson.dumps(fim) + b'\n'
+    finally: #também é executado se o cliente desconectar no meio
+        gPool.devolve(con)
+#.def camadasRede_ndjson
+
+kLoteThreads = config.config['ETC'].getint('lote_threads', 4)
+gExecutorLote = None
+gLockLote = threading.Lock()
+def executorLote():
+    ''' threads compartilhadas por todas as requisições de lote, criadas na primeira chamada'''
+    global gExecutorLote
+    with gLockLote:
+        if gExecutorLote is None:
+            gExecutorLote = ThreadPoolExecutor(max_workers=kLoteThreads, thread_name_prefix='lote')
+    return gExecutorLote
+
+def camadasRedeLote(itens):
+    ''' itens: lista de dicionários com listaIds ou grupo, camada, criterioCaminhos, tipos, excluirTipos, analise, agrupar, somenteMatriz e periodo (opcionais).
+        Gera (indice, resultado) na ordem em que as consultas terminam. Cada consulta usa uma conexão do pool e o cache de camadasRede.
+        Se o gerador for fechado antes do fim (cliente desconectou), as consultas que não começaram são canceladas'''
+    def consulta(item):
+        if item.get('agrupar'):
+            return camadasRedeAgrupada(camada=item['camada'], grupo=item['grupo'] if item.get('criterioCaminhos') else '', 
+                                       listaIds=None if item.get('criterioCaminhos') else item['listaIds'], criterioCaminhos=item.get('criterioCaminhos', ''), 
+                                       tipos=item.get('tipos'), excluirTipos=item.get('excluirTipos'), analise=bool(item.get('analise')),
+                                       somenteMatriz=bool(item.get('somenteMatriz')), periodo=item.get('periodo'))
+        if item.get('criterioCaminhos'):
+            return camadasRede(camada=item['camada'], grupo=item['grupo'], listaIds=None, criterioCaminhos=item['criterioCaminhos'], 
+                               tipos=item.get('tipos'), excluirTipos=item.get('excluirTipos'), analise=bool(item.get('analise')), somenteMatriz=bool(item.get('somenteMatriz')), 
+                               periodo=item.get('periodo'))
+        return camadasRede(camada=item['camada'], listaIds=item['listaIds'], grupo='', tipos=item.get('tipos'), excluirTipos=item.get('excluirTipos'), 
+                           analise=bool(item.get('analise')), somenteMatriz=bool(item.get('somenteMatriz')), periodo=item.get('periodo'))
+    executor = executorLote()
+    futuros = {executor.submit(consulta, item):k for k, item in enumerate(itens)}
+    try:
+        for futuro in as_completed(futuros):
+            try:
+                yield futuros[futuro], futuro.result()
+            except Exception as err:
+                print('erro em camadasRedeLote:', err)
+                yield futuros[futuro], {'no':[], 'ligacao':[], 'mensagem':'Erro na consulta.', 'erro':str(err)}
+    finally:
+        for futuro in futuros:
+            futuro.cancel()
+#.def camadasRedeLote
+
+def extrapolaCustos(custos, camada, fator):
+    ''' completa a estimativa até a camada, multiplicando a última camada pelo fator de crescimento'''
+    custos = list(custos)
+    while len(custos)<camada:
+        custos.append(custos[-1]*fator)
+    return custos[:camada]
+
+def estimaCustoCamadas(con, tmp, camada, grafo=None):
+    ''' estimativa da quantidade de ligações lidas em cada camada de camadasRede, sem fazer a expansão.
+        A camada 1 é o grau dos itens de entrada. A camada 2 soma o grau dos vizinhos (com a tabela rede.grau ou com o grafo em memória), 
+        sem os nós acima de kGrauMaximoNo, que não são expandidos. As camadas seguintes são extrapoladas pela razão entre as duas primeiras.
+        Sem a tabela grau, conta as ligações dos itens de entrada e extrapola pelo grau médio deles'''
+    if grafo is not None:
+        listaIds = [r[0] for r in con.execute(f'select identificador from {tmp}_ids_inicial')]
+        qtdeSementes, custos = grafo.custoCamadas(listaIds, kGrauMaximoNo, bSegunda=False)
+        if camada>1 and custos[0]<=kOrcamentoLigacoes: #a segunda camada só é estimada se a primeira couber no orçamento
+            qtdeSementes, custos = grafo.custoCamadas(listaIds, kGrauMaximoNo)
+    else:
+        e = esquemaLigacao()
+        sementes = (f"SELECT DISTINCT n.id as id FROM {tmp}_ids_inicial ti INNER JOIN rede.node n ON n.ident=ti.identificador" 
+                    if e['inteiro'] else f"SELECT DISTINCT identificador as id FROM {tmp}_ids_inicial")
+        qtdeSementes = con.execute(f'SELECT count(*) FROM ({sementes})').fetchone()[0]
+        if e['inteiro'] and 'grau' in e['tabelas']:
+            custos = [con.execute(f'WITH s AS ({sementes}) SELECT coalesce(sum(g.total),0) FROM s INNER JOIN rede.grau g ON g.id=s.id').fetchone()[0]]
+            if camada>1 and custos[0]<=kOrcamentoLigacoes:
+                query = f'''
+                    WITH s AS ({sementes}),
+                    v AS (
+                        SELECT t.{e['id2']} as id FROM s INNER JOIN {e['tabela']} t ON t.{e['id1']}=s.id
+                        UNION
+                        SELECT t.{e['id1']} as id FROM s INNER JOIN {e['tabela']} t ON t.{e['id2']}=s.id WHERE t.{e['descricao']}<>{e['filial']}
+                        EXCEPT
+                        SELECT id FROM s
+                    )
+                    SELECT coalesce(sum(g.total),0) FROM v INNER JOIN rede.grau g ON g.id=v.id
+                    {f'WHERE g.total<={kGrauMaximoNo}' if kGrauMaximoNo else ''}
+                '''
+                custos.append(con.execute(query).fetchone()[0])
+        else:
+            query = f'''
+                WITH s AS ({sementes})
+                SELECT (SELECT count(*) FROM s INNER JOIN {e['tabela']} t ON t.{e['id1']}=s.id)
+                     + (SELECT count(*) FROM s INNER JOIN {e['tabela']} t ON t.{e['id2']}=s.id)
+            '''
+            custos = [con.execute(query).fetchone()[0]]
+    if len(custos)>1:
+        fator = custos[1]/custos[0] if custos[0] else 0
+    else:
+        fator = custos[0]/qtdeSementes if qtdeSementes else 0
+    return extrapolaCustos(custos, camada, fator)
+#.def estimaCustoCamadas
+
+def admissaoConsulta(custos, camada):
+    ''' custos: estimativa de ligações lidas por camada (custos[0] é a camada 1).
+        Retorna a camada a executar e a mensagem. A camada é None se a consulta for rejeitada'''
+    if not kOrcamentoLigacoes or camada<1:
+        return camada, ''
+    acumulado = 0
+    camadaAdmitida = 0
+    for cam, custo in enumerate(custos[:camada], 1):
+        acumulado += custo
+        if acumulado>kOrcamentoLigacoes:
+            break
+        camadaAdmitida = cam
+    if camadaAdmitida>=camada:
+        return camada, ''
+    estimativa = int(sum(custos[:camada]))
+    if kAdmissaoConsulta=='rejeitar' or camadaAdmitida==0:
+        return None, f'A consulta não foi executada, pois a estimativa de {estimativa} ligações até a camada {camada} excede o limite da consulta ({kOrcamentoLigacoes}). Tente com menos itens ou com camada menor.'
+    return camadaAdmitida, f'A consulta foi reduzida para a camada {camadaAdmitida}, pois a estimativa de {estimativa} ligações até a camada {camada} excede o limite da consulta ({kOrcamentoLigacoes}).'
+#.def admissaoConsulta
+
+def camadasRede_expande(listaIds=None, camada=1, grupo=None, criterioCaminhos='', tipos=None, excluirTipos=None, somenteMatriz=False, periodo=None):
+    ''' faz a expansão das camadas (e caminhos) nas tabelas temporárias de uma conexão do pool.
+        Retorna con, tmp, camadasIds, mensagem, bIncompleto. con=None se não houver resultado. Quem chama deve devolver con ao pool.
+        bIncompleto=True se alguma consulta foi interrompida pelo tempo limite (kTempoLimiteConsulta).
+        tipos/excluirTipos: descrições dos tipos de ligação de rede.ligacao a seguir ou a não seguir (ligações de endereços e base local não são filtradas)
+        somenteMatriz: cada cnpj de filial é trocado pelo da matriz e as ligações de filial não são seguidas.
+        A quantidade de filiais de cada matriz fica em {tmp}_filiais (campo qtde_filiais dos nós)
+        periodo: (dia inicial, dia final) de periodoDatas. Só segue ligações de rede.ligacao com data de entrada no período'''
     mensagem = '' #{'lateral':'', 'popup':'', 'confirmar':''}
+    permitidos, naoEncontrados = tiposPermitidos(tipos, excluirTipos)
+    if naoEncontrados:
+        mensagem += f'Tipos de ligação não encontrados: {", ".join(naoEncontrados)}.'
+    if somenteMatriz:
+        permitidos = (permitidos if permitidos is not None else frozenset(tiposLigacao())) - {'filial'}
+    if periodo and not esquemaLigacao()['dataEntrada']:
+        mensagem += 'A base rede.db não tem a data de entrada das ligações (gerada por uma versão anterior do rede_cria_tabela_rede.db.py). O filtro de datas não foi aplicado.'
+        periodo = None
 
     '''
     https://stackoverflow.com/questions/17497614/sqlalchemy-core-connection-context-manager
@@ -448,10 +1041,13 @@ def camadasRede(listaIds=None, camada=1, grupo=None, criterioCaminhos='', bjson=
     cur = con.cursor()
     if len(camadasIds)==0:
         #print('consulta sem ids de entrada')
-        textoJson={'no': [], 'ligacao':[], 'mensagem':'Não encontrou informações.'} 
         cur.close() 
-        con = None        
-        return textoJson
+        gPool.devolve(con)
+        return None, tmp, camadasIds, 'Não encontrou informações.', False
+    if somenteMatriz: #itens de entrada que são filiais
+        for filial, matriz in trocaFilialPorMatriz(con, tmp, f'{tmp}_ids', 'identificador').items():
+            camadasIds.pop(filial, None)
+            camadasIds[matriz] = 0
     # print(listaIds) #x3
     # print(camadasIds) #x3
     #dicRazaoSocial = {} #excepcional, se um cnpj que é sócio na tabela de socios não tem cadastro na tabela empresas
@@ -466,60 +1062,144 @@ def camadasRede(listaIds=None, camada=1, grupo=None, criterioCaminhos='', bjson=
         CREATE TABLE {tmp}_ligacao  --cria tabela para caso de cam 0, sem ido dá erro na ora de criar tabela final de ids com id1 e id2
         (
             id1 VARCHAR, id2 VARCHAR, descricao VARCHAR            
-        )
+        );
+        --nós com grau acima de kGrauMaximoNo que foram alcançados mas não expandidos
+        DROP TABLE if exists {tmp}_truncados;
+        CREATE TABLE {tmp}_truncados (identificador VARCHAR, grau INTEGER);
+        DROP TABLE if exists {tmp}_filiais; --criada só no modo somenteMatriz
     '''
 
     con.executescript(query)
-    cam=0
-    tinicial = time.time()
-    for cam in range(1, camada+1):  
-        query = f''' 
-        DROP TABLE if exists {tmp}_ligacao;
-        
-        CREATE TABLE {tmp}_ligacao AS
-            SELECT t.id1, t.id2, t.descricao
-            FROM {tmp}_ids tl
-            INNER JOIN rede.ligacao t ON t.id1=tl.identificador
-            UNION
-            SELECT t.id1, t.id2, t.descricao
-            FROM {tmp}_ids tl
-            INNER JOIN rede.ligacao t ON t.id2=tl.identificador 
-            WHERE t.descricao<>'filial' 
-            --este where filial pode causar inconsistência na procura de caminhos por causar assimetria
-        
-            /* --fazer join para ver se tem repetição não faz diferença ou deixa um pouco mais lento
-            SELECT t.id1, t.id2, t.descricao
-            FROM {tmp}_ids ti
-            INNER JOIN rede.ligacao t ON t.id1=ti.identificador
-            LEFT JOIN {tmp}_ids tib ON t.id2=tib.identificador
-            WHERE tib.identificador IS NULL
-            UNION
-            SELECT t.id1, t.id2, t.descricao
-            FROM {tmp}_ids ti
-            INNER JOIN rede.ligacao t ON t.id2=ti.identificador 
-            LEFT JOIN {tmp}_ids tib ON t.id1=tib.identificador
-            WHERE tib.identificador IS NULL 
-            AND t.descricao<>'filial' 
-            --este where filial pode causar inconsistência na procura de caminhos por causar assimetria
-            */
-        ;
-        DROP TABLE if exists {tmp}_ids;
-        CREATE TABLE {tmp}_ids AS
-        SELECT DISTINCT * FROM 
-        (   SELECT identificador
-            FROM {tmp}_ids_inicial
-            UNION
-            SELECT t.id1 as identificador
-            FROM {tmp}_ligacao t
-            UNION
-            SELECT t.id2 as identificador
-            FROM {tmp}_ligacao t
-        )
+    if criterioCaminhos and kMotorCaminhos=='bfs':
+        #a busca de caminhos pega as ligações camada a camada, não precisa da expansão abaixo
+        if kTempoLimiteConsulta:
+            rede_conexoes.definePrazo(con, tempoInicio + kTempoLimiteConsulta)
+        try:
+            mensagem += camadasRede_caminhosBFS(con, tmp, camada, criterioCaminhos, permitidos, periodo)
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            cur.close()
+            gPool.devolve(con)
+            mensagem += f'A busca de caminhos foi interrompida, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s). Tente com uma camada menor.'
+            return None, tmp, camadasIds, mensagem, True
+        rede_conexoes.removePrazo(con)
+        if somenteMatriz:
+            camadasRede_matriz(con, tmp)
+        cur.close()
+        return con, tmp, camadasIds, mensagem, False
+    grafo = None
+    if kMotorGrafo in ('csr', 'mmap') and not periodo: #o grafo em memória não tem as datas das ligações, o filtro de datas é feito no sqlite
+        grafo = rede_grafo.grafoCSR(caminhoDBRede) if kMotorGrafo=='csr' else rede_grafo.grafoMmap(caminhoGrafo)
+    if kOrcamentoLigacoes and camada>0:
+        camada, mensagemAdmissao = admissaoConsulta(estimaCustoCamadas(con, tmp, camada, grafo), camada)
+        mensagem += mensagemAdmissao
+        if camada is None:
+            cur.close()
+            gPool.devolve(con)
+            return None, tmp, camadasIds, mensagem, True
+    expansao = None
+    if grafo is not None:
+        expansao = grafo.expansao([r[0] for r in con.execute(f'select identificador from {tmp}_ids_inicial')], grauMaximo=kGrauMaximoNo, 
+                                  tipos=grafo.codigosTipos(permitidos) if permitidos is not None else None)
+    else:
+        #a expansão é feita em {tmp}_nos (visitados), {tmp}_fronteira (nós novos da camada anterior) e {tmp}_lig_rede. 
+        #Se a base tiver a tabela ligacao_int, são inteiros de rede.node, que só são convertidos para texto depois do loop
+        e = esquemaLigacao()
+        bGrau = kGrauMaximoNo>0 and e['inteiro'] and 'grau' in e['tabelas'] #tabela rede.grau criada por rede_cria_tabela_rede.db.py
+        filtroTipos = filtroTiposSQL(permitidos, f"t.{e['descricao']}") + filtroDataSQL(periodo, 't.data_entrada')
+        query = f'''
+            DROP TABLE if exists {tmp}_truncados_int;
+            CREATE TABLE {tmp}_truncados_int (identificador, grau);
+            DROP TABLE if exists {tmp}_nos_inicial;
+            CREATE TABLE {tmp}_nos_inicial AS
+            { f"SELECT DISTINCT n.id as identificador FROM {tmp}_ids_inicial ti INNER JOIN rede.node n ON n.ident=ti.identificador"
+              if e['inteiro'] else f"SELECT DISTINCT identificador FROM {tmp}_ids_inicial" };
+            DROP TABLE if exists {tmp}_nos;
+            CREATE TABLE {tmp}_nos (identificador PRIMARY KEY);
+            INSERT INTO {tmp}_nos SELECT identificador FROM {tmp}_nos_inicial;
+            DROP TABLE if exists {tmp}_fronteira;
+            CREATE TABLE {tmp}_fronteira AS
+            SELECT identificador FROM {tmp}_nos;
+            DROP TABLE if exists {tmp}_lig_rede;
+            CREATE TABLE {tmp}_lig_rede (id1, id2, descricao);
         '''
-        
         con.executescript(query)
-        #sqlite pode executar vários comandos com executescript(query)
-        registros = cur.execute(f'select count(*) from {tmp}_ids').fetchone()[0]
+        #itens de entrada que não estão em rede.node também contam como registros
+        qtdeForaDaRede = cur.execute(f'select count(distinct identificador) from {tmp}_ids_inicial').fetchone()[0] - cur.execute(f'select count(*) from {tmp}_nos_inicial').fetchone()[0]
+    cam=0
+    tinicial = time.time()
+    tamanhoFronteiras = []
+    bIncompleto = False
+    #kTempoMaxConsulta só é verificado entre as camadas. O prazo abaixo interrompe a consulta sqlite que estiver em andamento
+    prazo = tempoInicio + kTempoLimiteConsulta if kTempoLimiteConsulta else None
+    if prazo:
+        rede_conexoes.definePrazo(con, prazo)
+    camadasLoop = camada
+    if kMotorGrafo=='cte' and camada>0: #todas as camadas numa consulta só, sem o loop abaixo
+        camadasLoop = 0
+        try:
+            mensagemCTE, tamanhoFronteiras = camadasRede_cte(con, tmp, camada, e, filtroTipos, bGrau, qtdeForaDaRede)
+            mensagem += mensagemCTE
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            mensagem += f'A expansão foi interrompida, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s). O resultado tem só os itens de entrada.'
+            bIncompleto = True
+    for cam in range(1, camadasLoop+1):
+        try:
+            if expansao:
+                registros = expansao.proximaCamada()
+                tamanhoFronteiras = expansao.tamanhoFronteiras
+            else:
+                if bGrau and cam>1: #os itens de entrada (fronteira da camada 1) sempre são expandidos
+                    query = f'''
+                    INSERT INTO {tmp}_truncados_int
+                    SELECT f.identificador, g.total
+                    FROM {tmp}_fronteira f INNER JOIN rede.grau g ON g.id=f.identificador
+                    WHERE g.total>{kGrauMaximoNo};
+                    DELETE FROM {tmp}_fronteira WHERE identificador IN (SELECT identificador FROM {tmp}_truncados_int);
+                    '''
+                    con.executescript(query)
+                #só busca as ligações da fronteira. As ligações dos nós das camadas anteriores já estão em {tmp}_lig_rede
+                query = f''' 
+                DROP TABLE if exists {tmp}_lig_camada;
+                CREATE TABLE {tmp}_lig_camada AS
+                    SELECT t.{e['id1']} as id1, t.{e['id2']} as id2, t.{e['descricao']} as descricao
+                    FROM {tmp}_fronteira tl
+                    INNER JOIN {e['tabela']} t ON t.{e['id1']}=tl.identificador{filtroTipos}
+                    UNION
+                    SELECT t.{e['id1']} as id1, t.{e['id2']} as id2, t.{e['descricao']} as descricao
+                    FROM {tmp}_fronteira tl
+                    INNER JOIN {e['tabela']} t ON t.{e['id2']}=tl.identificador{filtroTipos}
+                    WHERE t.{e['descricao']}<>{e['filial']}
+                    --este where filial pode causar inconsistência na procura de caminhos por causar assimetria
+                ;
+                INSERT INTO {tmp}_lig_rede
+                SELECT * FROM {tmp}_lig_camada;
+                DROP TABLE if exists {tmp}_fronteira;
+                CREATE TABLE {tmp}_fronteira AS
+                SELECT t.id1 as identificador
+                FROM {tmp}_lig_camada t
+                UNION
+                SELECT t.id2 as identificador
+                FROM {tmp}_lig_camada t
+                EXCEPT
+                SELECT identificador
+                FROM {tmp}_nos;
+                INSERT INTO {tmp}_nos
+                SELECT identificador FROM {tmp}_fronteira;
+                '''
+                con.executescript(query)
+                #sqlite pode executar vários comandos com executescript(query)
+                tamanhoFronteiras.append(cur.execute(f'select count(*) from {tmp}_fronteira').fetchone()[0])
+                registros = cur.execute(f'select count(*) from {tmp}_nos').fetchone()[0] + qtdeForaDaRede
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            mensagem += f'A camada {cam} foi interrompida, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s). O resultado está incompleto.'
+            bIncompleto = True
+            break
 
         if registros==registrosAnterior: # and cam>1:
             if cam>1: 
@@ -535,50 +1215,396 @@ def camadasRede(listaIds=None, camada=1, grupo=None, criterioCaminhos='', bjson=
                 break
         registrosAnterior = registros
     #.for cam in range(camada): 
+    print(time.asctime(), f'camadasRede ({kMotorGrafo}): nós novos por camada {tamanhoFronteiras}, {time.time()-tinicial:.3f}s')
+    rede_conexoes.removePrazo(con) #a conversão do que já foi obtido não é interrompida
+    if expansao: #passa o resultado da expansão em memória para as tabelas temporárias, o restante da rotina fica igual
+        cur.executemany(f'INSERT INTO {tmp}_ligacao (id1, id2, descricao) VALUES (?,?,?)', expansao.ligacoes())
+        con.executescript(f'DROP TABLE if exists {tmp}_ids; CREATE TABLE {tmp}_ids (identificador VARCHAR)')
+        cur.executemany(f'INSERT INTO {tmp}_ids (identificador) VALUES (?)', ((i,) for i in expansao.identificadores()))
+        cur.executemany(f'INSERT INTO {tmp}_truncados (identificador, grau) VALUES (?,?)', expansao.identificadoresTruncados().items())
+    elif e['inteiro']: #converte para texto só no final
+        query = f'''
+            INSERT INTO {tmp}_ligacao
+            SELECT n1.ident, n2.ident, tl.descricao
+            FROM (SELECT DISTINCT * FROM {tmp}_lig_rede) t
+            INNER JOIN rede.node n1 ON n1.id=t.id1
+            INNER JOIN rede.node n2 ON n2.id=t.id2
+            INNER JOIN rede.tipo_ligacao tl ON tl.codigo=t.descricao;
+            DROP TABLE if exists {tmp}_ids;
+            CREATE TABLE {tmp}_ids AS
+            SELECT identificador FROM {tmp}_ids_inicial
+            UNION
+            SELECT n.ident FROM {tmp}_nos t INNER JOIN rede.node n ON n.id=t.identificador;
+            INSERT INTO {tmp}_truncados
+            SELECT n.ident, t.grau FROM {tmp}_truncados_int t INNER JOIN rede.node n ON n.id=t.identificador;
+        '''
+        con.executescript(query)
+    else:
+        query = f'''
+            INSERT INTO {tmp}_ligacao
+            SELECT DISTINCT * FROM {tmp}_lig_rede;
+            DROP TABLE if exists {tmp}_ids;
+            CREATE TABLE {tmp}_ids AS
+            SELECT identificador FROM {tmp}_ids_inicial
+            UNION
+            SELECT identificador FROM {tmp}_nos;
+        '''
+        con.executescript(query)
+    qtdeTruncados = cur.execute(f'select count(*) from {tmp}_truncados').fetchone()[0]
+    if qtdeTruncados:
+        mensagem += f'{qtdeTruncados} itens com mais de {kGrauMaximoNo} ligações não foram expandidos (marcados como truncado).'
     #print('camada rede em', time.time()-tinicial) 
+    if prazo:
+        rede_conexoes.definePrazo(con, prazo)
     #adiciona endereços, email, telefone e ligacoes da base local
-    if camada>0:
-        for tipoLink in ['endereco', 'base_local']:
-            if tipoLink=='endereco':
-                if not caminhoDBEnderecoNormalizado:
-                    continue
-                camDB = caminhoDBEnderecoNormalizado
-                tabela = tipoLink + '.link_ete'
-            else:
-                if not caminhoDBBaseLocal:
-                    continue
-                camDB = caminhoDBBaseLocal
-                tabela = tipoLink + '.links'   
-                #db = 'dlink'
-            
-            con.execute("ATTACH DATABASE '" + camDB.replace('\\','/') + "' as " + tipoLink)
-            query = f''' 
-                         INSERT INTO  {tmp}_ligacao
-                         SELECT distinct * from (
-                         SELECT t.id1, t.id2, t.descricao
-                         FROM {tmp}_ids tid
-                         INNER JOIN {tabela} t ON  tid.identificador = t.id1
-                         UNION
-                         SELECT t.id1, t.id2, t.descricao
-                         FROM {tmp}_ids tid
-                         INNER JOIN {tabela} t ON  tid.identificador = t.id2
-                         ) tu
-                         '''
-            con.execute(query)
+    if camada>0 and not bIncompleto:
+        try:
+            for tipoLink in ['endereco', 'base_local']:
+                if tipoLink=='endereco':
+                    if not caminhoDBEnderecoNormalizado:
+                        continue
+                    camDB = caminhoDBEnderecoNormalizado
+                    tabela = tipoLink + '.link_ete'
+                else:
+                    if not caminhoDBBaseLocal:
+                        continue
+                    camDB = caminhoDBBaseLocal
+                    tabela = 'dlocal.links'   
+                    #db = 'dlink'
+                
+                rede_conexoes.anexaBase(con, camDB, tabela.split('.')[0])
+                query = f''' 
+                             INSERT INTO  {tmp}_ligacao
+                             SELECT distinct * from (
+                             SELECT t.id1, t.id2, t.descricao
+                             FROM {tmp}_ids tid
+                             INNER JOIN {tabela} t ON  tid.identificador = t.id1
+                             UNION
+                             SELECT t.id1, t.id2, t.descricao
+                             FROM {tmp}_ids tid
+                             INNER JOIN {tabela} t ON  tid.identificador = t.id2
+                             ) tu
+                             '''
+                con.execute(query)
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            mensagem += f'As ligações de endereços e da base local não foram incluídas, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s).'
+            bIncompleto = True
+    if somenteMatriz: #as ligações de endereços e da base local podem ter filiais
+        rede_conexoes.removePrazo(con)
+        camadasRede_matriz(con, tmp)
+        if prazo:
+            rede_conexoes.definePrazo(con, prazo)
     if criterioCaminhos:
-        camadasRede_caminhos(con, tmp, camada, criterioCaminhos)
-        textoJson = camadasRede_json(con, tmp, camadasIds, mensagem, bCaminhos=True)
-    else:
-        textoJson = camadasRede_json(con, tmp, camadasIds, mensagem, bCaminhos=False)
-    
+        try:
+            camadasRede_caminhos(con, tmp, camada, criterioCaminhos)
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            #as tabelas temporárias ficam inconsistentes no meio da rotina de caminhos, não há resultado parcial
+            cur.close()
+            gPool.devolve(con)
+            mensagem += f'A busca de caminhos foi interrompida, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s). Tente com uma camada menor.'
+            return None, tmp, camadasIds, mensagem, True
+    rede_conexoes.removePrazo(con)
     cur.close() 
-    con = None 
-    return textoJson
-#.def camadasRede
+    return con, tmp, camadasIds, mensagem, bIncompleto
+#.def camadasRede_expande
+
+def trocaFilialPorMatriz(con, tmp, tabela, coluna):
+    ''' troca na coluna os cnpjs de filial pelo cnpj da matriz (ligação filial de rede.ligacao, da filial para a matriz).
+        Retorna o dicionário filial->matriz dos itens trocados'''
+    e = esquemaLigacao()
+    if e['inteiro']:
+        query = f'''
+            SELECT DISTINCT x.{coluna}, n2.ident
+            FROM {tabela} x
+            INNER JOIN rede.node n1 ON n1.ident=x.{coluna}
+            INNER JOIN {e['tabela']} t ON t.{e['id1']}=n1.id AND t.{e['descricao']}={e['filial']}
+            INNER JOIN rede.node n2 ON n2.id=t.{e['id2']}
+            WHERE x.{coluna} LIKE 'PJ^_%' ESCAPE '^'
+        '''
+    else:
+        query = f'''
+            SELECT DISTINCT x.{coluna}, t.{e['id2']}
+            FROM {tabela} x
+            INNER JOIN {e['tabela']} t ON t.{e['id1']}=x.{coluna} AND t.{e['descricao']}={e['filial']}
+            WHERE x.{coluna} LIKE 'PJ^_%' ESCAPE '^'
+        '''
+    matrizes = dict(con.execute(query).fetchall())
+    if matrizes:
+        con.executemany(f'UPDATE {tabela} SET {coluna}=? WHERE {coluna}=?', [(matriz, filial) for filial, matriz in matrizes.items()])
+    return matrizes
+#.def trocaFilialPorMatriz
+
+def camadasRede_matriz(con, tmp):
+    ''' modo somenteMatriz, depois da expansão: troca as filiais das ligações pela matriz (sem a ligação da matriz com ela mesma)
+        e grava em {tmp}_filiais a quantidade de filiais de cada cnpj do resultado'''
+    trocaFilialPorMatriz(con, tmp, f'{tmp}_ligacao', 'id1')
+    trocaFilialPorMatriz(con, tmp, f'{tmp}_ligacao', 'id2')
+    e = esquemaLigacao()
+    if e['inteiro']: #filial -> matriz, conta pelo índice (dst, tipo)
+        qtde = f"(SELECT count(*) FROM {e['tabela']} t WHERE t.{e['id2']}=n.id AND t.{e['descricao']}={e['filial']}) as qtde FROM {tmp}_pjs x INNER JOIN rede.node n ON n.ident=x.identificador"
+    else:
+        qtde = f"(SELECT count(*) FROM {e['tabela']} t WHERE t.{e['id2']}=x.identificador AND t.{e['descricao']}={e['filial']}) as qtde FROM {tmp}_pjs x"
+    query = f'''
+        DELETE FROM {tmp}_ligacao WHERE id1=id2;
+        DROP TABLE if exists {tmp}_pjs;
+        CREATE TABLE {tmp}_pjs AS
+        SELECT identificador FROM {tmp}_ids_inicial WHERE identificador LIKE 'PJ^_%' ESCAPE '^'
+        UNION
+        SELECT id1 FROM {tmp}_ligacao WHERE id1 LIKE 'PJ^_%' ESCAPE '^'
+        UNION
+        SELECT id2 FROM {tmp}_ligacao WHERE id2 LIKE 'PJ^_%' ESCAPE '^';
+        DROP TABLE if exists {tmp}_filiais;
+        CREATE TABLE {tmp}_filiais AS
+        SELECT x.identificador, {qtde};
+        DROP TABLE if exists {tmp}_pjs;
+    '''
+    con.executescript(query)
+#.def camadasRede_matriz
+
+def camadasRede_cte(con, tmp, camada, e, filtroTipos, bGrau, qtdeForaDaRede):
+    ''' expansão das camadas numa consulta WITH RECURSIVE (motor_grafo=cte), a partir de {tmp}_nos_inicial.
+        O sqlite não deixa a parte recursiva consultar a própria cte, então os nós já alcançados ficam num conjunto do python:
+        no_novo_cte só aceita o nó na primeira vez que aparece e cada nó é expandido uma vez. Com ORDER BY 2 as linhas saem em ordem de camada,
+        então a primeira vez é a menor camada. expande_cte aplica limite_registros_camada durante a consulta, como o loop de camadasRede_expande.
+        Depois aplica as regras de parada do loop com a contagem de cada camada
+        e preenche {tmp}_nos, {tmp}_lig_rede e {tmp}_truncados_int como o loop. Retorna a mensagem e os nós novos por camada'''
+    alcancados = {r[0] for r in con.execute(f'SELECT identificador FROM {tmp}_nos_inicial')}
+    contagemCamada = {0:len(alcancados)}
+    expandeCamada = {}
+    def noNovo(no, cam):
+        if no in alcancados:
+            return 0
+        alcancados.add(no)
+        contagemCamada[cam] = contagemCamada.get(cam, 0) + 1
+        return 1
+    def expande(cam):
+        #a primeira linha da camada cam só é processada depois de todas as linhas da camada cam-1, então a contagem até cam já está completa
+        if cam not in expandeCamada:
+            expandeCamada[cam] = int(cam==0 or qtdeForaDaRede + sum(contagemCamada.get(c, 0) for c in range(cam+1))<=kLimiteCamada)
+        return expandeCamada[cam]
+    naoExpande = f'AND (a.camada=0 OR NOT EXISTS (SELECT 1 FROM rede.grau g WHERE g.id=a.no AND g.total>{kGrauMaximoNo}))' if bGrau else ''
+    #CASE garante que no_novo_cte só é chamada para ligações que passam nos filtros
+    query = f'''
+        DROP TABLE if exists {tmp}_alcance;
+        CREATE TABLE {tmp}_alcance AS
+        WITH RECURSIVE alcance(no, camada) AS (
+            SELECT identificador, 0 FROM {tmp}_nos_inicial
+            UNION ALL
+            SELECT t.{e['id2']}, a.camada+1
+            FROM alcance a INNER JOIN {e['tabela']} t ON t.{e['id1']}=a.no{filtroTipos}
+            WHERE CASE WHEN a.camada<{camada} AND expande_cte(a.camada) {naoExpande}{filtroTipos} THEN no_novo_cte(t.{e['id2']}, a.camada+1) ELSE 0 END
+            UNION ALL
+            SELECT t.{e['id1']}, a.camada+1
+            FROM alcance a INNER JOIN {e['tabela']} t ON t.{e['id2']}=a.no{filtroTipos}
+            WHERE CASE WHEN a.camada<{camada} AND expande_cte(a.camada) AND t.{e['descricao']}<>{e['filial']} {naoExpande}{filtroTipos} THEN no_novo_cte(t.{e['id1']}, a.camada+1) ELSE 0 END
+            ORDER BY 2
+            LIMIT {kLimiteLinhasCTE}
+        )
+        SELECT no as identificador, camada FROM alcance;
+    '''
+    #as funções guardam o conjunto de nós desta consulta. A conexão volta para o pool, então são removidas no fim
+    con.create_function('no_novo_cte', 2, noNovo)
+    con.create_function('expande_cte', 1, expande)
+    try:
+        con.executescript(query)
+    finally:
+        con.create_function('no_novo_cte', 2, None)
+        con.create_function('expande_cte', 1, None)
+    qtdeLinhas, camadaMaxima = con.execute(f'SELECT count(*), max(camada) FROM {tmp}_alcance').fetchone()
+    nosPorCamada = dict(con.execute(f'SELECT camada, count(*) FROM {tmp}_alcance GROUP BY camada').fetchall())
+    #ORDER BY 2 gera as linhas em ordem de camada. Se parou no limite de linhas, só a última camada pode estar incompleta
+    camadaCortada = camadaMaxima if qtdeLinhas>=kLimiteLinhasCTE else None
+    mensagem = ''
+    tamanhoFronteiras = []
+    ultima = 0 #última camada expandida
+    registrosAnterior = 0
+    registros = nosPorCamada.get(0, 0) + qtdeForaDaRede
+    for cam in range(1, camada+1):
+        if cam==camadaCortada:
+            mensagem += f'A camada {camada} não foi alcançada, pois a consulta excedeu o limite de linhas ({kLimiteLinhasCTE}). Chegou até a camada {cam-1}.'
+            break
+        ultima = cam
+        tamanhoFronteiras.append(nosPorCamada.get(cam, 0))
+        registros += nosPorCamada.get(cam, 0)
+        if registros==registrosAnterior:
+            if cam>1:
+                mensagem += f'A camada {camada} não foi alcançada, pois não havia mais itens além da camada {cam-1}.'
+            break
+        if cam<camada and registros>kLimiteCamada:
+            mensagem += f'A camada {camada} não foi alcançada, pois excedeu o limite de itens por camada ({kLimiteCamada}). Chegou até a camada {cam}.'
+            break
+        registrosAnterior = registros
+    truncados = f'''
+        INSERT INTO {tmp}_truncados_int
+        SELECT a.identificador, g.total FROM {tmp}_alcance a INNER JOIN rede.grau g ON g.id=a.identificador
+        WHERE a.camada>0 AND a.camada<{ultima} AND g.total>{kGrauMaximoNo};''' if bGrau else ''
+    #ligações dos nós expandidos (camadas anteriores à última, menos os truncados), como a soma de {tmp}_lig_camada no loop
+    query = f'''
+        INSERT INTO {tmp}_nos
+        SELECT identificador FROM {tmp}_alcance WHERE camada>0 AND camada<={ultima};
+        {truncados}
+        DROP TABLE if exists {tmp}_expandidos;
+        CREATE TABLE {tmp}_expandidos AS
+        SELECT identificador FROM {tmp}_alcance WHERE camada<{ultima}
+        EXCEPT
+        SELECT identificador FROM {tmp}_truncados_int;
+        INSERT INTO {tmp}_lig_rede
+        SELECT t.{e['id1']}, t.{e['id2']}, t.{e['descricao']}
+        FROM {tmp}_expandidos x INNER JOIN {e['tabela']} t ON t.{e['id1']}=x.identificador{filtroTipos}
+        UNION
+        SELECT t.{e['id1']}, t.{e['id2']}, t.{e['descricao']}
+        FROM {tmp}_expandidos x INNER JOIN {e['tabela']} t ON t.{e['id2']}=x.identificador{filtroTipos}
+        WHERE t.{e['descricao']}<>{e['filial']};
+        DROP TABLE if exists {tmp}_alcance;
+        DROP TABLE if exists {tmp}_expandidos;
+    '''
+    con.executescript(query)
+    return mensagem, tamanhoFronteiras
+#.def camadasRede_cte
+
+def adjacenciaCaminhos(con, tmp, permitidos=None, periodo=None):
+    ''' rede_caminhos.Adjacencia com as ligações de rede.ligacao (no motor_grafo configurado), endereços e base local.
+        permitidos: tipos de ligação de rede.ligacao a seguir (ver tiposPermitidos), None para todos
+        periodo: só ligações de rede.ligacao com data de entrada no período (ver periodoDatas). Usa o sqlite mesmo com motor_grafo csr ou mmap'''
+    tabelasLinks = []
+    if caminhoDBEnderecoNormalizado:
+        rede_conexoes.anexaBase(con, caminhoDBEnderecoNormalizado, 'endereco')
+        tabelasLinks.append('endereco.link_ete')
+    if caminhoDBBaseLocal:
+        rede_conexoes.anexaBase(con, caminhoDBBaseLocal, 'dlocal')
+        tabelasLinks.append('dlocal.links')
+    grafo = None
+    if kMotorGrafo in ('csr', 'mmap') and not periodo:
+        grafo = rede_grafo.grafoCSR(caminhoDBRede) if kMotorGrafo=='csr' else rede_grafo.grafoMmap(caminhoGrafo)
+    e = esquemaLigacao()
+    filtroTipos = filtroTiposSQL(permitidos, f"t.{e['descricao']}") + (filtroDataSQL(periodo, 't.data_entrada') if e['dataEntrada'] else '')
+    codigosGrafo = grafo.codigosTipos(permitidos) if grafo is not None and permitidos is not None else None
+    return rede_caminhos.Adjacencia(con, tmp, e, tabelasLinks, grafo, filtroTipos, codigosGrafo)
+
+def camadasRede_caminhosBFS(con, tmp, camada, criterioCaminhos, permitidos=None, periodo=None):
+    ''' caminhos mais curtos entre os itens de {tmp}_ids_inicial com rede_caminhos.buscaCaminhos. 
+        Cria as mesmas tabelas {tmp}_ligacao e {tmp}_origem_destino_grupo que camadasRede_caminhos. Retorna a mensagem'''
+    tinicial = time.time()
+    adjacencia = adjacenciaCaminhos(con, tmp, permitidos, periodo)
+    rotulos = con.execute(f'SELECT DISTINCT identificador, grupo FROM {tmp}_ids_inicial ORDER BY identificador').fetchall()
+    componentes = None
+    if indiceComponentes(): #pares sem ligação nenhuma entre si não são buscados
+        componentes = {i:c for i, (c, _) in componentesDosIds(con, [r[0] for r in rotulos]).items()}
+    linhas, mensagem, tamanhoFronteiras = rede_caminhos.buscaCaminhos(adjacencia, rotulos, criterioCaminhos, camada, kLimiteCamada, kTempoMaxConsulta, componentes)
+    query = f'''
+        DROP TABLE if exists {tmp}_caminhos_fronteira;
+        DROP TABLE if exists {tmp}_ligacao;
+        CREATE TABLE {tmp}_ligacao (id1, id2, descricao, camada, id_origem, id_destino, grupo_origem, grupo_destino, camada_caminho);
+    '''
+    con.executescript(query)
+    con.executemany(f'INSERT INTO {tmp}_ligacao VALUES (?,?,?,?,?,?,?,?,?)', linhas)
+    query = f'''
+        DROP TABLE if exists {tmp}_origem_destino_grupo;
+        CREATE TABLE {tmp}_origem_destino_grupo AS
+        SELECT DISTINCT id_origem, id_destino, grupo_origem, grupo_destino, camada_caminho
+        FROM {tmp}_ligacao;
+    '''
+    con.executescript(query)
+    print(time.asctime(), f'camadasRede_caminhosBFS ({kMotorGrafo}): nós novos por camada {tamanhoFronteiras}, {time.time()-tinicial:.3f}s')
+    return mensagem
+#.def camadasRede_caminhosBFS
+
+kMaximoCaminhos = config.config['ETC'].getint('maximo_caminhos', 100) #quantidade máxima de caminhos retornados por caminhosEntreDois
+kLimiteItensCaminhos = config.config['ETC'].getint('limite_itens_caminhos', 100000) #itens visitados pela busca bidirecional
+
+@timeit
+def caminhosEntreDois(origem, destino, profundidade=6, k=0, tipos=None, excluirTipos=None, periodo=None):
+    ''' caminhos entre dois itens, para /rede/api/paths. k=0: todos os caminhos mais curtos (até kMaximoCaminhos). 
+        k>0: os k caminhos simples mais curtos. Os caminhos vêm em ordem de comprimento, com posicao começando em 1.
+        tipos/excluirTipos/periodo: filtro dos tipos de ligação e das datas de entrada, como em camadasRede'''
+    ids = []
+    for item in (origem, destino):
+        cids = separaEntrada([item])[0]
+        if len(cids)!=1:
+            return {'caminhos':[], 'mensagem':f'O item {item} deve corresponder a um único identificador (encontrados: {len(cids)}).'}
+        ids.append(cids.pop())
+    permitidos, naoEncontrados = tiposPermitidos(tipos, excluirTipos)
+    mensagem = f'Tipos de ligação não encontrados: {", ".join(naoEncontrados)}.' if naoEncontrados else ''
+    bIncompleto = False
+    caminhos = []
+    con = gPool.obtem()
+    try:
+        if indiceComponentes():
+            componentes = componentesDosIds(con, ids)
+            if componentes[ids[0]][0]!=componentes[ids[1]][0]:
+                return {'origem':ids[0], 'destino':ids[1], 'caminhos':[], 'mensagem':'Os itens não estão ligados por nenhum caminho.'}
+        if kTempoLimiteConsulta:
+            rede_conexoes.definePrazo(con, time.time() + kTempoLimiteConsulta)
+        adjacencia = rede_caminhos.AdjacenciaCache(adjacenciaCaminhos(con, tabelaTemp(), permitidos, periodo))
+        if k>0:
+            gerador = rede_caminhos.kCaminhosMaisCurtos(adjacencia, ids[0], ids[1], min(k, kMaximoCaminhos), profundidade, limiteNos=kLimiteItensCaminhos)
+        else:
+            gerador = itertools.islice(rede_caminhos.todosCaminhosMaisCurtos(adjacencia, ids[0], ids[1], profundidade, limiteNos=kLimiteItensCaminhos), kMaximoCaminhos)
+        try:
+            for caminho in gerador:
+                caminhos.append({'posicao':len(caminhos)+1, 'comprimento':len(caminho)-1, 'nos':caminho,
+                                 'ligacoes':[{'origem':id1, 'destino':id2, 'label':descricao} for id1, id2, descricao in rede_caminhos.ligacoesDoCaminho(adjacencia, caminho)]})
+        except rede_caminhos.LimiteExcedido:
+            mensagem += f'A busca parou, pois excedeu o limite de itens visitados ({kLimiteItensCaminhos}).'
+            bIncompleto = True
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            mensagem += f'A busca foi interrompida, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s).'
+            bIncompleto = True
+    finally:
+        gPool.devolve(con)
+    if not caminhos and not bIncompleto:
+        mensagem += f'Não foi encontrado caminho com até {profundidade} ligações.'
+    elif k<=0 and len(caminhos)==kMaximoCaminhos:
+        mensagem += f'Foram retornados só os primeiros {kMaximoCaminhos} caminhos mais curtos.'
+    resultado = {'origem':ids[0], 'destino':ids[1], 'caminhos':caminhos, 'mensagem':mensagem}
+    if bIncompleto:
+        resultado['incompleto'] = True
+    return resultado
+#.def caminhosEntreDois
 
 @timeit
 def camadasRede_caminhos(con, tmp, camada, criterioCaminhos):
     #Rotina de caminhos
+    #os identificadores e descrições são trocados por inteiros de um dicionário local ({tmp}_no, {tmp}_tipo), 
+    #para os joins abaixo compararem inteiros. A ordem dos números é a mesma dos textos, para manter o critério t1.id_origem<t2.id_origem
+    query = f'''
+        DROP TABLE if exists {tmp}_no;
+        CREATE TABLE {tmp}_no (id INTEGER PRIMARY KEY, ident TEXT UNIQUE);
+        INSERT INTO {tmp}_no (ident)
+        SELECT identificador FROM {tmp}_ids_inicial
+        UNION
+        SELECT id1 FROM {tmp}_ligacao
+        UNION
+        SELECT id2 FROM {tmp}_ligacao
+        ORDER BY 1;
+        DROP TABLE if exists {tmp}_tipo;
+        CREATE TABLE {tmp}_tipo (id INTEGER PRIMARY KEY, descricao TEXT UNIQUE);
+        INSERT INTO {tmp}_tipo (descricao)
+        SELECT DISTINCT descricao FROM {tmp}_ligacao;
+
+        ALTER TABLE {tmp}_ligacao RENAME TO {tmp}_ligacao_texto;
+        CREATE TABLE {tmp}_ligacao AS
+        SELECT n1.id as id1, n2.id as id2, tt.id as descricao
+        FROM {tmp}_ligacao_texto t
+        INNER JOIN {tmp}_no n1 ON n1.ident=t.id1
+        INNER JOIN {tmp}_no n2 ON n2.ident=t.id2
+        INNER JOIN {tmp}_tipo tt ON tt.descricao IS t.descricao;
+        DROP TABLE {tmp}_ligacao_texto;
+
+        ALTER TABLE {tmp}_ids_inicial RENAME TO {tmp}_ids_inicial_texto;
+        CREATE TABLE {tmp}_ids_inicial AS
+        SELECT n1.id as identificador, t.grupo, n2.id as id_origem, t.camada
+        FROM {tmp}_ids_inicial_texto t
+        INNER JOIN {tmp}_no n1 ON n1.ident=t.identificador
+        INNER JOIN {tmp}_no n2 ON n2.ident=t.id_origem;
+    '''
+    con.executescript(query)
     #repete rede para os itens, mas agora coletando dados sobre grupo, id_origem e camada
     query = f'''
 
@@ -878,15 +1904,34 @@ def camadasRede_caminhos(con, tmp, camada, criterioCaminhos):
             
     '''
     con.executescript(query)
+    query = f'''
+            --volta para texto
+            ALTER TABLE {tmp}_ligacao RENAME TO {tmp}_ligacao_int;
+            CREATE TABLE {tmp}_ligacao AS
+            SELECT n1.ident as id1, n2.ident as id2, tt.descricao, t.camada, no.ident as id_origem, nd.ident as id_destino, t.grupo_origem, t.grupo_destino, t.camada_caminho
+            FROM {tmp}_ligacao_int t
+            INNER JOIN {tmp}_no n1 ON n1.id=t.id1
+            INNER JOIN {tmp}_no n2 ON n2.id=t.id2
+            INNER JOIN {tmp}_no no ON no.id=t.id_origem
+            INNER JOIN {tmp}_no nd ON nd.id=t.id_destino
+            INNER JOIN {tmp}_tipo tt ON tt.id=t.descricao;
+
+            ALTER TABLE {tmp}_origem_destino_grupo RENAME TO {tmp}_origem_destino_grupo_int;
+            CREATE TABLE {tmp}_origem_destino_grupo AS
+            SELECT no.ident as id_origem, nd.ident as id_destino, t.grupo_origem, t.grupo_destino, t.camada_caminho
+            FROM {tmp}_origem_destino_grupo_int t
+            INNER JOIN {tmp}_no no ON no.id=t.id_origem
+            INNER JOIN {tmp}_no nd ON nd.id=t.id_destino;
+
+            DROP TABLE {tmp}_ids_inicial;
+            ALTER TABLE {tmp}_ids_inicial_texto RENAME TO {tmp}_ids_inicial;
+    '''
+    con.executescript(query)
 #.def camadasRede_caminhos
 
 #@timeit
 #def camadasRede_json(camadasIds, cam, camada, mensagem, con, tmp, bCaminhos=False):
-def camadasRede_json(con, tmp, camadasIds, mensagem,  bCaminhos=False):
-    nosaux = []
-    ligacoes = []        
-    sno = set()
-    #if cam: 
+def camadasRede_atualizaIds(con, tmp, bCaminhos):
     query = f''' --atualiza {tmp}_ids para buscar dados de cnpjs
             DROP TABLE if exists {tmp}_ids;
             CREATE TABLE {tmp}_ids AS
@@ -900,6 +1945,119 @@ def camadasRede_json(con, tmp, camadasIds, mensagem,  bCaminhos=False):
             
     '''
     con.executescript(query)
+#.def camadasRede_atualizaIds
+
+def camadasRede_dicGrupo(con, tmp):
+    query = f'''Select distinct identificador as id, group_concat(grupo) as grupo from {tmp}_ids_inicial group by identificador'''
+    dgrupo = pd.read_sql(query, con)
+    return pd.Series(dgrupo.grupo.values, index=dgrupo.id).to_dict()
+
+def nosSemCNPJ(nos, camadasIds, dicGrupo):
+    ''' nós PF_, PE_ e outros, com dados tirados do próprio identificador'''
+    for n in nos:
+        if n not in camadasIds:
+            camadasIds[n] = 1 #não está calculando camadas... só distinguindo o que é camada 0 ou não
+        if not n.startswith('PJ_'):
+            descricao = ''
+            if n.startswith('PF_'):
+                _, descricao = id2cpfnome(n) #kid[15:] 
+            elif n.startswith('PE_'): 
+                descricao = '(EMPRESA SÓCIA NO EXTERIOR)'
+            no = {'id': n, 'descricao':descricao, 
+                    'camada': camadasIds.get(n,1),
+                    } #, 
+            if n in dicGrupo:
+                no['nota'] = dicGrupo[n]
+            yield no
+#.def nosSemCNPJ
+
+def nosForaDaLigacao(camadasIds, sno):
+    ''' itens da camada 0 que não aparecem na tabela de ligacao rede.db (mas pode estar em outras, como links.db)'''
+    for n in set(camadasIds).difference(sno):
+        #no = {'id': n, 'descricao':'', 'camada': camadasIds.get(n,1)} #, 
+        if n[:3] in ('PF_', 'PJ_', 'ID_', 'EN_', 'EM_', 'TE_'):
+            continue
+        yield {'id': n, 'descricao': '', 
+              'camada': camadasIds.get(n,1), 'tipo':0, 'situacao_ativa': True,
+              #'logradouro': '',
+              #'municipio': '', 'uf': '',  
+              'cod_nat_juridica':''
+              }
+#.def nosForaDaLigacao
+
+def marcaTruncados(nos, truncados):
+    ''' nós que não foram expandidos por terem muitas ligações. A interface pode expandir o nó depois, como item de entrada'''
+    if truncados:
+        for no in nos:
+            if no['id'] in truncados:
+                no['grau'] = truncados[no['id']]
+                no['truncado'] = True
+    return nos
+
+def marcaFiliais(nos, filiais):
+    ''' modo somenteMatriz: quantidade de filiais de cada cnpj, que não aparecem como nós'''
+    if filiais:
+        for no in nos:
+            if no['id'] in filiais:
+                no['qtde_filiais'] = filiais[no['id']]
+    return nos
+
+def camadasRede_filiais(con, tmp):
+    try:
+        return dict(con.execute(f'SELECT identificador, qtde FROM {tmp}_filiais').fetchall())
+    except sqlite3.OperationalError: #tabela só é criada no modo somenteMatriz
+        return {}
+
+def camadasRede_truncados(con, tmp):
+    try:
+        return dict(con.execute(f'SELECT identificador, grau FROM {tmp}_truncados').fetchall())
+    except sqlite3.OperationalError: #tabela não criada (busca de caminhos)
+        return {}
+
+def camadasRede_blocos(con, tmp, camadasIds, bCaminhos=False, tamanhoBloco=kTamanhoBlocoNDJSON):
+    ''' gera (chave, lista) em blocos de tamanhoBloco: primeiro as ligações, depois os nós e por fim origem_destino.
+        Usado na resposta em streaming, sem montar o grafo inteiro na memória'''
+    camadasRede_atualizaIds(con, tmp, bCaminhos)
+    sno = set()
+    bloco = []
+    for row in con.execute(f''' SELECT id1 as origem, id2 as destino, descricao as label from {tmp}_ligacao'''):
+        bloco.append({'origem':row[0], 'destino':row[1], 'label':row[2], 'cor':'silver', 'camada':0, 'tipoDescricao':''})
+        sno.add(row[0])
+        sno.add(row[1])
+        if len(bloco)>=tamanhoBloco:
+            yield 'ligacao', bloco
+            bloco = []
+    if bloco:
+        yield 'ligacao', bloco
+    dicGrupo = camadasRede_dicGrupo(con, tmp)
+    #os dados da base local e os nós das empresas são buscados depois de nosSemCNPJ, que completa camadasIds
+    nosIniciais = list(nosSemCNPJ(sno, camadasIds, dicGrupo))
+    if not bCaminhos:
+        nosIniciais.extend(nosForaDaLigacao(camadasIds, sno))
+    dicDados = jsonDadosBaseLocalDic(listaIds=list(camadasIds), tmp=tmp, con=con) if caminhoDBBaseLocal else {}
+    truncados = camadasRede_truncados(con, tmp)
+    filiais = camadasRede_filiais(con, tmp)
+    bloco = []
+    for no in itertools.chain(nosIniciais, nosDosCNPJs(camadasIds, tmp, con, dicGrupo)):
+        no.update(dicDados.get(no['id'], {}))
+        bloco.append(no)
+        if len(bloco)>=tamanhoBloco:
+            yield 'no', marcaFiliais(marcaTruncados(ajustaLabelIcone(bloco), truncados), filiais)
+            bloco = []
+    if bloco:
+        yield 'no', marcaFiliais(marcaTruncados(ajustaLabelIcone(bloco), truncados), filiais)
+    if bCaminhos:
+        dod = pd.read_sql(f''' SELECT * from {tmp}_origem_destino_grupo''', con)
+        for k in range(0, len(dod), tamanhoBloco):
+            yield 'origem_destino', dod.iloc[k:k+tamanhoBloco].to_dict('records')
+#.def camadasRede_blocos
+
+def camadasRede_json(con, tmp, camadasIds, mensagem,  bCaminhos=False):
+    nosaux = []
+    ligacoes = []        
+    sno = set()
+    #if cam: 
+    camadasRede_atualizaIds(con, tmp, bCaminhos)
     #if camada>0:
     # queryLigacao = f''' SELECT id1 as origem, id2 as destino, descricao as label from {tmp}_ligacao'''
     # dlaux= pd.read_sql(queryLigacao, con)[['origem','destino','label']]
@@ -930,40 +2088,13 @@ def camadasRede_json(con, tmp, camadasIds, mensagem,  bCaminhos=False):
     # dnoaux = pd.read_sql(queryNos, con)
     # sno.update(dnoaux['id'])
         
-    query = f'''Select distinct identificador as id, group_concat(grupo) as grupo from {tmp}_ids_inicial group by identificador'''
-    dgrupo = pd.read_sql(query, con)
-    dicGrupo = pd.Series(dgrupo.grupo.values, index=dgrupo.id).to_dict()
-    
-    for n in sno:
-        if n not in camadasIds:
-            camadasIds[n] = 1 #não está calculando camadas... só distinguindo o que é camada 0 ou não
-        if not n.startswith('PJ_'):
-            descricao = ''
-            if n.startswith('PF_'):
-                _, descricao = id2cpfnome(n) #kid[15:] 
-            elif n.startswith('PE_'): 
-                descricao = '(EMPRESA SÓCIA NO EXTERIOR)'
-            no = {'id': n, 'descricao':descricao, 
-                    'camada': camadasIds.get(n,1),
-                    } #, 
-            if n in dicGrupo:
-                no['nota'] = dicGrupo[n]
-            nosaux.append(copy.deepcopy(no))    
+    dicGrupo = camadasRede_dicGrupo(con, tmp)
+    nosaux.extend(nosSemCNPJ(sno, camadasIds, dicGrupo))
     
     #print('diferença', set(camadasIds).difference(sno))
     #bAdicionaItensQueNaoAparecemNaTabelaDeLigacao = True
     if not bCaminhos: #se não for busca por caminhos, adiciona itens da camada 0
-        for n in set(camadasIds).difference(sno): #adiciona itens que não aparecem na tabela de ligacao rede.db (mas pode estar em outras, como links.db)
-            #no = {'id': n, 'descricao':'', 'camada': camadasIds.get(n,1)} #, 
-            if n[:3] in ('PF_', 'PJ_', 'ID_', 'EN_', 'EM_', 'TE_'):
-                continue
-            no = {'id': n, 'descricao': '', 
-                  'camada': camadasIds.get(n,1), 'tipo':0, 'situacao_ativa': True,
-                  #'logradouro': '',
-                  #'municipio': '', 'uf': '',  
-                  'cod_nat_juridica':''
-                  }
-            nosaux.append(copy.deepcopy(no))
+        nosaux.extend(nosForaDaLigacao(camadasIds, sno))
 
     # cnpjs = {n.removeprefix('PJ_') for n in camadasIds.keys() if n.startswith('PJ_')} #usar sno ao inves de camadasIds.keys pula ligações
     # if cnpjs:
@@ -992,6 +2123,8 @@ def camadasRede_json(con, tmp, camadasIds, mensagem,  bCaminhos=False):
     dadosDosNosCNPJs(nosaux=nosaux, camadasIds=camadasIds, tmp=tmp, con=con, dicGrupo=dicGrupo)
     dadosDosNosBaseLocal(nosaux, camadasIds, tmp=tmp, con=con)
     nosaux=ajustaLabelIcone(nosaux)
+    marcaTruncados(nosaux, camadasRede_truncados(con, tmp))
+    marcaFiliais(nosaux, camadasRede_filiais(con, tmp))
     if bCaminhos: #adiciona no json tabela de achados
         queryLigacao = f''' SELECT * from {tmp}_origem_destino_grupo'''
         dod= pd.read_sql(queryLigacao, con)    
@@ -1020,8 +2153,14 @@ def dadosDosNosBaseLocal(nosInOut, camadasIds, tmp=None, con=None):
 #@timeit
 #def dadosDosNosCNPJs(cnpjs, nosaux, camadasIds, tmp, con):
 def dadosDosNosCNPJs(nosaux, camadasIds, tmp, con, dicGrupo=None):
+    nosaux.extend(nosDosCNPJs(camadasIds, tmp, con, dicGrupo))
+    nos = nosaux #nosaux[::-1] #inverte, assim os nos de camada menor serao inseridas depois, ficando na frente
+    nosaux = nos.sort(key=lambda n: n['camada'], reverse=True) #inverte ordem, porque os últimos icones vão aparecer na frente. Talvez na prática não seja útil.   
+#.def dadosDosNosCNPJs
 
-    con.execute("ATTACH DATABASE '" + caminhoDBReceita.replace('\\','/') + "' as " + 'cnpj')
+def nosDosCNPJs(camadasIds, tmp, con, dicGrupo=None):
+    ''' gera os nós PJ_ de {tmp}_ids com os dados da base cnpj'''
+    rede_conexoes.anexaBase(con, caminhoDBReceita, 'cnpj')
     con.row_factory=sqlite3.Row
     cur = con.cursor()
     query = f'''                
@@ -1085,7 +2224,7 @@ def dadosDosNosCNPJs(nosaux, camadasIds, tmp, con, dicGrupo=None):
         if dicGrupo:
             if no['id'] in dicGrupo:
                 no['nota'] = dicGrupo[no['id']]
-        nosaux.append(copy.deepcopy(no))
+        yield no
         #setCNPJsRecuperados.add(k['cnpj'])
     #trata caso excepcional com base de teste, cnpj que é sócio não tem registro na tabela empresas
     # if False:
@@ -1100,13 +2239,31 @@ def dadosDosNosCNPJs(nosaux, camadasIds, tmp, con, dicGrupo=None):
     #         nosaux.append(copy.deepcopy(no))
     #ajusta nos, colocando label
     #nosaux=ajustaLabelIcone(nosaux)
-    
-    nos = nosaux #nosaux[::-1] #inverte, assim os nos de camada menor serao inseridas depois, ficando na frente
-    nosaux = nos.sort(key=lambda n: n['camada'], reverse=True) #inverte ordem, porque os últimos icones vão aparecer na frente. Talvez na prática não seja útil.   
-#.def dadosDosNosCNPJs
+    cur.close()
+#.def nosDosCNPJs
+
+def estimaCustoLink(con, tmp, tabela, camada, numeroItens):
+    ''' estimativa de ligações lidas em cada camada de camadaLink. A camada 1 é a contagem das ligações dos itens de entrada. 
+        Nas seguintes, a quantidade de itens é limitada pelo LIMIT da consulta (numeroItens), e cada item tem o grau médio dos itens de entrada'''
+    qtdeSementes = con.execute(f'SELECT count(DISTINCT identificador) FROM {tmp}_ids').fetchone()[0]
+    query = f'''
+        WITH s AS (SELECT DISTINCT identificador FROM {tmp}_ids)
+        SELECT (SELECT count(*) FROM s INNER JOIN {tabela} t ON t.id1=s.identificador)
+             + (SELECT count(*) FROM s INNER JOIN {tabela} t ON t.id2=s.identificador)
+    '''
+    custos = [con.execute(query).fetchone()[0]]
+    media = custos[0]/qtdeSementes if qtdeSementes else 0
+    limite = numeroItens
+    while len(custos)<camada:
+        itens = min(custos[-1], 2*limite) if limite else custos[-1] #cada ligação lida acrescenta no máximo dois itens
+        custos.append(itens*media)
+        limite = limite * numeroItens * 2
+    return custos
+#.def estimaCustoLink
 
 #@timeit
 #def camadaLink(cpfcnpjIn='', conCNPJ=None, camada=1, numeroItens=15, 
+@cacheResultado
 def camadaLink(listaIds=None, conCNPJ=None, camada=1, numeroItens=15, 
                valorMinimo=0, valorMaximo=0, grupo='', bjson=True, 
                tipoLink='link'):    
@@ -1161,7 +2318,15 @@ def camadaLink(listaIds=None, conCNPJ=None, camada=1, numeroItens=15,
     #passo = numeroItens*2 #15
     #cnt1 = collections.Counter() #contadores de links para o id1 e id2
     #cnt2 = collections.Counter()    
+    if kOrcamentoLigacoes and camada>0:
+        camada, mensagem = admissaoConsulta(estimaCustoLink(con, tmp, tabela, camada, numeroItens), camada)
+        if camada is None:
+            gPool.devolve(con)
+            return {'no': [], 'ligacao':[], 'mensagem':mensagem, 'incompleto':True}
     tempoInicio = time.time()
+    bIncompleto = False
+    if kTempoLimiteConsulta:
+        rede_conexoes.definePrazo(con, tempoInicio + kTempoLimiteConsulta)
     registrosAnterior = -1
     cntlink = collections.Counter()
     for cam in range(1, camada+1):       
@@ -1178,57 +2343,64 @@ def camadaLink(listaIds=None, conCNPJ=None, camada=1, numeroItens=15,
         
 
         #cur.execute(query + ' LIMIT ' + str(limite) if limite else query)
-        if limite:
-            cur.execute(query + ' LIMIT :limite', {'limite':limite})
-        else:
-            cur.execute(query)
-        for k in cur:
+        try:
+            if limite:
+                cur.execute(query + ' LIMIT :limite', {'limite':limite})
+            else:
+                cur.execute(query)
+            for k in cur:
             
-            #k=dict(zip(colsname,k1))
-            if not(k['id1']) or not(k['id2']):
-                print('####link invalido!!!', k['id1'], k['id2'], k['descricao'], k['valor'])
-                continue #caso a tabela esteja inconsistente
-            #limita a quantidade de ligacoes por item
-            if numeroItens>0:
-                if cntlink[k['id1']]>numeroItens or cntlink[k['id2']]>numeroItens:
-                    continue
-            if valorMinimo:
-                if k['valor']<valorMinimo:
-                     continue
-            if valorMaximo:
-                if valorMaximo < k['valor']:
-                    continue
-            cntlink[k['id1']] += 1
-            cntlink[k['id2']] += 1
+                #k=dict(zip(colsname,k1))
+                if not(k['id1']) or not(k['id2']):
+                    print('####link invalido!!!', k['id1'], k['id2'], k['descricao'], k['valor'])
+                    continue #caso a tabela esteja inconsistente
+                #limita a quantidade de ligacoes por item
+                if numeroItens>0:
+                    if cntlink[k['id1']]>numeroItens or cntlink[k['id2']]>numeroItens:
+                        continue
+                if valorMinimo:
+                    if k['valor']<valorMinimo:
+                         continue
+                if valorMaximo:
+                    if valorMaximo < k['valor']:
+                        continue
+                cntlink[k['id1']] += 1
+                cntlink[k['id2']] += 1
             
-            if k['id1'] not in camadasIds:
-                camadasIds[k['id1']] = cam           
-            if k['id2'] not in camadasIds:
-                camadasIds[k['id2']] = cam
-            #neste caso, não deve haver ligação repetida, mas é necessário colocar uma verificação se for ligações generalizadas
-            # if orig_destAnt == ('PJ_'+k['cnpj'], destino):
-            #     print('repetiu ligacao', orig_destAnt)
-            # orig_destAnt = ('PJ_'+k['cnpj'], destino)
-            if (k['id1'], k['id2']) not in setLigacoes: #cam+1==camada and bjson: #só pega dados na última camada
-                # ligacao = {"origem":k['id1'], "destino":k['id2'], 
-                #            "cor": "silver" if  tipoLink=='endereco' else "gold", #"cor":"gray", 
-                #            "camada":cam+1, "tipoDescricao":'link',"label":k['descricao'] + ':' + ajustaValor(k['valor'], bValorInteiro)}
-                ligacao = {"origem":k['id1'], "destino":k['id2'], 
-                           "cor": "silver" if  tipoLink=='endereco' else "gold", #"cor":"gray", 
-                           "camada":cam} #"label":k['descricao'] + ':' + ajustaValor(k['valor'], bValorInteiro)}
-                if tipoLink=='endereco':
-                    ligacao['tipoDescricao'] = k['descricao']
-                    ligacao['label'] = k['descricao']
-                elif tipoLink=='base_local':
-                    ligacao['label'] = k['descricao'] 
-                    ligacao['tipoDescricao'] = 'base_local'
+                if k['id1'] not in camadasIds:
+                    camadasIds[k['id1']] = cam           
+                if k['id2'] not in camadasIds:
+                    camadasIds[k['id2']] = cam
+                #neste caso, não deve haver ligação repetida, mas é necessário colocar uma verificação se for ligações generalizadas
+                # if orig_destAnt == ('PJ_'+k['cnpj'], destino):
+                #     print('repetiu ligacao', orig_destAnt)
+                # orig_destAnt = ('PJ_'+k['cnpj'], destino)
+                if (k['id1'], k['id2']) not in setLigacoes: #cam+1==camada and bjson: #só pega dados na última camada
+                    # ligacao = {"origem":k['id1'], "destino":k['id2'], 
+                    #            "cor": "silver" if  tipoLink=='endereco' else "gold", #"cor":"gray", 
+                    #            "camada":cam+1, "tipoDescricao":'link',"label":k['descricao'] + ':' + ajustaValor(k['valor'], bValorInteiro)}
+                    ligacao = {"origem":k['id1'], "destino":k['id2'], 
+                               "cor": "silver" if  tipoLink=='endereco' else "gold", #"cor":"gray", 
+                               "camada":cam} #"label":k['descricao'] + ':' + ajustaValor(k['valor'], bValorInteiro)}
+                    if tipoLink=='endereco':
+                        ligacao['tipoDescricao'] = k['descricao']
+                        ligacao['label'] = k['descricao']
+                    elif tipoLink=='base_local':
+                        ligacao['label'] = k['descricao'] 
+                        ligacao['tipoDescricao'] = 'base_local'
+                    else:
+                        ligacao['label'] = k['descricao'] + ': ' + ajustaValor(k['valor'], bValorInteiro)
+                        ligacao['tipoDescricao'] = k['descricao'] 
+                    ligacoes.append(copy.deepcopy(ligacao))
+                    setLigacoes.add((k['id1'], k['id2']))
                 else:
-                    ligacao['label'] = k['descricao'] + ': ' + ajustaValor(k['valor'], bValorInteiro)
-                    ligacao['tipoDescricao'] = k['descricao'] 
-                ligacoes.append(copy.deepcopy(ligacao))
-                setLigacoes.add((k['id1'], k['id2']))
-            else:
-                print('####ligacao repetida. A implementar')
+                    print('####ligacao repetida. A implementar')
+        except sqlite3.OperationalError as err:
+            if not rede_conexoes.consultaInterrompida(err):
+                raise
+            mensagem += f'A camada {cam} foi interrompida, pois excedeu o tempo limite de consulta ({kTempoLimiteConsulta}s). O resultado está incompleto.'
+            bIncompleto = True
+            break
         #.for k in con.execute(query):
         listaProximaCamada = [item for item in camadasIds if camadasIds[item]>cam-1]
         dftmptable = pd.DataFrame({'identificador' : listaProximaCamada})
@@ -1242,17 +2414,18 @@ def camadaLink(listaIds=None, conCNPJ=None, camada=1, numeroItens=15,
         registros = con.execute(f'select count(*) from {tmp}_ids').fetchone()[0]
         if cam<camada:
             if registros>kLimiteCamada:
-                mensagem=f'A camada {camada} não foi alcançada, pois excedeu o limite de itens. Chegou até a camada {cam}.'
+                mensagem += f'A camada {camada} não foi alcançada, pois excedeu o limite de itens. Chegou até a camada {cam}.'
                 break
             if registros==registrosAnterior and cam>1:
-                mensagem = f'A camada {camada} não foi alcançada,  pois não havia mais itens. Chegou na camada {cam-1}.'
+                mensagem += f'A camada {camada} não foi alcançada,  pois não havia mais itens. Chegou na camada {cam-1}.'
                 break
             if (time.time()-tempoInicio)>kTempoMaxConsulta:
                 #print('xxx', time.time()-tempoInicio)
-                mensagem=f'A camada {camada} não foi alcançada, pois excedeu o tempo máximo de consulta. Chegou até a camada {cam}.'
+                mensagem += f'A camada {camada} não foi alcançada, pois excedeu o tempo máximo de consulta. Chegou até a camada {cam}.'
                 break
         registrosAnterior = registros
     #.for cam in range(1, camada+1):
+    rede_conexoes.removePrazo(con)
 
     for c in camadasIds:
         if c.startswith('PJ_'):
@@ -1278,8 +2451,9 @@ def camadaLink(listaIds=None, conCNPJ=None, camada=1, numeroItens=15,
     dadosDosNosBaseLocal(nosaux, camadasIds, tmp=tmp, con=con)
     nosaux=ajustaLabelIcone(nosaux)
     textoJson={'no': nosaux, 'ligacao':ligacoes, 'mensagem':mensagem} 
-    con.close()
-    con = None
+    if bIncompleto:
+        textoJson['incompleto'] = True
+    gPool.devolve(con)
 
     #apagaTabelasTemporarias(tmp, camDB)
     return textoJson
@@ -1336,12 +2510,12 @@ def jsonDadosReceita(cnpjlista, bsocios=False):
         querySocios = '''
             SELECT t.cnpj, t.cnpj_cpf_socio, t.nome_socio, sq.descricao as cod_qualificacao, 
                 t.data_entrada_sociedade, t.pais, tpais.descricao as pais_, t.representante_legal, t.nome_representante, t.qualificacao_representante_legal, sq2.descricao as qualificacao_representante_legal_, t.faixa_etaria
-            FROM estabelecimento tt       
-            left join socios t on tt.cnpj=t.cnpj
-            LEFT JOIN empresas te on te.cnpj_basico=tt.cnpj_basico
-            LEFT JOIN qualificacao_socio sq ON sq.codigo=t.qualificacao_socio
-            LEFT JOIN qualificacao_socio sq2 ON sq2.codigo=t.qualificacao_representante_legal
-            left join pais tpais on tpais.codigo=t.pais
+            FROM cnpj.estabelecimento tt       
+            left join cnpj.socios t on tt.cnpj=t.cnpj
+            LEFT JOIN cnpj.empresas te on te.cnpj_basico=tt.cnpj_basico
+            LEFT JOIN cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_socio
+            LEFT JOIN cnpj.qualificacao_socio sq2 ON sq2.codigo=t.qualificacao_representante_legal
+            left join cnpj.pais tpais on tpais.codigo=t.pais
             where 
         '''
     
@@ -1355,12 +2529,12 @@ def jsonDadosReceita(cnpjlista, bsocios=False):
         ##prestar atenção no query plan, que altera quando tem um fica diferente quanto tem mais elementos
     query = '''
         select t.*, te.*, ifnull(tm.descricao,t.nome_cidade_exterior) as municipio_texto, tpais.descricao as pais_, tsimples.opcao_mei
-        from estabelecimento t
+        from cnpj.estabelecimento t
         
-        left join empresas te on te.cnpj_basico=t.cnpj_basico
-        left join municipio tm on tm.codigo=t.municipio
-        left join simples tsimples on tsimples.cnpj_basico=t.cnpj_basico
-        left join pais tpais on tpais.codigo=t.pais
+        left join cnpj.empresas te on te.cnpj_basico=t.cnpj_basico
+        left join cnpj.municipio tm on tm.codigo=t.municipio
+        left join cnpj.simples tsimples on tsimples.cnpj_basico=t.cnpj_basico
+        left join cnpj.pais tpais on tpais.codigo=t.pais
         where ''' 
     if len(cnpjlista)==1:
         query += 't.cnpj=?'
@@ -1373,7 +2547,7 @@ def jsonDadosReceita(cnpjlista, bsocios=False):
 				'ddd1', 'telefone1', 'ddd2', 'telefone2', 'ddd_fax', 'fax', 'correio_eletronico', 'capital_social'
 				]
     
-    con = sqlite3.connect(caminhoDBReceita, uri=True)    
+    con = gPool.obtem()
     con.row_factory=sqlite3.Row
     cur = con.cursor()    
     
@@ -1444,7 +2618,8 @@ def jsonDadosReceita(cnpjlista, bsocios=False):
     #print('jsonDados-fim: ' + time.ctime())   
     # if proximo==-1:
     #     da['proximo_cnpj'] = cnpjin
-    con = None
+    cur.close()
+    gPool.devolve(con)
     return dlista
 #.def jsonDadosReceita
 
@@ -1455,8 +2630,9 @@ def jsonDadosBaseLocalDic(listaIds=None, tmp=None, con=None):
     if not listaIds: #and not cpfcnpjIn:
         return {}
 
+    bConexaoPropria = not con
     if  con:
-        con.execute("ATTACH DATABASE '" + caminhoDBBaseLocal.replace('\\','/') + "' as dlocal") 
+        rede_conexoes.anexaBase(con, caminhoDBBaseLocal, 'dlocal')
     else:
         con, camadasIds_, cnpjs_, cpfnomes_, tmp = criaTabelasTmpParaCamadas(caminhoDBBaseLocal, 'dlocal', listaIds=listaIds, grupo='', prefixo_tabela_temporaria='')    
     #with contextlib.closing(con) as con1:
@@ -1502,7 +2678,8 @@ def jsonDadosBaseLocalDic(listaIds=None, tmp=None, con=None):
                 dicLista[k['id']]=copy.deepcopy(daux)
         cur.close()
     #con.execute(f'Drop table if exists {tmp}_idsj')
-    #con = None
+    if bConexaoPropria:
+        gPool.devolve(con)
     return dicLista
 #.def jsonDadosBaseLocalDic
 
@@ -1593,6 +2770,7 @@ def carregaJSONemBaseLocal(nosLigacoes, comentario=''):
     dftmptable = pd.DataFrame(listaLigacao, columns = ['id1', 'id2', 'descricao','valor', 'comentario'])
     dftmptable.to_sql('links', con=con, if_exists='append', index=False) 
     con = None
+    gCache.limpa() #os resultados guardados não têm os dados novos da base local
 #.def carregaJSONemBaseLocal
 
 def junta(a, separador, b):
@@ -1748,8 +2926,7 @@ def dadosParaExportar(dados):
     #writer.close()
     output.seek(0)
     #apagaTabelasTemporarias(tmp)
-    #con.close()
-    con = None
+    gPool.devolve(con)
     return output
 
     #https://github.com/jmcarpenter2/swifter
@@ -1832,11 +3009,11 @@ def mensagemInicial():
 @lru_cache(8)
 def qteEmpresas_referenciaF(): 
     #pega qtde de registros na tabela _referencia para acelerar o início da rotina
-    con = sqlite3.connect(caminhoDBReceita)
-    res = con.execute("select valor from _referencia where referencia='cnpj_qtde'").fetchone()[0]
+    con = gPool.obtem()
+    res = con.execute("select valor from cnpj._referencia where referencia='cnpj_qtde'").fetchone()[0]
     cnpj_qtde = int(res)
-    data_referencia = con.execute("select valor from _referencia where referencia='CNPJ'").fetchone()[0]
-    con = None
+    data_referencia = con.execute("select valor from cnpj._referencia where referencia='CNPJ'").fetchone()[0]
+    gPool.devolve(con)
     return {'cnpj_qtde':cnpj_qtde, 'data_referencia':data_referencia}
 #.def qteEmpresas_referenciaF(): 
 
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+bases pequenas (cnpj.db e rede.db) geradas na hora para os testes, sem as bases da Receita.
+O rede.db tem as tabelas node, tipo_ligacao, ligacao_int, grau e a view ligacao, como o gerado por rede_cria_tabela_rede.db.py.
+rede_config lê o rede.ini da pasta atual e o arquivo de -k na importação, então os módulos da rede são importados uma vez por sessão,
+com um rede_teste.ini que troca os caminhos das bases. Rodar na pasta do projeto:
+    python -m pytest rede/testes
+"""
+import os, sys, shutil, sqlite3, random, datetime, io, contextlib
+import pytest
+
+kPastaRede = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+kQualificacoes = {22:'Sócio', 49:'Sócio-Administrador'}
+kCodigoFilial = 900
+
+def criaBaseCnpj(caminho, quantidade=60, semente=1):
+    ''' empresas com sócios pessoa física, sócios empresa (cadeias de controle) e filiais. Retorna a lista de ligações
+        (origem, destino, tipo, data de entrada AAAAMMDD) no formato da tabela ligacao'''
+    shutil.copy(os.path.join(kPastaRede, 'bases', 'base_cnpj_vazia.db'), caminho)
+    aleatorio = random.Random(semente)
+    con = sqlite3.connect(caminho)
+    con.execute('DELETE FROM qualificacao_socio')
+    con.executemany('INSERT INTO qualificacao_socio VALUES (?,?)', [(f'{c:02d}', d) for c, d in kQualificacoes.items()])
+    basicos = [f'{10000000+k:08d}' for k in range(quantidade)]
+    pessoas = [(f'***{aleatorio.randint(0, 999999):06d}**', f'PESSOA {k}') for k in range(quantidade//2)]
+    ligacoes = []
+    for k, basico in enumerate(basicos):
+        cnpj = basico + '000100'
+        con.execute('INSERT INTO empresas (cnpj_basico, razao_social, natureza_juridica, capital_social) VALUES (?,?,?,?)', (basico, f'EMPRESA {basico}', '2062', 1000.0))
+        con.execute('''INSERT INTO estabelecimento (cnpj_basico, cnpj_ordem, cnpj_dv, matriz_filial, nome_fantasia, situacao_cadastral, uf, municipio, cnpj)
+                       VALUES (?,?,?,?,?,?,?,?,?)''', (basico, '0001', '00', '1', f'FANTASIA {basico}', '02', 'DF', '9701', cnpj))
+        for f in range(aleatorio.choice([0, 0, 1, 2])):
+            filial = basico + f'{f+2:04d}00'
+            con.execute('''INSERT INTO estabelecimento (cnpj_basico, cnpj_ordem, cnpj_dv, matriz_filial, situacao_cadastral, uf, municipio, cnpj)
+                           VALUES (?,?,?,?,?,?,?,?)''', (basico, f'{f+2:04d}', '00', '2', '02', 'DF', '9701', filial))
+            ligacoes.append(('PJ_'+filial, 'PJ_'+cnpj, kCodigoFilial, None))
+        socios = [('PF', *aleatorio.choice(pessoas)) for _ in range(aleatorio.randint(1, 2))]
+        if k and aleatorio.random()<0.5:
+            socio = basicos[aleatorio.randrange(k)] + '000100'
+            socios.append(('PJ', socio, f'EMPRESA {socio[:8]}'))
+        for tipo, documento, nome in socios:
+            qualificacao = aleatorio.choice(list(kQualificacoes))
+            data = f'20{aleatorio.randint(0, 23):02d}{aleatorio.randint(1, 12):02d}{aleatorio.randint(1, 28):02d}'
+            con.execute('''INSERT INTO socios (cnpj, cnpj_basico, nome_socio, cnpj_cpf_socio, qualificacao_socio, data_entrada_sociedade)
+                           VALUES (?,?,?,?,?,?)''', (cnpj, basico, nome, documento, f'{qualificacao:02d}', data))
+            origem = f'PF_{documento}-{nome}' if tipo=='PF' else f'PJ_{documento}'
+            ligacoes.append((origem, 'PJ_'+cnpj, qualificacao, data))
+    for tabela in ('empresas', 'estabelecimento', 'socios'): #nas bases da Receita os campos vazios são texto vazio, não nulo
+        colunas = [c[1] for c in con.execute(f'pragma table_info({tabela})') if c[2]=='TEXT']
+        con.execute(f'UPDATE {tabela} SET ' + ', '.join(f"{c}=ifnull({c}, '')" for c in colunas))
+    con.commit()
+    con.close()
+    return ligacoes
+#.def criaBaseCnpj
+
+def criaBaseRede(caminho, ligacoes):
+    ''' rede.db com identificadores em inteiros a partir das ligações de criaBaseCnpj'''
+    idents = sorted({l[0] for l in ligacoes} | {l[1] for l in ligacoes})
+    numero = {ident:k+1 for k, ident in enumerate(idents)}
+    def dia(data):
+        return (datetime.date(int(data[:4]), int(data[4:6]), int(data[6:8])) - datetime.date(1970, 1, 1)).days if data else None
+    con = sqlite3.connect(caminho)
+    con.executescript('''
+        CREATE TABLE node (id INTEGER PRIMARY KEY, ident TEXT UNIQUE);
+        CREATE TABLE tipo_ligacao (codigo INTEGER PRIMARY KEY, descricao TEXT);
+        CREATE TABLE ligacao_int (src INTEGER, dst INTEGER, tipo INTEGER, data_entrada INTEGER, PRIMARY KEY (src, tipo, dst)) WITHOUT ROWID;
+        CREATE INDEX idx_ligacao_int_dst ON ligacao_int (dst, tipo, data_entrada);
+    ''')
+    con.executemany('INSERT INTO node VALUES (?,?)', [(numero[i], i) for i in idents])
+    con.executemany('INSERT INTO tipo_ligacao VALUES (?,?)', list(kQualificacoes.items()) + [(kCodigoFilial, 'filial')])
+    con.executemany('INSERT OR IGNORE INTO ligacao_int VALUES (?,?,?,?)', [(numero[o], numero[d], t, dia(data)) for o, d, t, data in ligacoes])
+    con.executescript('''
+        CREATE TABLE grau (id INTEGER PRIMARY KEY, saida INTEGER, entrada INTEGER, total INTEGER);
+        INSERT INTO grau
+        SELECT id, sum(saida), sum(entrada), sum(saida+entrada) FROM (
+            SELECT src as id, count(*) as saida, 0 as entrada FROM ligacao_int GROUP BY src
+            UNION ALL
+            SELECT dst, 0, count(*) FROM ligacao_int GROUP BY dst
+        ) GROUP BY id;
+        CREATE VIEW ligacao AS
+        SELECT n1.ident as id1, n2.ident as id2, tl.descricao as descricao,
+            CASE WHEN tl.descricao='filial' THEN 'estabelecimento' ELSE 'socios' END as comentario,
+            date(t.data_entrada + 2440587.5) as data_entrada
+        FROM ligacao_int t
+        INNER JOIN node n1 ON n1.id=t.src
+        INNER JOIN node n2 ON n2.id=t.dst
+        INNER JOIN tipo_ligacao tl ON tl.codigo=t.tipo;
+    ''')
+    con.commit()
+    con.close()
+    return idents
+#.def criaBaseRede
+
+@pytest.fixture(scope='session')
+def bases(tmp_path_factory):
+    ''' caminhos das bases de teste e identificadores do rede.db'''
+    pasta = tmp_path_factory.mktemp('bases')
+    caminhoCnpj, caminhoRede = str(pasta/'cnpj.db'), str(pasta/'rede.db')
+    idents = criaBaseRede(caminhoRede, criaBaseCnpj(caminhoCnpj))
+    caminhoIni = str(pasta/'rede_teste.ini')
+    with open(caminhoIni, 'w', encoding='utf8') as f:
+        f.write(f'''[BASE]
+base_rede = {caminhoRede}
+base_rede_search =
+base_receita = {caminhoCnpj}
+base_endereco_normalizado =
+base_links =
+base_local =
+base_grafo =
+[ETC]
+limiter_padrao = 10000/second
+limiter_dados = 10000/second
+motor_grafo = sqlite
+[API]
+api_lote = 1
+api_keys = teste
+conectados_maximo_itens = 5
+''')
+    return {'cnpj':caminhoCnpj, 'rede':caminhoRede, 'ini':caminhoIni, 'idents':idents}
+
+@pytest.fixture(scope='session')
+def rede(bases):
+    ''' módulo rede (aplicação flask) carregado com as bases de teste. rede_config precisa do rede.ini na pasta atual'''
+    pastaAnterior, argvAnterior = os.getcwd(), sys.argv
+    os.chdir(kPastaRede)
+    sys.path.insert(0, kPastaRede)
+    sys.argv = ['rede.py', '-k', bases['ini']]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import rede
+    finally:
+        sys.argv = argvAnterior
+    yield rede
+    os.chdir(pastaAnterior)
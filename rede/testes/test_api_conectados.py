@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+/rede/api/conectados tem limite próprio de ids (conectados_maximo_itens, 5 no rede_teste.ini), separado do lote_maximo_itens
+"""
+
+def test_conectados_maximo_itens(rede, bases):
+    assert rede.conectados_maximo_itens==5 and rede.lote_maximo_itens!=5
+    resposta = rede.app.test_client().post('/rede/api/conectados', json={'api_key':'teste', 'ids':bases['idents'][:6]})
+    assert resposta.status_code==400
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+/rede/api/lote: a resposta em ndjson é gerada enquanto o cliente lê, então o teste consome o corpo inteiro
+"""
+import json
+
+def test_lote_ndjson(rede, bases):
+    empresas = [i for i in bases['idents'] if i.startswith('PJ_')][:3]
+    itens = [{'listaIds':[i], 'camada':2} for i in empresas]
+    resposta = rede.app.test_client().post('/rede/api/lote', json={'api_key':'teste', 'itens':itens})
+    assert resposta.status_code==200
+    assert resposta.mimetype=='application/x-ndjson'
+    linhas = [json.loads(linha) for linha in resposta.get_data().splitlines()]
+    assert sorted(l['indice'] for l in linhas)==list(range(len(itens)))
+    for linha in linhas:
+        ids = {n['id'] for n in linha['resultado']['no']}
+        assert empresas[linha['indice']] in ids
+        assert linha['resultado']['ligacao']
+
+def test_lote_chave_invalida(rede):
+    resposta = rede.app.test_client().post('/rede/api/lote', json={'api_key':'errada', 'itens':[{'listaIds':['PJ_10000000000100']}]})
+    assert resposta.status_code==401
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+camadasRede sem lock global: consultas simultâneas em threads, cada uma com uma conexão do pool e as tabelas tmp
+na base :memory: da própria conexão, têm que dar o mesmo resultado das consultas uma de cada vez
+"""
+import io, contextlib, random, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+def resumo(resultado):
+    ''' parte do resultado que não depende da ordem dos itens'''
+    return (sorted((n['id'], n.get('camada')) for n in resultado['no']),
+            sorted((l['origem'], l['destino'], l.get('label', '')) for l in resultado['ligacao']),
+            resultado.get('mensagem', ''))
+
+def globaisDoModulo(modulo):
+    return {nome:valor for nome, valor in vars(modulo).items() if isinstance(valor, (int, float, str, bool, tuple, frozenset))}
+
+def motoresDisponiveis():
+    import rede_grafo
+    return ['sqlite', 'cte'] + (['csr'] if rede_grafo.disponivel() else [])
+
+@pytest.mark.parametrize('motor', ['sqlite', 'cte', 'csr'])
+def test_camadas_simultaneas(rede, bases, monkeypatch, motor):
+    r = rede.rede_relacionamentos
+    if motor not in motoresDisponiveis():
+        pytest.skip(f'motor {motor} indisponível')
+    monkeypatch.setattr(r, 'kMotorGrafo', motor)
+    monkeypatch.setattr(r.gCache, 'limiteBytes', 0) #sem cache, todas as chamadas fazem a consulta
+    aleatorio = random.Random(5)
+    consultas = [((item,), camada) for item in aleatorio.sample(bases['idents'], 12) for camada in (1, 2, 3)]
+    consultas += [(tuple(aleatorio.sample(bases['idents'], 3)), 2) for _ in range(4)]
+    def consulta(parametros):
+        itens, camada = parametros
+        return resumo(r.camadasRede(listaIds=list(itens), camada=camada))
+    globais = globaisDoModulo(r)
+    with contextlib.redirect_stdout(io.StringIO()): #redirect_stdout não é seguro dentro das threads, fica em volta de tudo
+        referencia = {c:consulta(c) for c in consultas}
+        pedidos = consultas*6
+        aleatorio.shuffle(pedidos)
+        with ThreadPoolExecutor(16) as executor:
+            respostas = list(executor.map(consulta, pedidos))
+    assert any(ligacoes for _, ligacoes, _ in referencia.values())
+    diferentes = [c for c, resposta in zip(pedidos, respostas) if resposta!=referencia[c]]
+    assert not diferentes
+    assert globaisDoModulo(r)==globais
+    assert r.gPool.fila.qsize()<=r.gPool.criadas #todas as conexões voltaram ao pool ou foram descartadas
+
+def test_cte_remove_funcoes_da_conexao(rede, bases, monkeypatch):
+    ''' as funções do motor cte guardam os nós da consulta e não podem ficar registradas na conexão devolvida ao pool'''
+    r = rede.rede_relacionamentos
+    monkeypatch.setattr(r, 'kMotorGrafo', 'cte')
+    monkeypatch.setattr(r.gCache, 'limiteBytes', 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        r.camadasRede(listaIds=[bases['idents'][0]], camada=2)
+    con = r.gPool.obtem()
+    try:
+        for funcao in ('no_novo_cte(1, 1)', 'expande_cte(0)'):
+            with pytest.raises(sqlite3.OperationalError):
+                con.execute(f'select {funcao}')
+    finally:
+        r.gPool.devolve(con)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Componentes conexos do grafo de ligações, para a rede-cnpj saber sem busca se dois itens estão ligados.
+É chamado no fim do script rede_cria_tabela_rede.db.py e pode ser rodado de novo sozinho, por exemplo depois de gerar
+o arquivo cnpj_links_ete.db (rede_cria_tabela_cnpj_links_ete.py), para incluir as ligações de endereços, telefones e emails.
+Grava no rede.db:
+- componente (id, componente, tamanho): para cada nó da tabela node, o componente (menor id do componente) e a quantidade de itens do componente
+- componente_extra (ident, componente, tamanho): itens que só aparecem em link_ete (endereços etc), se o cnpj_links_ete.db foi usado
+- componente_info (chave, valor): links_ete=1 se as ligações de cnpj_links_ete.db foram incluídas
+A união é feita com union-find vetorizado no numpy (ligação de raízes pelo menor número e compressão de caminhos a cada rodada).
+"""
+import time, sys, sqlite3, os
+import numpy as np
+
+camDBrede = 'dados-publicos/rede.db'
+camDBlinksEte = 'dados-publicos/cnpj_links_ete.db'
+
+def leLigacoes(con, query, m):
+    ''' lê as ligações em blocos para dois arrays int64'''
+    origem = np.zeros(m, dtype=np.int64)
+    destino = np.zeros(m, dtype=np.int64)
+    cur = con.execute(query)
+    k = 0
+    while True:
+        bloco = cur.fetchmany(1000000)
+        if not bloco:
+            break
+        a = np.array(bloco, dtype=np.int64)
+        origem[k:k+len(a)], destino[k:k+len(a)] = a[:,0], a[:,1]
+        k += len(a)
+        print(time.ctime(), f'{k} de {m} ligações')
+    return origem[:k], destino[:k]
+#.def leLigacoes
+
+def unionFind(n, origem, destino):
+    ''' retorna array pai, com pai[i] = menor número de nó do componente de i'''
+    pai = np.arange(n, dtype=np.int64)
+    rodada = 0
+    while True:
+        po, pd = pai[origem], pai[destino]
+        diferentes = po!=pd
+        if not diferentes.any():
+            break
+        rodada += 1
+        menor, maior = np.minimum(po[diferentes], pd[diferentes]), np.maximum(po[diferentes], pd[diferentes])
+        #liga a raiz maior na menor. pai[i]<=i sempre, então não forma ciclo
+        np.minimum.at(pai, maior, menor)
+        while True: #compressão: cada nó aponta direto para a raiz
+            avo = pai[pai]
+            if (avo==pai).all():
+                break
+            pai = avo
+        origem, destino = origem[diferentes], destino[diferentes] #ligações já dentro do mesmo componente não mudam mais
+        print(time.ctime(), f'rodada {rodada}: {int(diferentes.sum())} ligações entre componentes diferentes')
+    return pai
+#.def unionFind
+
+def criaTabelaComponente(camDBrede, camDBlinksEte=''):
+    con = sqlite3.connect(camDBrede)
+    tabelas = {r[0] for r in con.execute("select name from sqlite_master")}
+    if 'ligacao_int' not in tabelas:
+        print(f'o arquivo {camDBrede} não tem a tabela ligacao_int. Gere novamente com o script rede_cria_tabela_rede.db.py.')
+        con.close()
+        return
+    print(time.ctime(), 'lendo ligações')
+    n = con.execute('select max(id) from node').fetchone()[0] or 0
+    m = con.execute('select count(*) from ligacao_int').fetchone()[0]
+    origem, destino = leLigacoes(con, 'select src, dst from ligacao_int', m)
+    con.executescript('''
+        DROP TABLE IF EXISTS componente;
+        DROP TABLE IF EXISTS componente_extra;
+        DROP TABLE IF EXISTS componente_info;
+        DROP TABLE IF EXISTS temp.ident_extra;
+    ''')
+    bLinksEte = bool(camDBlinksEte) and os.path.exists(camDBlinksEte)
+    qtdeExtra = 0
+    if bLinksEte:
+        print(time.ctime(), f'lendo ligações de {camDBlinksEte}')
+        con.execute("ATTACH DATABASE '" + camDBlinksEte.replace('\\','/') + "' as links")
+        #itens de link_ete que não estão em node recebem números depois do último nó
+        con.executescript(f'''
+            CREATE TEMP TABLE ident_extra (id INTEGER PRIMARY KEY, ident TEXT UNIQUE);
+            INSERT INTO temp.ident_extra (id, ident) VALUES ({n}, NULL);
+            INSERT INTO temp.ident_extra (ident)
+            SELECT id1 FROM links.link_ete UNION SELECT id2 FROM links.link_ete
+            EXCEPT SELECT ident FROM node;
+            DELETE FROM temp.ident_extra WHERE ident IS NULL;
+        ''')
+        qtdeExtra = con.execute('select count(*) from temp.ident_extra').fetchone()[0]
+        mLinks = con.execute('select count(*) from links.link_ete').fetchone()[0]
+        o2, d2 = leLigacoes(con, '''
+            SELECT coalesce(n1.id, e1.id), coalesce(n2.id, e2.id)
+            FROM links.link_ete t
+            LEFT JOIN node n1 ON n1.ident=t.id1 LEFT JOIN temp.ident_extra e1 ON e1.ident=t.id1
+            LEFT JOIN node n2 ON n2.ident=t.id2 LEFT JOIN temp.ident_extra e2 ON e2.ident=t.id2
+        ''', mLinks)
+        origem, destino = np.concatenate([origem, o2]), np.concatenate([destino, d2])
+        o2 = d2 = None
+    print(time.ctime(), 'calculando componentes')
+    total = n + qtdeExtra + 1 #posição 0 não é usada, id de node começa em 1
+    pai = unionFind(total, origem, destino)
+    origem = destino = None
+    tamanho = np.bincount(pai, minlength=total)
+    print(time.ctime(), f'{len(np.unique(pai[1:]))} componentes, maior com {int(tamanho.max())} itens')
+    print(time.ctime(), 'gravando tabela componente')
+    con.execute('CREATE TABLE componente (id INTEGER PRIMARY KEY, componente INTEGER, tamanho INTEGER)')
+    ids = np.arange(1, n+1)
+    for inicio in range(0, n, 1000000):
+        fatia = ids[inicio:inicio+1000000]
+        con.executemany('INSERT INTO componente VALUES (?,?,?)', zip(fatia.tolist(), pai[fatia].tolist(), tamanho[pai[fatia]].tolist()))
+    con.execute('CREATE INDEX idx_componente ON componente (componente)')
+    con.execute('CREATE TABLE componente_extra (ident TEXT PRIMARY KEY, componente INTEGER, tamanho INTEGER)')
+    if qtdeExtra:
+        cur = con.execute('select id, ident from temp.ident_extra')
+        while True:
+            bloco = cur.fetchmany(1000000)
+            if not bloco:
+                break
+            con.executemany('INSERT INTO componente_extra VALUES (?,?,?)', ((ident, int(pai[i]), int(tamanho[pai[i]])) for i, ident in bloco))
+    con.execute('CREATE TABLE componente_info (chave TEXT PRIMARY KEY, valor TEXT)')
+    con.executemany('INSERT INTO componente_info VALUES (?,?)', [('links_ete', '1' if bLinksEte else '0'), ('data', time.strftime('%Y-%m-%d %H:%M:%S'))])
+    con.commit()
+    con.close()
+    print(time.ctime(), f'tabela componente gravada em {camDBrede}' + (f', com as ligações de {camDBlinksEte}' if bLinksEte else ''))
+#.def criaTabelaComponente
+
+if __name__ == '__main__':
+    if not os.path.exists(camDBrede):
+        print(f'o arquivo {camDBrede} não foi localizado. Rode primeiro o script rede_cria_tabela_rede.db.py.')
+        sys.exit(0)
+    criaTabelaComponente(camDBrede, camDBlinksEte)
+    print(time.ctime(), 'Fim!!!!!!!!!! ')
+    resp = input('Pressione Enter.')
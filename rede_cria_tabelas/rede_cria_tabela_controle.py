@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Cadeia de controle societário (fecho transitivo das ligações de sócio PJ->PJ), para a rede-cnpj achar as pessoas no topo
+da cadeia de uma empresa com uma busca no índice, sem expandir 5 a 10 camadas.
+É chamado no fim do script rede_cria_tabela_rede.db.py e pode ser rodado de novo sozinho.
+Grava no rede.db:
+- cadeia_controle (empresa, controladora, profundidade, caminho, ciclo): para cada cnpj, as empresas sócias diretas ou indiretas,
+  com a menor quantidade de ligações (profundidade) e o caminho desse menor trajeto (ids de node separados por vírgula, da empresa até a controladora).
+  ciclo=1 quando a controladora já estava no caminho (participação circular): a linha registra o ciclo e a cadeia não continua a partir dela
+A tabela é calculada em largura, uma profundidade por vez: cada par (empresa, controladora) entra uma vez, com o primeiro caminho achado,
+e só os pares novos são expandidos na profundidade seguinte. O ciclo é procurado no caminho de cada par.
+- cadeia_controle_info (chave, valor): profundidade máxima usada e data
+As ligações de sócio são as de código menor que 100 em tipo_ligacao, mais a 999 (qualificação sem descrição), ou seja, sem representante legal e filial.
+"""
+import time, sys, sqlite3, os
+
+camDBrede = 'dados-publicos/rede.db'
+kProfundidadeMaxima = 20 #quantidade máxima de ligações entre a empresa e a controladora. O custo depende da quantidade de pares (empresa, controladora), não da profundidade
+
+def criaTabelaControle(camDBrede, profundidadeMaxima=kProfundidadeMaxima):
+    con = sqlite3.connect(camDBrede)
+    tabelas = {r[0] for r in con.execute("select name from sqlite_master")}
+    if 'ligacao_int' not in tabelas:
+        print(f'o arquivo {camDBrede} não tem a tabela ligacao_int. Gere novamente com o script rede_cria_tabela_rede.db.py.')
+        con.close()
+        return
+    #node é numerado em ordem alfabética do identificador, então os cnpjs (PJ_) são um intervalo de ids
+    pjInicio, pjFim = con.execute("select min(id), max(id) from node where ident>='PJ_' and ident<'PJ`'").fetchone()
+    print(time.ctime(), 'ligações de sócio entre empresas')
+    con.executescript(f'''
+        DROP TABLE IF EXISTS cadeia_controle;
+        DROP TABLE IF EXISTS cadeia_controle_info;
+        DROP TABLE IF EXISTS temp.socio_pj;
+        CREATE TEMP TABLE socio_pj (src INTEGER, dst INTEGER, PRIMARY KEY (dst, src)) WITHOUT ROWID;
+        INSERT OR IGNORE INTO temp.socio_pj
+        SELECT src, dst FROM ligacao_int
+        WHERE (tipo<100 OR tipo=999) AND src BETWEEN {pjInicio or 0} AND {pjFim or -1} AND dst BETWEEN {pjInicio or 0} AND {pjFim or -1};
+    ''')
+    print(time.ctime(), f"{con.execute('select count(*) from temp.socio_pj').fetchone()[0]} ligações")
+    print(time.ctime(), 'calculando cadeias de controle')
+    #fronteira: pares novos da última profundidade, que ainda não foram expandidos
+    con.executescript('''
+        CREATE TABLE cadeia_controle (empresa INTEGER, controladora INTEGER, profundidade INTEGER, caminho TEXT, ciclo INTEGER,
+                                      PRIMARY KEY (empresa, ciclo, controladora)) WITHOUT ROWID;
+        INSERT INTO cadeia_controle (empresa, controladora, profundidade, caminho, ciclo)
+        SELECT dst, src, 1, dst||','||src, src=dst FROM temp.socio_pj;
+        DROP TABLE IF EXISTS temp.fronteira;
+        CREATE TEMP TABLE fronteira AS
+        SELECT empresa, controladora, caminho FROM cadeia_controle WHERE ciclo=0;
+    ''')
+    profundidade = 1
+    while profundidade<profundidadeMaxima and con.execute('select 1 from temp.fronteira limit 1').fetchone():
+        profundidade += 1
+        #caminho entre vírgulas no instr para não confundir 12 com 123. Se vários caminhos chegam no mesmo par, fica o menor texto
+        con.executescript(f'''
+            DROP TABLE IF EXISTS temp.candidato;
+            CREATE TEMP TABLE candidato AS
+            SELECT f.empresa, s.src as controladora, min(f.caminho||','||s.src) as caminho, instr(','||f.caminho||',', ','||s.src||',')>0 as ciclo
+            FROM temp.fronteira f INNER JOIN temp.socio_pj s ON s.dst=f.controladora
+            GROUP BY f.empresa, s.src, instr(','||f.caminho||',', ','||s.src||',')>0;
+            DROP TABLE temp.fronteira;
+            CREATE TEMP TABLE fronteira AS
+            SELECT c.empresa, c.controladora, c.caminho FROM temp.candidato c
+            WHERE c.ciclo=0 AND NOT EXISTS (SELECT 1 FROM cadeia_controle x WHERE x.empresa=c.empresa AND x.ciclo=0 AND x.controladora=c.controladora);
+            INSERT INTO cadeia_controle (empresa, controladora, profundidade, caminho, ciclo)
+            SELECT empresa, controladora, {profundidade}, caminho, 0 FROM temp.fronteira;
+            INSERT OR IGNORE INTO cadeia_controle (empresa, controladora, profundidade, caminho, ciclo)
+            SELECT empresa, controladora, {profundidade}, caminho, 1 FROM temp.candidato WHERE ciclo=1;
+        ''')
+        print(time.ctime(), f"profundidade {profundidade}: {con.execute('select count(*) from temp.fronteira').fetchone()[0]} pares novos")
+    con.executescript('''
+        DROP TABLE IF EXISTS temp.candidato;
+        DROP TABLE IF EXISTS temp.fronteira;
+        DROP TABLE IF EXISTS temp.socio_pj;
+        CREATE TABLE cadeia_controle_info (chave TEXT PRIMARY KEY, valor TEXT);
+    ''')
+    con.executemany('INSERT INTO cadeia_controle_info VALUES (?,?)', [('profundidade_maxima', str(profundidadeMaxima)), ('data', time.strftime('%Y-%m-%d %H:%M:%S'))])
+    con.commit()
+    qtde, qtdeCiclos, profundidade = con.execute('select count(*), sum(ciclo), max(profundidade) from cadeia_controle').fetchone()
+    con.close()
+    print(time.ctime(), f'tabela cadeia_controle gravada em {camDBrede}: {qtde} linhas, {qtdeCiclos or 0} ciclos, profundidade até {profundidade or 0}')
+#.def criaTabelaControle
+
+if __name__ == '__main__':
+    if not os.path.exists(camDBrede):
+        print(f'o arquivo {camDBrede} não foi localizado. Rode primeiro o script rede_cria_tabela_rede.db.py.')
+        sys.exit(0)
+    criaTabelaControle(camDBrede)
+    print(time.ctime(), 'Fim!!!!!!!!!! ')
+    resp = input('Pressione Enter.')
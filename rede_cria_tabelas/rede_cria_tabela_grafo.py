@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Este script gera o arquivo binário rede_grafo.bin a partir das tabelas node, tipo_ligacao e ligacao_int do rede.db
+(rodar depois do script rede_cria_tabela_rede.db.py).
+No servidor, com motor_grafo=mmap no rede.ini, o arquivo é aberto com numpy.memmap, sem carregar nada na memória.
+Os workers do uwsgi compartilham as mesmas páginas do cache do sistema operacional, e a primeira consulta não espera a carga do grafo.
+
+Formato do arquivo (little-endian):
+- cabeçalho de 4096 bytes: REDEGRF1 + json com quantidade de nós, ligações, descrições dos tipos e posição de cada seção
+- seções alinhadas em 64 bytes:
+    nos_offsets int64[n+1] e nos_texto (identificadores em utf-8 concatenados, em ordem crescente, posição = número do nó)
+    saida_offsets int64[n+1], saida_vizinhos int32[m], saida_tipos uint8[m] (ligações id1->id2, formato CSR)
+    entrada_offsets int64[n+1], entrada_vizinhos int32[m], entrada_tipos uint8[m] (ligações id2->id1)
+"""
+import time, sys, sqlite3, os, json
+import numpy as np
+
+camDBrede = 'dados-publicos/rede.db'
+camGrafo = 'dados-publicos/rede_grafo.bin'
+
+kAssinatura = b'REDEGRF1'
+kTamanhoCabecalho = 4096
+kAlinhamento = 64
+
+def csr(origem, destino, tipos, n):
+    ordem = np.argsort(origem, kind='stable')
+    offsets = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(origem, minlength=n), out=offsets[1:])
+    return offsets, destino[ordem].astype(np.int32), tipos[ordem]
+#.def csr
+
+def escreveSecao(arq, secoes, nome, array):
+    posicao = arq.tell()
+    if posicao % kAlinhamento:
+        arq.write(b'\0'*(kAlinhamento - posicao % kAlinhamento))
+        posicao = arq.tell()
+    array = np.ascontiguousarray(array)
+    arq.write(array.tobytes())
+    secoes[nome] = {'offset':posicao, 'dtype':array.dtype.str, 'tamanho':int(array.size)}
+#.def escreveSecao
+
+def criaArquivoGrafo(camDBrede, camGrafo):
+    ''' grava camGrafo a partir de camDBrede. Retorna False se o rede.db não servir'''
+    con = sqlite3.connect(f'file:{camDBrede}?mode=ro', uri=True)
+    tabelas = {r[0] for r in con.execute("select name from sqlite_master")}
+    if 'ligacao_int' not in tabelas:
+        print(f'o arquivo {camDBrede} não tem a tabela ligacao_int. Gere novamente com o script rede_cria_tabela_rede.db.py.')
+        con.close()
+        return False
+    print(time.ctime(), 'lendo nós')
+    n = con.execute('select count(*) from node').fetchone()[0]
+    idsNos = np.zeros(n, dtype=np.int64)
+    nosOffsets = np.zeros(n+1, dtype=np.int64)
+    camTemp = camGrafo + '.tmp'
+    arq = open(camTemp, 'wb')
+    arq.write(b'\0'*kTamanhoCabecalho)
+    secoes = {}
+    #nos_texto é gravado direto do cursor, para não manter os identificadores na memória
+    posicaoTexto = arq.tell()
+    tamanho = 0
+    for k, (idNo, ident) in enumerate(con.execute('select id, ident from node order by ident')):
+        b = ident.encode('utf8')
+        arq.write(b)
+        tamanho += len(b)
+        idsNos[k] = idNo
+        nosOffsets[k+1] = tamanho
+    secoes['nos_texto'] = {'offset':posicaoTexto, 'dtype':'|u1', 'tamanho':tamanho}
+    escreveSecao(arq, secoes, 'nos_offsets', nosOffsets)
+    nosOffsets = None
+    #a tabela node é criada em ordem de identificador, então id em ordem crescente equivale à ordem alfabética
+    if n and not (np.diff(idsNos)>0).all():
+        print('A tabela node não está com id na mesma ordem de ident. Gere novamente o rede.db.')
+        con.close()
+        arq.close()
+        os.remove(camTemp)
+        return False
+
+    print(time.ctime(), 'lendo ligações')
+    descricoes = [r[1] for r in con.execute('select codigo, descricao from tipo_ligacao order by codigo')]
+    codigos = np.array([r[0] for r in con.execute('select codigo from tipo_ligacao order by codigo')], dtype=np.int64)
+    m = con.execute('select count(*) from ligacao_int').fetchone()[0]
+    origem = np.zeros(m, dtype=np.int64)
+    destino = np.zeros(m, dtype=np.int64)
+    tipos = np.zeros(m, dtype=np.int64)
+    cur = con.execute('select src, dst, tipo from ligacao_int')
+    k = 0
+    while True:
+        bloco = cur.fetchmany(1000000)
+        if not bloco:
+            break
+        a = np.array(bloco, dtype=np.int64)
+        origem[k:k+len(a)], destino[k:k+len(a)], tipos[k:k+len(a)] = a[:,0], a[:,1], a[:,2]
+        k += len(a)
+        print(time.ctime(), f'{k} de {m} ligações')
+    con.close()
+    origem = np.searchsorted(idsNos, origem)
+    destino = np.searchsorted(idsNos, destino)
+    tipos = np.searchsorted(codigos, tipos).astype(np.uint8 if len(descricoes)<256 else np.uint16)
+    idsNos = None
+
+    print(time.ctime(), 'gravando ligações no formato CSR')
+    for sentido, (o, d) in (('saida', (origem, destino)), ('entrada', (destino, origem))):
+        offsets, vizinhos, tiposOrdenados = csr(o, d, tipos, n)
+        escreveSecao(arq, secoes, f'{sentido}_offsets', offsets)
+        escreveSecao(arq, secoes, f'{sentido}_vizinhos', vizinhos)
+        escreveSecao(arq, secoes, f'{sentido}_tipos', tiposOrdenados)
+        offsets = vizinhos = tiposOrdenados = None
+
+    cabecalho = kAssinatura + json.dumps({'nos':n, 'ligacoes':m, 'descricoes':descricoes, 'secoes':secoes}, ensure_ascii=False).encode('utf8')
+    if len(cabecalho)>kTamanhoCabecalho:
+        print('Erro: cabeçalho maior que o previsto.')
+        arq.close()
+        os.remove(camTemp)
+        return False
+    arq.seek(0)
+    arq.write(cabecalho)
+    arq.close()
+    os.replace(camTemp, camGrafo) #só troca o arquivo quando estiver completo
+    print(f'O arquivo {camGrafo} foi gerado com {n} nós e {m} ligações.')
+    return True
+#.def criaArquivoGrafo
+
+if __name__ == '__main__':
+    if not os.path.exists(camDBrede):
+        print(f'o arquivo {camDBrede} não foi localizado. Rode primeiro o script rede_cria_tabela_rede.db.py.')
+        sys.exit(0)
+    if os.path.exists(camGrafo):
+        print('o arquivo ' + camGrafo + ' já existe. Apague-o primeiro.')
+        sys.exit(0)
+    if criaArquivoGrafo(camDBrede, camGrafo):
+        print('Copie o arquivo para a pasta bases e coloque base_grafo e motor_grafo=mmap no rede.ini')
+    print(time.ctime(), 'Fim!!!!!!!!!! ')
+    resp = input('Pressione Enter.')
@@ -8,12 +8,19 @@ Este script deve ser rodado para modificar a base sqlite cnpj.db para ser usado
 A partir da versão 0.8.9 (outubro/2002), a rede-cnpj utiliza a tabela 'ligacao' auxiliar para permitir consultas mais rápidas para a geração dos gráficos (fica cerca de 3x mais rápido)
 Esta rotina:
 - cria tabela ligacao para uso na rede-cnpj
+- os vínculos ficam em inteiros: tabela node (dicionário identificador->número), tipo_ligacao e ligacao_int. 
+  O código do tipo de ligação vem do código da qualificação do sócio, então é o mesmo em todas as gerações da base
+  A tabela ligacao passa a ser uma view sobre ligacao_int, para manter compatibilidade com consultas antigas
+  ligacao_int guarda a data de entrada na sociedade (socios.data_entrada_sociedade) como número do dia desde 1970-01-01, para os filtros de data da rede-cnpj
+- cria as tabelas grau e grau_tipo (quantidade de ligações de cada nó) e componente (componentes conexos), ver rede_cria_tabela_componente.py
+- cria a tabela cadeia_controle (empresas sócias diretas e indiretas de cada cnpj), ver rede_cria_tabela_controle.py
 - cria indexação full text para buscar parte do nome de sócio, razão social e nome fantasia.
 O arquivo cnpj.db deve estar na mesma pasta que este script. 
 """
 
 #import sqlalchemy
 import time, sys, sqlite3, os, psutil
+import rede_cria_tabela_componente, rede_cria_tabela_controle
 
 #camDbSqliteBaseCompleta = r"cnpj.db" 
 camDBcnpj = "dados-publicos/cnpj.db" 
@@ -48,27 +55,31 @@ if resp.lower()!='y' and resp.lower()!='s':
 
 sql_ligacao= '''
 -- cria tabela de ligação (necessário a partir de versão 0.8.9 (outubro/2022)
+-- o tipo da ligação é um código inteiro estável, que não muda entre uma geração e outra da base:
+-- sócio = código da qualificação (cnpj.qualificacao_socio), representante legal = 100 + código da qualificação do representante,
+-- filial = 900, qualificação sem descrição = 999. A descrição fica só na tabela tipo_ligacao
+-- data_entrada é a data de entrada na sociedade (AAAAMMDD) das ligações de sócio e de representante legal, e nula na de filial
 drop table if exists ligacao
 ;
 drop table if exists ligacao1
 ;
 -- PJ->PJ vinculo sócio pessoa juridica
 create table ligacao1 AS
-select  'PJ_'||t.cnpj_cpf_socio as origem, 'PJ_'||t.cnpj as destino, sq.descricao as tipo, 'socios' as base
+select  'PJ_'||t.cnpj_cpf_socio as origem, 'PJ_'||t.cnpj as destino, ifnull(CAST(sq.codigo AS INTEGER), 999) as tipo, 'socios' as base, t.data_entrada_sociedade as data_entrada
 from cnpj.socios t
 left join cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_socio
 where length(t.cnpj_cpf_socio)=14 --t.nome_socio=''
 ;
 -- PF->PJ vinculo de sócio pessoa física
 insert into ligacao1
-select  'PF_'||t.cnpj_cpf_socio||'-'||t.nome_socio as origem, 'PJ_'||t.cnpj as destino, sq.descricao as tipo, 'socios' as base
+select  'PF_'||t.cnpj_cpf_socio||'-'||t.nome_socio as origem, 'PJ_'||t.cnpj as destino, ifnull(CAST(sq.codigo AS INTEGER), 999) as tipo, 'socios' as base, t.data_entrada_sociedade as data_entrada
 from cnpj.socios t
 left join cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_socio
 where length(t.cnpj_cpf_socio)=11 AND t.nome_socio<>''
 ;
 -- PE->PJ empresa sócia no exterior 
 insert into ligacao1
-select 'PE_'||t.nome_socio as origem, 'PJ_'||t.cnpj as destino,  sq.descricao as tipo, 'socios' as base
+select 'PE_'||t.nome_socio as origem, 'PJ_'||t.cnpj as destino,  ifnull(CAST(sq.codigo AS INTEGER), 999) as tipo, 'socios' as base, t.data_entrada_sociedade as data_entrada
 from cnpj.socios t
 left join cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_socio
 where length(t.cnpj_cpf_socio)<>14 and length(t.cnpj_cpf_socio)<>11 and
@@ -76,7 +87,7 @@ t.cnpj_cpf_socio=''
 ;
 -- PF>PE representante legal de empresa socia no exterior
 insert into ligacao1
-select  'PF_'||t.representante_legal||'-'||t.nome_representante as origem, 'PE_'||t.nome_socio as destino, 'rep-sócio-'||sq.descricao as tipo, 'socios' as base
+select  'PF_'||t.representante_legal||'-'||t.nome_representante as origem, 'PE_'||t.nome_socio as destino, ifnull(100+CAST(sq.codigo AS INTEGER), 999) as tipo, 'socios' as base, t.data_entrada_sociedade as data_entrada
 from cnpj.socios t
 left join cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_representante_legal
 where length(t.cnpj_cpf_socio)<>14 and length(t.cnpj_cpf_socio)<>11 and
@@ -84,14 +95,14 @@ t.cnpj_cpf_socio='' and t.representante_legal<>'***000000**'
 ;
 -- PF->PJ representante legal PJ->PJ
 insert into ligacao1
-select 'PF_'||t.representante_legal||'-'||t.nome_representante as origem, 'PJ_'||t.cnpj_cpf_socio as destino, 'rep-sócio-'||sq.descricao as tipo, 'socios' as base
+select 'PF_'||t.representante_legal||'-'||t.nome_representante as origem, 'PJ_'||t.cnpj_cpf_socio as destino, ifnull(100+CAST(sq.codigo AS INTEGER), 999) as tipo, 'socios' as base, t.data_entrada_sociedade as data_entrada
 from cnpj.socios t
 left join cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_representante_legal
 where length(t.cnpj_cpf_socio)=14 and t.representante_legal<>'***000000**' --t.nome_socio=''
 ;
 -- PF->PF representante legal de sócio PF
 insert into ligacao1
-select  'PF_'||t.representante_legal||'-'||t.nome_representante as origem, 'PF_'||t.cnpj_cpf_socio||'-'||t.nome_socio as destino, 'rep-sócio-'||sq.descricao as tipo, 'socios' as base
+select  'PF_'||t.representante_legal||'-'||t.nome_representante as origem, 'PF_'||t.cnpj_cpf_socio||'-'||t.nome_socio as destino, ifnull(100+CAST(sq.codigo AS INTEGER), 999) as tipo, 'socios' as base, t.data_entrada_sociedade as data_entrada
 from cnpj.socios t
 left join cnpj.qualificacao_socio sq ON sq.codigo=t.qualificacao_representante_legal
 where length(t.cnpj_cpf_socio)=11 and t.representante_legal<>'***000000**' --t.nome_socio=''
@@ -106,7 +117,7 @@ CREATE INDEX idx_filiais ON tfilial (cnpj_basico)
 ;
 -- PJ filial-> PJ matriz
 insert into ligacao1
-select 'PJ_'||tf.cnpj as origem, 'PJ_'||t.cnpj as destino, 'filial' as tipo, 'estabelecimento' as base
+select 'PJ_'||tf.cnpj as origem, 'PJ_'||t.cnpj as destino, 900 as tipo, 'estabelecimento' as base, NULL as data_entrada
 from tfilial tf
 left join cnpj.estabelecimento t on t.cnpj_basico=tf.cnpj_basico 
 where  t.matriz_filial = '1' -- is '1'
@@ -128,18 +139,86 @@ and tf.matriz_filial = '2' -- is '2' --tf.cnpj<>t.cnpj
 --- cria tabela de ligacao
 ----------------------------------
 
-CREATE TABLE ligacao AS
-SELECT  origem as id1, destino as id2, tipo as descricao, base as comentario from ligacao1 group by origem, destino, tipo, base
+CREATE TABLE ligacao_texto AS
+SELECT  origem as id1, destino as id2, tipo, min(nullif(data_entrada, '')) as data_entrada from ligacao1 group by origem, destino, tipo
 --testar... parece que group by é mais rápido que distinct
 --SELECT DISTINCT origem as id1, destino as id2, tipo as descricao, base as comentario  from ligacao1
 ;
- --para ficar no padrao das outras tabelas de ligacao
- 
 DROP TABLE IF EXISTS ligacao1
 ;
-CREATE  INDEX idx_ligacao_origem ON ligacao (id1)
+-----------------------------------
+--- identificadores em inteiros. As consultas comparam inteiros, e só convertem para texto na saída
+-----------------------------------
+--id em ordem alfabética do identificador
+CREATE TABLE node (id INTEGER PRIMARY KEY, ident TEXT UNIQUE)
+;
+INSERT INTO node (ident)
+SELECT id1 FROM ligacao_texto
+UNION
+SELECT id2 FROM ligacao_texto
+ORDER BY 1
+;
+CREATE TABLE tipo_ligacao (codigo INTEGER PRIMARY KEY, descricao TEXT)
+;
+INSERT INTO tipo_ligacao (codigo, descricao)
+SELECT codigo, descricao FROM (
+    SELECT CAST(codigo AS INTEGER) as codigo, min(ifnull(descricao,'')) as descricao FROM cnpj.qualificacao_socio GROUP BY 1
+    UNION ALL
+    SELECT 100+CAST(codigo AS INTEGER), 'rep-sócio-'||min(ifnull(descricao,'')) FROM cnpj.qualificacao_socio GROUP BY CAST(codigo AS INTEGER)
+    UNION ALL
+    SELECT 900, 'filial'
+    UNION ALL
+    SELECT 999, ''
+) 
+WHERE codigo IN (SELECT DISTINCT tipo FROM ligacao_texto)
+;
+CREATE INDEX idx_tipo_ligacao_descricao ON tipo_ligacao (descricao)
+;
+--tabela WITHOUT ROWID ordenada por (src, tipo, dst): a busca por src lê as ligações em sequência, sem ir do índice para a tabela.
+--O índice por dst inclui a chave primária (src), então também cobre a consulta. Ver rede/rede_benchmark.py
+--data_entrada: dias desde 1970-01-01 (nulo se a data não for válida). Fica na linha da tabela, então o filtro de data não faz leitura extra
+CREATE TABLE ligacao_int (src INTEGER, dst INTEGER, tipo INTEGER, data_entrada INTEGER, PRIMARY KEY (src, tipo, dst)) WITHOUT ROWID
+;
+INSERT INTO ligacao_int (src, dst, tipo, data_entrada)
+SELECT n1.id, n2.id, t.tipo, 
+    CAST(julianday(substr(t.data_entrada,1,4)||'-'||substr(t.data_entrada,5,2)||'-'||substr(t.data_entrada,7,2)) - 2440587.5 AS INTEGER)
+FROM ligacao_texto t
+INNER JOIN node n1 ON n1.ident=t.id1
+INNER JOIN node n2 ON n2.ident=t.id2
+ORDER BY n1.id, t.tipo, n2.id
 ;
-CREATE  INDEX idx_ligacao_destino ON ligacao (id2)
+DROP TABLE IF EXISTS ligacao_texto
+;
+--índice com o tipo, para o filtro de tipos de ligação (parâmetros tipos e excluir_tipos) ler só as ligações pedidas, 
+--e com a data de entrada, para o filtro de datas (parâmetros data_desde e data_ate) também ser resolvido só no índice
+CREATE  INDEX idx_ligacao_int_dst ON ligacao_int (dst, tipo, data_entrada)
+;
+--grau (quantidade de ligações) de cada nó por tipo de ligação e no total. camadasRede não expande nós com grau acima de grau_maximo_no do rede.ini
+CREATE TABLE grau_tipo AS
+SELECT id, tipo, sum(saida) as saida, sum(entrada) as entrada
+FROM (
+    SELECT src as id, tipo, count(*) as saida, 0 as entrada FROM ligacao_int GROUP BY src, tipo
+    UNION ALL
+    SELECT dst as id, tipo, 0 as saida, count(*) as entrada FROM ligacao_int GROUP BY dst, tipo
+) 
+GROUP BY id, tipo
+;
+CREATE INDEX idx_grau_tipo ON grau_tipo (id)
+;
+CREATE TABLE grau (id INTEGER PRIMARY KEY, saida INTEGER, entrada INTEGER, total INTEGER)
+;
+INSERT INTO grau
+SELECT id, sum(saida), sum(entrada), sum(saida+entrada) FROM grau_tipo GROUP BY id
+;
+--view com os identificadores em texto, no padrao das outras tabelas de ligacao (id1, id2, descricao, comentario)
+CREATE VIEW ligacao AS
+SELECT n1.ident as id1, n2.ident as id2, tl.descricao as descricao, 
+    CASE WHEN tl.descricao='filial' THEN 'estabelecimento' ELSE 'socios' END as comentario,
+    date(t.data_entrada + 2440587.5) as data_entrada
+FROM ligacao_int t
+INNER JOIN node n1 ON n1.id=t.src
+INNER JOIN node n2 ON n2.id=t.dst
+INNER JOIN tipo_ligacao tl ON tl.codigo=t.tipo
 ;
 '''
 
@@ -179,6 +258,12 @@ def executaSequencia(camDB, sqlsequencia):
 # cria tabela rede.db
 executaSequencia(camDBrede, sqlsequencia=sql_ligacao)
 
+# componentes conexos. Se o cnpj_links_ete.db for gerado depois, rodar de novo rede_cria_tabela_componente.py para incluir os endereços
+rede_cria_tabela_componente.criaTabelaComponente(camDBrede, rede_cria_tabela_componente.camDBlinksEte)
+
+# cadeias de controle (sócios PJ->PJ diretos e indiretos), para /rede/api/controle
+rede_cria_tabela_controle.criaTabelaControle(camDBrede)
+
 
 sql_search= '''
 ----------------------------------------------
@@ -201,13 +286,9 @@ select 'PJ_' || te.cnpj ||'-' || te.nome_fantasia  as id_descricao
 from cnpj.estabelecimento te 
 -- where trim(te.nome_fantasia) <>'' --incluir este where faz que ignore cnpj filial sem nome fantasia, o que faz falta na hora de busca filiais por cnpj básico
 UNION ALL
-select  id1  as id_descricao
-from rede.ligacao
-where substr(id1,1,3)<>'PJ_'
-UNION ALL
-select  id2 as id_descricao
-from  rede.ligacao
-where substr(id2,1,3)<>'PJ_'
+select  ident  as id_descricao
+from rede.node
+where substr(ident,1,3)<>'PJ_'
 ) as tunion
 group by id_descricao --talvez group by seja mais rápido que distinct
 ;